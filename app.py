@@ -1,9 +1,32 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import os
+import re
 import sys
 import uuid
 import datetime
 import subprocess
+import atexit
+import threading
+import queue
+
+import asr
+import audio_gc
+import audio_ingest
+import audio_pack
+import book_export
+import dataset
+import dictation
+import dictation_trace
+import jobs
+import metrics
+import oplog
+import rerecognize
+import search
+from catalog import Catalog
+from chapter_store import ChapterStore
+from locks import KeyedLocks
+from storage import SqliteStorage
 
 app = Flask(__name__)
 
@@ -21,45 +44,218 @@ app.config['BOOKS_FOLDER'] = os.path.join(app.root_path, 'books')
 # 确保必要的目录存在
 os.makedirs(app.config['BOOKS_FOLDER'], exist_ok=True)
 
+# 章节存储模式：snapshot每次保存完整写入content.json；
+# oplog只把修改追加到ops.log，超过阈值后由后台线程压缩回content.json；
+# sqlite把书籍、章节和段落保存在SQLITE_PATH数据库中（默认为书籍目录下的library.db），
+# 段落修改只写入变化的行，已有的books目录可以用 python storage.py 导入
+app.config.setdefault('STORAGE_MODE', 'snapshot')
+app.config.setdefault('SQLITE_PATH', None)
+app.config.setdefault('OPLOG_COMPACT_OPS', 500)
+app.config.setdefault('OPLOG_COMPACT_BYTES', 1024 * 1024)
+app.config.setdefault('OPLOG_FSYNC', False)
+
 # 全局变量
 current_book = None
 current_chapter = None
+compactor = oplog.Compactor()
+# 每本书、每个章节各自一把锁，取代原先所有章节共用的一把保存锁
+keyed_locks = KeyedLocks()
+
+def chapter_lock(book_id, chapter_id):
+    return keyed_locks.hold(('chapter', book_id, chapter_id))
+
+def book_lock(book_id):
+    return keyed_locks.hold(('book', book_id))
+
+# 请求耗时按阶段（加载、修改、保存、序列化、等锁、等待子进程）统计，由/metrics输出，见metrics.py
+# 超过SLOW_REQUEST_THRESHOLD秒的请求输出日志，SLOW_REQUEST_LOG为追加写入的日志文件，默认不写文件
+app.config.setdefault('SLOW_REQUEST_THRESHOLD', 1.0)
+app.config.setdefault('SLOW_REQUEST_LOG', None)
+request_metrics = metrics.RequestMetrics(
+    keyed_locks.thread_wait,
+    slow_threshold=app.config['SLOW_REQUEST_THRESHOLD'],
+    slow_log=app.config['SLOW_REQUEST_LOG']
+)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # 解析请求JSON计入load阶段，生成响应计入serialize阶段
+    def loads(self, s, **kwargs):
+        with request_metrics.phase('load'):
+            return super().loads(s, **kwargs)
+    
+    def dumps(self, obj, **kwargs):
+        with request_metrics.phase('serialize'):
+            return super().dumps(obj, **kwargs)
+
+app.json = TimedJSONProvider(app)
+
+@app.before_request
+def begin_request_metrics():
+    request_metrics.begin()
+
+@app.after_request
+def finish_request_metrics(response):
+    request_metrics.finish(request.endpoint, request.method, response.status_code, request.path)
+    return response
+
+@app.teardown_request
+def discard_request_metrics(exc):
+    # 视图抛出未处理的异常时after_request不会执行
+    if request_metrics.active():
+        request_metrics.finish(request.endpoint, request.method, 500, request.path)
+
+_sqlite_storage = None
+_sqlite_storage_lock = threading.Lock()
+
+def sqlite_storage():
+    # STORAGE_MODE为'sqlite'时返回数据库存储，否则返回None，使用JSON目录存储
+    global _sqlite_storage
+    if app.config['STORAGE_MODE'] != 'sqlite':
+        return None
+    path = app.config['SQLITE_PATH'] or os.path.join(app.config['BOOKS_FOLDER'], 'library.db')
+    with _sqlite_storage_lock:
+        if _sqlite_storage is None or _sqlite_storage.path != path:
+            _sqlite_storage = SqliteStorage(path)
+        return _sqlite_storage
 
 class Chapter:
     def __init__(self, chapter_id, title, book_id):
         self.id = chapter_id
         self.title = title
         self.book_id = book_id
+        # 赋值时会建立段落索引并添加结尾段落块
         self.paragraphs = []
         self.chapter_dir = os.path.join(app.config['BOOKS_FOLDER'], book_id, 'chapters', chapter_id)
         self.audio_dir = os.path.join(self.chapter_dir, 'audio')
+        self.content_file = os.path.join(self.chapter_dir, 'content.json')
+        self.log_file = os.path.join(self.chapter_dir, oplog.LOG_FILENAME)
         
-        # 创建章节目录
-        os.makedirs(self.chapter_dir, exist_ok=True)
-        os.makedirs(self.audio_dir, exist_ok=True)
+        # 最近一次加载/保存时content.json和ops.log的(mtime, size)，用于判断缓存是否过期
+        # 数据库存储时为章节的版本号
+        self.file_signature = None
+        # 内存占用估算（字节），供章节缓存按内存上限淘汰
+        self.size_estimate = 0
+        
+        # 章节修订号，每次修改加一，客户端据此判断本地数据是否与服务端一致
+        self.revision = 0
+        
+        # 操作日志：尚未写入磁盘的操作、最后一条操作的序号、快照之后日志中的操作数和字节数
+        self._pending_ops = []
+        self.log_seq = 0
+        self.log_ops = 0
+        self.log_bytes = 0
         
-        # 确保有一个结尾段落块
-        self.ensure_end_paragraph()
+        # 已不再被引用、等待保存后删除的音频文件
+        self._discarded_audio = []
     
-    def ensure_end_paragraph(self):
-        # 收集所有非结尾段落块，排除任何标记为end_paragraph的段落
+    def ensure_dirs(self):
+        # 章节目录只在写入时创建，加载已有章节时不再重复调用makedirs
+        os.makedirs(self.audio_dir, exist_ok=True)
+    
+    def new_audio_filename(self, paragraph_id):
+        # 录音文件名为 段落id_时间戳.wav，同一秒内重复录音时追加序号
+        # 文件名一旦使用就不会对应其他内容，播放接口据此让浏览器长期缓存录音
+        # 这里以独占方式创建空文件占用文件名，随后由上传或边录边识别写入内容
+        self.ensure_dirs()
+        base = f"{paragraph_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        for n in range(1, 1000):
+            filename = f'{base}.wav' if n == 1 else f'{base}_{n}.wav'
+            try:
+                os.close(os.open(os.path.join(self.audio_dir, filename), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return filename
+            except FileExistsError:
+                continue
+        raise RuntimeError('无法生成录音文件名')
+    
+    @staticmethod
+    def read_signature(chapter_dir):
+        signature = []
+        for name in ('content.json', oplog.LOG_FILENAME):
+            try:
+                stat = os.stat(os.path.join(chapter_dir, name))
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+    
+    def is_stale(self):
+        # content.json或ops.log被进程外修改或删除时，缓存中的章节对象需要重新加载
+        db = sqlite_storage()
+        if db is not None:
+            return db.chapter_version(self.book_id, self.id) != self.file_signature
+        return Chapter.read_signature(self.chapter_dir) != self.file_signature
+    
+    def update_size_estimate(self):
+        # 粗略估算：字符串按每字2字节计算，每个段落字典额外计约400字节
+        self.size_estimate = sum(len(p.get('text', '')) * 2 + 400 for p in self.paragraphs)
+    
+    def _record(self, op):
+        # 记录一次修改，操作日志模式下保存时只追加这些记录
+        self.revision += 1
+        # 连续更新同一段落时合并为一条记录
+        if op['op'] == 'update' and self._pending_ops:
+            last = self._pending_ops[-1]
+            if last['op'] == 'update' and last['id'] == op['id']:
+                last['fields'].update(op['fields'])
+                last['revision'] = self.revision
+                return
+        op['revision'] = self.revision
+        self._pending_ops.append(op)
+    
+    # 段落列表与id -> 位置索引
+    # 段落按id查找为O(1)；插入、删除、移动只更新受影响区间内段落的位置，
+    # 在末尾附近添加段落或短距离移动时几乎不需要额外开销
+    @property
+    def paragraphs(self):
+        return self._paragraphs
+    
+    @paragraphs.setter
+    def paragraphs(self, paragraphs):
+        # 整体替换段落列表时（加载、回滚）重建索引，并确保只有一个结尾段落块且在最后
+        end_paragraph = None
         regular_paragraphs = []
-        for p in self.paragraphs:
+        for p in paragraphs:
             # 只保留非结尾段落块
             if not p.get('is_end_paragraph') and p['id'] != 'end_paragraph':
                 regular_paragraphs.append(p)
+            elif end_paragraph is None and p['id'] == 'end_paragraph':
+                end_paragraph = p
         
-        # 创建一个全新的结尾段落块
-        end_paragraph = {
-            'id': 'end_paragraph',
-            'text': '',
-            'audio': '',
-            'created_at': datetime.datetime.now().isoformat(),
-            'is_end_paragraph': True
-        }
+        if end_paragraph is None:
+            # 创建一个全新的结尾段落块
+            end_paragraph = {
+                'id': 'end_paragraph',
+                'text': '',
+                'audio': '',
+                'created_at': datetime.datetime.now().isoformat(),
+                'is_end_paragraph': True
+            }
+        end_paragraph['is_end_paragraph'] = True
         
-        # 重新构建段落列表，确保只有一个结尾段落块且在最后
-        self.paragraphs = regular_paragraphs + [end_paragraph]
+        self._paragraphs = regular_paragraphs + [end_paragraph]
+        self._positions = {p['id']: i for i, p in enumerate(self._paragraphs)}
+    
+    def _reindex(self, start, stop=None):
+        # 更新[start, stop)区间内段落的位置
+        paragraphs = self._paragraphs
+        stop = len(paragraphs) if stop is None else stop
+        positions = self._positions
+        for i in range(start, stop):
+            positions[paragraphs[i]['id']] = i
+    
+    def index_of(self, paragraph_id):
+        return self._positions.get(paragraph_id, -1)
+    
+    def get_paragraph(self, paragraph_id):
+        index = self._positions.get(paragraph_id)
+        return self._paragraphs[index] if index is not None else None
+    
+    def ensure_end_paragraph(self):
+        # 段落列表只通过本类的方法修改，结尾段落块始终在最后；
+        # 只有在列表被直接改动过的情况下才需要重新整理
+        end_index = self._positions.get('end_paragraph')
+        if end_index != len(self._paragraphs) - 1 or len(self._positions) != len(self._paragraphs):
+            self.paragraphs = self._paragraphs
     
     def add_paragraph(self, text='', after_id=None):
         paragraph = {
@@ -69,139 +265,288 @@ class Chapter:
             'created_at': datetime.datetime.now().isoformat()
         }
         
-        if after_id:
-            # 查找after_id对应的索引
-            insert_index = -1
-            for i, p in enumerate(self.paragraphs):
-                if p['id'] == after_id:
-                    insert_index = i + 1  # 在找到的段落后面插入
-                    break
-            
-            if insert_index != -1:
-                # 在找到的位置插入
-                self.paragraphs.insert(insert_index, paragraph)
-            else:
-                # 如果没找到，添加到末尾
-                self.paragraphs.append(paragraph)
-        else:
-            # 没有指定after_id，添加到末尾
-            self.paragraphs.append(paragraph)
+        # 默认添加到末尾（结尾段落块之前）
+        insert_index = len(self._paragraphs) - 1
+        if after_id and after_id != 'end_paragraph':
+            # 在after_id对应的段落后面插入，找不到时添加到末尾
+            after_index = self._positions.get(after_id)
+            if after_index is not None:
+                insert_index = after_index + 1
         
+        self._paragraphs.insert(insert_index, paragraph)
+        self._reindex(insert_index)
+        self._record({'op': 'add', 'index': insert_index, 'paragraph': paragraph})
         return paragraph
     
-    def update_paragraph(self, paragraph_id, text):
-        for paragraph in self.paragraphs:
-            if paragraph['id'] == paragraph_id:
-                paragraph['text'] = text
-                return paragraph
-        return None
+    def update_paragraph(self, paragraph_id, text, **fields):
+        # fields为需要一并更新的其他字段，例如语音识别写入的transcribe_delay
+        paragraph = self.get_paragraph(paragraph_id)
+        if paragraph is None:
+            return None
+        paragraph['text'] = text
+        paragraph.update(fields)
+        self._record({'op': 'update', 'id': paragraph_id, 'fields': dict(fields, text=text)})
+        return paragraph
+    
+    def _discard_audio(self, audio_filename):
+        # 只从模型中去掉引用，章节保存后由后台清理线程删除文件，批量修改回滚时文件仍然可用
+        if audio_filename:
+            self._discarded_audio.append(audio_filename)
     
     def delete_paragraph(self, paragraph_id):
-        for i, paragraph in enumerate(self.paragraphs):
-            if paragraph['id'] == paragraph_id:
-                # 删除关联的音频文件和所有识别结果文件
-                if paragraph['audio']:
-                    # 获取音频文件的基本名称（不含扩展名）
-                    audio_filename = paragraph['audio']
-                    base_name = os.path.splitext(audio_filename)[0]
-                    
-                    # 定义所有可能的文件扩展名
-                    extensions = ['.wav', '.merge.txt', '.txt', '.srt', '.json']
-                    
-                    # 删除所有相关文件
-                    for ext in extensions:
-                        file_path = os.path.join(self.audio_dir, base_name + ext)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                # 删除段落
-                del self.paragraphs[i]
-                return True
-        return False
+        index = self._positions.get(paragraph_id)
+        if index is None or paragraph_id == 'end_paragraph':
+            return False
+        paragraph = self._paragraphs.pop(index)
+        del self._positions[paragraph_id]
+        self._reindex(index)
+        # 删除关联的音频文件和所有识别结果文件
+        self._discard_audio(paragraph['audio'])
+        self._record({'op': 'delete', 'id': paragraph_id})
+        return True
     
-    def add_audio(self, paragraph_id, audio_filename):
-        for paragraph in self.paragraphs:
-            if paragraph['id'] == paragraph_id:
-                # 删除旧的音频文件和所有识别结果文件
-                if paragraph['audio']:
-                    # 获取旧音频文件的基本名称（不含扩展名）
-                    old_audio_filename = paragraph['audio']
-                    old_base_name = os.path.splitext(old_audio_filename)[0]
-                    
-                    # 定义所有可能的文件扩展名
-                    extensions = ['.wav', '.merge.txt', '.txt', '.srt', '.json']
-                    
-                    # 删除所有相关文件
-                    for ext in extensions:
-                        file_path = os.path.join(self.audio_dir, old_base_name + ext)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                # 更新音频文件
-                paragraph['audio'] = audio_filename
-                return paragraph
-        return None
+    def add_audio(self, paragraph_id, audio_filename, audio_meta=None):
+        # audio_meta为入库时统计的音频信息（时长、采样率、峰值），没有时清除旧音频的信息
+        paragraph = self.get_paragraph(paragraph_id)
+        if paragraph is None:
+            return None
+        # 删除旧的音频文件和所有识别结果文件
+        self._discard_audio(paragraph['audio'])
+        # 更新音频文件
+        paragraph['audio'] = audio_filename
+        if audio_filename and app.config['AUDIO_STORAGE'] == 'pack':
+            audio_packer.schedule(self.audio_dir)
+        if audio_meta:
+            paragraph['audio_meta'] = audio_meta
+        else:
+            paragraph.pop('audio_meta', None)
+        self._record({'op': 'audio', 'id': paragraph_id, 'audio': audio_filename, 'audio_meta': audio_meta})
+        return paragraph
+    
+    def remove_audio(self, paragraph_id):
+        return self.add_audio(paragraph_id, '')
     
     def move_paragraph(self, paragraph_id, direction):
-        for i, paragraph in enumerate(self.paragraphs):
-            if paragraph['id'] == paragraph_id:
-                new_index = i + direction
-                if 0 <= new_index < len(self.paragraphs):
-                    # 交换位置
-                    self.paragraphs[i], self.paragraphs[new_index] = self.paragraphs[new_index], self.paragraphs[i]
-                    return True
-                break
-        return False
+        # 与相邻段落交换位置
+        index = self._positions.get(paragraph_id)
+        if index is None:
+            return False
+        return self.move_paragraph_to(paragraph_id, index + direction)
+    
+    def move_paragraph_to(self, paragraph_id, index=None, after_id=None):
+        # 把段落移动到指定位置：index为移动后的位置；或者指定after_id，移动到该段落之后
+        # after_id为None且未指定index时移动到最前面
+        # 结尾段落块固定在最后，不参与移动
+        current = self._positions.get(paragraph_id)
+        last_index = len(self._paragraphs) - 2
+        if current is None or paragraph_id == 'end_paragraph':
+            return False
+        
+        if index is None:
+            if after_id:
+                after_index = self._positions.get(after_id)
+                if after_index is None or after_id == paragraph_id or after_id == 'end_paragraph':
+                    return False
+                # 从前往后移动时，取出当前段落后目标段落的位置会前移一位
+                index = after_index + 1 if after_index < current else after_index
+            else:
+                index = 0
+        
+        if not 0 <= index <= last_index:
+            return False
+        if index == current:
+            return True
+        
+        paragraph = self._paragraphs.pop(current)
+        self._paragraphs.insert(index, paragraph)
+        self._reindex(min(current, index), max(current, index) + 1)
+        self._record({'op': 'move', 'id': paragraph_id, 'index': index})
+        return True
+    
+    def checkpoint(self):
+        # 记录当前状态，批量修改中途失败时用rollback恢复
+        import copy
+        return (
+            [dict(p) for p in self.paragraphs],
+            self.revision,
+            copy.deepcopy(self._pending_ops),
+            list(self._discarded_audio)
+        )
+    
+    def rollback(self, state):
+        paragraphs, self.revision, self._pending_ops, self._discarded_audio = state
+        self.paragraphs = paragraphs
+    
+    def search_changes(self):
+        # 本次保存中文本有变化的段落 {段落id: 文本，已删除为None}，用于增量更新全文搜索索引
+        changes = {}
+        for op in self._pending_ops:
+            if op['op'] not in ('add', 'update', 'delete'):
+                continue
+            paragraph_id = op['paragraph']['id'] if op['op'] == 'add' else op['id']
+            if paragraph_id != 'end_paragraph':
+                paragraph = self.get_paragraph(paragraph_id)
+                changes[paragraph_id] = paragraph['text'] if paragraph else None
+        return changes
     
     def get_full_text(self):
         return '\n'.join([p['text'] for p in self.paragraphs if p['text'].strip() and not p.get('is_end_paragraph')])
     
+    def word_count(self):
+        # 字数按非空白字符计算
+        return sum(len(''.join(p['text'].split())) for p in self.paragraphs if not p.get('is_end_paragraph'))
+    
+    @request_metrics.timed('save')
     def save(self):
         # 保存章节内容到文件
-        import json
-        import threading
-        import os
+        # 章节锁是可重入的，路由中已持有锁时可以直接保存；后台写回/压缩线程也通过它与请求串行
+        with chapter_lock(self.book_id, self.id):
+            # 确保结尾段落块在最后，清理重复的结尾段落块
+            self.ensure_end_paragraph()
+            self.ensure_dirs()
+            search_changes = self.search_changes()
+            
+            db = sqlite_storage()
+            if db is not None:
+                self._save_to_db(db)
+            # 操作日志模式下，已有快照且磁盘未被外部修改时只追加本次的操作记录
+            elif (app.config['STORAGE_MODE'] == 'oplog'
+                    and self.file_signature is not None
+                    and self.file_signature[0] is not None
+                    and not self.is_stale()):
+                self._append_log()
+            else:
+                self._write_snapshot()
+            
+            search_index.update(self.book_id, self.id, search_changes)
+            
+            # 章节已保存，不再被引用的音频文件交给后台清理，见audio_gc.py
+            if self._discarded_audio:
+                audio_sweeper.schedule(self.book_id, self.id)
+                self._discarded_audio = []
+            
+            # 更新书架目录中的字数，数据库存储时书架摘要直接由数据库查询
+            if db is None:
+                catalog.chapter_saved(self.book_id, self.id, self.word_count(), self.file_signature)
         
-        # 确保结尾段落块在最后，清理重复的结尾段落块
-        self.ensure_end_paragraph()
+        if self.log_ops >= app.config['OPLOG_COMPACT_OPS'] or self.log_bytes >= app.config['OPLOG_COMPACT_BYTES']:
+            compactor.schedule(self)
+    
+    def _save_to_db(self, db):
+        # 调用方需持有章节锁
+        # 数据库中的版本与加载时一致时只写入本次修改的段落，否则整章重写
+        self.file_signature = db.save_chapter(
+            self.book_id, self.id, self.title, self.paragraphs[:-1], self.revision,
+            self._pending_ops, self.file_signature)
+        self._pending_ops = []
+        self.update_size_estimate()
+    
+    def _append_log(self):
+        # 调用方需持有章节锁
+        if not self._pending_ops:
+            return
+        ops = []
+        for op in self._pending_ops:
+            self.log_seq += 1
+            ops.append(dict(op, seq=self.log_seq))
+        self.log_bytes += oplog.append_ops(self.log_file, ops, fsync=app.config['OPLOG_FSYNC'])
+        self.log_ops += len(ops)
+        self._pending_ops = []
         
-        content_file = os.path.join(self.chapter_dir, 'content.json')
+        # 记录写入后的文件签名，自己写入的文件不会让缓存失效
+        self.file_signature = Chapter.read_signature(self.chapter_dir)
+    
+    def _write_snapshot(self):
+        # 调用方需持有章节锁
+        import json
+        
+        content_file = self.content_file
         temp_file = content_file + '.tmp'
         
-        # 使用模块级别的锁确保文件写入的原子性
-        if not hasattr(Chapter, '_save_lock'):
-            Chapter._save_lock = threading.Lock()
+        # 先将数据序列化为字符串，确保数据完整性
+        # log_seq表示快照已包含到哪一条操作记录
+        data = {
+            'id': self.id,
+            'title': self.title,
+            'log_seq': self.log_seq,
+            'revision': self.revision,
+            'paragraphs': self.paragraphs
+        }
         
-        with Chapter._save_lock:
-            # 先将数据序列化为字符串，确保数据完整性
-            data = {
-                'id': self.id,
-                'title': self.title,
-                'paragraphs': self.paragraphs
-            }
-            
-            # 写入临时文件
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            # 使用原子操作重命名文件，确保写入的完整性
-            os.replace(temp_file, content_file)
+        # 写入临时文件
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        
+        # 使用原子操作重命名文件，确保写入的完整性
+        os.replace(temp_file, content_file)
+        
+        # 快照已包含所有操作，清空日志
+        oplog.truncate(self.log_file)
+        self._pending_ops = []
+        self.log_ops = 0
+        self.log_bytes = 0
+        
+        # 记录写入后的文件签名，自己写入的文件不会让缓存失效
+        self.file_signature = Chapter.read_signature(self.chapter_dir)
+        self.update_size_estimate()
+    
+    def compact(self):
+        # 把操作日志折叠回content.json，由后台压缩线程调用
+        with chapter_lock(self.book_id, self.id):
+            if self.log_ops == 0 or self.is_stale():
+                # 磁盘已被其他对象或进程修改时放弃，由持有最新数据的一方负责压缩
+                return False
+            self.ensure_end_paragraph()
+            self._write_snapshot()
+            return True
     
     @staticmethod
+    @request_metrics.timed('load')
     def load(chapter_id, book_id):
+        db = sqlite_storage()
+        if db is not None:
+            data = db.load_chapter(book_id, chapter_id)
+            if data is None:
+                return None
+            chapter = Chapter(data['id'], data['title'], book_id)
+            chapter.revision = data['revision']
+            chapter.file_signature = data['version']
+            chapter.paragraphs = data['paragraphs']
+            chapter.update_size_estimate()
+            return chapter
+        
         chapter_dir = os.path.join(app.config['BOOKS_FOLDER'], book_id, 'chapters', chapter_id)
         content_file = os.path.join(chapter_dir, 'content.json')
         
         if os.path.exists(content_file):
             import json
             
+            # 先记录签名再读取，读取期间被外部修改时下次访问会重新加载
+            signature = Chapter.read_signature(chapter_dir)
+            
             # 直接加载JSON文件，不进行任何修复
             with open(content_file, 'r', encoding='utf-8') as f:
                 data = json.load(f)
             
             chapter = Chapter(data['id'], data['title'], book_id)
-            chapter.paragraphs = data.get('paragraphs', [])
+            paragraphs = data.get('paragraphs', [])
+            chapter.log_seq = data.get('log_seq', 0)
+            chapter.revision = data.get('revision', 0)
             
-            # 确保总是有一个结尾段落块，并且在最后位置
-            chapter.ensure_end_paragraph()
+            # 在快照的基础上重放操作日志
+            # 无论当前是否为操作日志模式都要重放，避免切换模式后丢失日志中的修改
+            for op in oplog.read_ops(chapter.log_file, after_seq=chapter.log_seq):
+                oplog.apply_op(paragraphs, op)
+                chapter.log_seq = op['seq']
+                chapter.revision = op.get('revision', chapter.revision + 1)
+                chapter.log_ops += 1
+            if chapter.log_ops:
+                chapter.log_bytes = os.path.getsize(chapter.log_file)
+            chapter.file_signature = signature
+            
+            # 建立段落索引，并确保总是有一个结尾段落块，并且在最后位置
+            chapter.paragraphs = paragraphs
+            chapter.update_size_estimate()
             
             return chapter
         return None
@@ -245,31 +590,59 @@ class Book:
     def delete_chapter(self, chapter_id):
         for i, chapter in enumerate(self.chapters):
             if chapter['id'] == chapter_id:
-                # 删除章节目录
+                # 删除章节目录，持有章节锁避免与正在进行的段落修改交错
                 chapter_dir = os.path.join(self.chapters_dir, chapter_id)
-                if os.path.exists(chapter_dir):
-                    import shutil
-                    shutil.rmtree(chapter_dir)
+                with chapter_lock(self.id, chapter_id):
+                    if os.path.exists(chapter_dir):
+                        import shutil
+                        # 先关闭章节音频包的mmap，Windows下打开的文件无法删除
+                        audio_packs.forget(chapter_dir)
+                        shutil.rmtree(chapter_dir)
+                    db = sqlite_storage()
+                    if db is not None:
+                        db.delete_chapter(self.id, chapter_id)
+                    chapter_store.invalidate(self.id, chapter_id)
+                    search_index.remove(self.id, chapter_id)
                 # 删除章节
                 del self.chapters[i]
                 self.save()
                 return True
         return False
     
+    @request_metrics.timed('save')
     def save(self):
         # 保存书籍信息到文件
+        data = {
+            'id': self.id,
+            'title': self.title,
+            'author': self.author,
+            'chapters': self.chapters
+        }
+        db = sqlite_storage()
+        if db is not None:
+            db.save_book(data)
+            return
+        
         info_file = os.path.join(self.book_dir, 'book_info.json')
         import json
         with open(info_file, 'w', encoding='utf-8') as f:
-            json.dump({
-                'id': self.id,
-                'title': self.title,
-                'author': self.author,
-                'chapters': self.chapters
-            }, f, ensure_ascii=False, indent=2)
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        
+        # 增量更新书架目录
+        catalog.book_saved(data, info_file)
     
     @staticmethod
+    @request_metrics.timed('load')
     def load(book_id):
+        db = sqlite_storage()
+        if db is not None:
+            data = db.load_book(book_id)
+            if data is None:
+                return None
+            book = Book(data['id'], data['title'], data['author'])
+            book.chapters = data['chapters']
+            return book
+        
         book_dir = os.path.join(app.config['BOOKS_FOLDER'], book_id)
         info_file = os.path.join(book_dir, 'book_info.json')
         
@@ -285,17 +658,571 @@ class Book:
     
     @staticmethod
     def get_all_books():
-        books = []
-        for book_dir in os.listdir(app.config['BOOKS_FOLDER']):
-            book_path = os.path.join(app.config['BOOKS_FOLDER'], book_dir)
-            if os.path.isdir(book_path):
-                info_file = os.path.join(book_path, 'book_info.json')
-                if os.path.exists(info_file):
-                    import json
-                    with open(info_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    books.append(data)
-        return books
+        # 返回所有书籍的摘要（不含章节列表），由书架目录缓存
+        db = sqlite_storage()
+        if db is not None:
+            return db.list_books()
+        return catalog.books()
+
+def chapter_words(book_id, chapter_id):
+    chapter = Chapter.load(chapter_id, book_id)
+    return chapter.word_count() if chapter else 0
+
+# 书架目录，缓存每本书的摘要，避免每次打开书架都解析所有书籍的信息文件
+app.config.setdefault('CATALOG_VERIFY_INTERVAL', 30.0)
+catalog = Catalog(
+    lambda: app.config['BOOKS_FOLDER'],
+    lambda book_id, chapter_id: Chapter.read_signature(
+        os.path.join(app.config['BOOKS_FOLDER'], book_id, 'chapters', chapter_id)),
+    chapter_words,
+    verify_interval=app.config['CATALOG_VERIFY_INTERVAL']
+)
+atexit.register(catalog.close)
+
+# 全文搜索索引，章节保存时增量更新，见search.py
+app.config.setdefault('SEARCH_INDEX_PATH', None)
+search_index = search.SearchIndex(
+    lambda: app.config['SEARCH_INDEX_PATH'] or os.path.join(app.config['BOOKS_FOLDER'], search.INDEX_FILENAME))
+atexit.register(search_index.close)
+
+# 进程内章节缓存，段落相关接口都通过它获取章节对象
+app.config.setdefault('CHAPTER_CACHE_MAX_ENTRIES', 64)
+app.config.setdefault('CHAPTER_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+# 写回模式（默认关闭）：段落文本更新先在内存中确认，最多WRITE_BEHIND_INTERVAL秒后写入磁盘，
+# 进程异常退出时会丢失这段时间内的修改
+app.config.setdefault('WRITE_BEHIND', False)
+app.config.setdefault('WRITE_BEHIND_INTERVAL', 1.0)
+app.config.setdefault('WRITE_BEHIND_MAX_DIRTY', 50)
+# 批量修改接口单次最多包含的操作数
+app.config.setdefault('BATCH_MAX_OPS', 1000)
+chapter_store = ChapterStore(
+    Chapter.load,
+    max_entries=app.config['CHAPTER_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['CHAPTER_CACHE_MAX_BYTES'],
+    write_behind=app.config['WRITE_BEHIND'],
+    flush_interval=app.config['WRITE_BEHIND_INTERVAL'],
+    flush_threshold=app.config['WRITE_BEHIND_MAX_DIRTY']
+)
+# 进程退出时写入所有未保存的修改
+atexit.register(chapter_store.close)
+
+# 语音识别客户端池
+# ASR_BACKEND：cw（websocket连接CW服务端，默认；连接失败时暂时改用cw-exe，健康检查时重新连接）、
+# cw-exe（每次启动CW/start_client.exe）、fake（测试用）
+app.config.setdefault('ASR_BACKEND', 'cw')
+app.config.setdefault('ASR_SERVER', 'ws://127.0.0.1:6016')
+app.config.setdefault('ASR_POOL_SIZE', 2)
+app.config.setdefault('ASR_HEALTH_INTERVAL', 30.0)
+app.config.setdefault('ASR_TIMEOUT', 60.0)
+# 边录边识别使用单独的ASR_MAX_STREAMS个常驻连接，不占用识别任务的客户端；
+# 开始录音时最多等待ASR_STREAM_WAIT秒取得连接，取不到或识别后端不支持边录边识别时只录音，
+# 结束后作为识别任务处理，原因在开始录音的响应中返回
+app.config.setdefault('ASR_MAX_STREAMS', 2)
+app.config.setdefault('ASR_STREAM_WAIT', 0.2)
+asr_pool = asr.RecognizerPool(
+    lambda: asr.create_backend(
+        app.config['ASR_BACKEND'],
+        server=app.config['ASR_SERVER'],
+        base_dir=os.path.dirname(os.path.abspath(__file__)),
+        timeout=app.config['ASR_TIMEOUT']
+    ),
+    size=app.config['ASR_POOL_SIZE'],
+    health_interval=app.config['ASR_HEALTH_INTERVAL'],
+    timeout=app.config['ASR_TIMEOUT'],
+    max_streams=app.config['ASR_MAX_STREAMS']
+)
+atexit.register(asr_pool.close)
+
+# 语音识别任务队列：接口立即返回任务id，识别结果通过/api/events推送给编辑器
+# 工作线程数与识别客户端数一致，其中ASR_RESERVED_INTERACTIVE个只处理编辑器中的录音识别
+app.config.setdefault('ASR_RESERVED_INTERACTIVE', 1)
+app.config.setdefault('ASR_MAX_PENDING', 200)
+job_queue = jobs.JobQueue(
+    workers=app.config['ASR_POOL_SIZE'],
+    reserved=app.config['ASR_RESERVED_INTERACTIVE'],
+    max_pending=app.config['ASR_MAX_PENDING']
+)
+# 其余后台任务（重建搜索索引、导出训练数据、手动清理录音）使用单独的BACKGROUND_WORKERS个工作线程，
+# 识别任务队列的工作线程只处理语音识别
+app.config.setdefault('BACKGROUND_WORKERS', 1)
+app.config.setdefault('BACKGROUND_MAX_PENDING', 20)
+background_jobs = jobs.JobQueue(
+    workers=app.config['BACKGROUND_WORKERS'],
+    reserved=0,
+    max_pending=app.config['BACKGROUND_MAX_PENDING']
+)
+event_bus = jobs.EventBus()
+# 边录边识别的会话，超过DICTATION_IDLE_TIMEOUT秒没有收到音频的会话会被清理
+app.config.setdefault('DICTATION_IDLE_TIMEOUT', 60.0)
+dictation_sessions = dictation.DictationManager(app.config['DICTATION_IDLE_TIMEOUT'])
+# 每次录音识别各阶段（上传、保存录音、识别、写入章节）的耗时写入滚动日志，默认为书籍目录下的
+# dictation_trace.log，超过DICTATION_TRACE_MAX_BYTES后轮转；用 python dictation_trace.py 查看统计
+app.config.setdefault('DICTATION_TRACE_LOG', None)
+app.config.setdefault('DICTATION_TRACE_MAX_BYTES', 5 * 1024 * 1024)
+dictation_traces = dictation_trace.TraceLog(
+    lambda: app.config['DICTATION_TRACE_LOG'] or os.path.join(app.config['BOOKS_FOLDER'], dictation_trace.LOG_FILENAME),
+    max_bytes=app.config['DICTATION_TRACE_MAX_BYTES']
+)
+
+# 录音入库：上传的录音在进程池中转换为16kHz单声道16位PCM WAV，并记录时长、采样率和峰值
+# AUDIO_KEEP_ORIGINAL开启时原始录音保存在audio/originals目录下
+app.config.setdefault('AUDIO_INGEST_WORKERS', 2)
+app.config.setdefault('AUDIO_KEEP_ORIGINAL', False)
+audio_ingestor = audio_ingest.AudioIngest(
+    base_dir=os.path.dirname(os.path.abspath(__file__)),
+    workers=app.config['AUDIO_INGEST_WORKERS']
+)
+atexit.register(audio_ingestor.close)
+
+# 录音存储：files每条录音一个文件；pack把一段时间（AUDIO_PACK_DELAY秒）不再变化的录音
+# 追加到章节的音频包中，见audio_pack.py。已有的录音可以用 python audio_pack.py pack 打包
+app.config.setdefault('AUDIO_STORAGE', 'files')
+app.config.setdefault('AUDIO_PACK_DELAY', 300.0)
+audio_packs = audio_pack.PackRegistry()
+audio_packer = audio_pack.Packer(audio_packs, delay=app.config['AUDIO_PACK_DELAY'])
+atexit.register(audio_packs.close)
+atexit.register(audio_packer.close)
+
+# 不再被引用的录音由后台线程清理：有删除的章节在AUDIO_GC_DELAY秒后清理，
+# 另外每隔AUDIO_GC_INTERVAL秒核对整个书库。AUDIO_GC_GRACE秒内修改过的文件不会被删除。
+# AUDIO_GC_DRY_RUN默认为True，只生成报告（见/api/stats的audio_gc.last_report），不删除文件；
+# 用 python audio_gc.py 或 /api/audio-gc/report 确认报告无误后再设为False开启自动删除，
+# 或者用 python audio_gc.py --apply、POST /api/audio-gc/sweep {"apply": true} 手动删除一次
+app.config.setdefault('AUDIO_GC_DRY_RUN', True)
+app.config.setdefault('AUDIO_GC_DELAY', 30.0)
+app.config.setdefault('AUDIO_GC_GRACE', 600.0)
+app.config.setdefault('AUDIO_GC_INTERVAL', 6 * 3600.0)
+
+def book_chapter_ids(book_id):
+    with book_lock(book_id):
+        book = Book.load(book_id)
+        return [chapter['id'] for chapter in book.chapters] if book else None
+
+def live_audio(book_id, chapter_id):
+    # 在章节锁内先写入未保存的修改，再从磁盘读取段落引用的录音
+    with chapter_lock(book_id, chapter_id):
+        chapter_store.flush(book_id, chapter_id)
+        chapter = Chapter.load(chapter_id, book_id)
+        if not chapter:
+            return None
+        return {paragraph['audio'] for paragraph in chapter.paragraphs if paragraph.get('audio')}
+
+audio_sweeper = audio_gc.AudioSweeper(
+    lambda: app.config['BOOKS_FOLDER'],
+    book_chapter_ids,
+    live_audio,
+    audio_packs,
+    grace=app.config['AUDIO_GC_GRACE'],
+    delay=app.config['AUDIO_GC_DELAY'],
+    interval=app.config['AUDIO_GC_INTERVAL'],
+    dry_run=app.config['AUDIO_GC_DRY_RUN'],
+    # 从音频包中删除的录音在压缩后才释放空间
+    packed_removed=lambda audio_dir: audio_packer.schedule(audio_dir) if app.config['AUDIO_STORAGE'] == 'pack' else None
+)
+atexit.register(audio_sweeper.close)
+
+def apply_config():
+    # 各组件在导入时按当时的app.config创建；导入之后修改了以下设置时调用本函数使其生效，
+    # start_background_workers()启动服务器前也会调用一次。
+    # 决定线程和连接数量的设置（ASR_POOL_SIZE、ASR_MAX_STREAMS、ASR_RESERVED_INTERACTIVE、
+    # ASR_MAX_PENDING、BACKGROUND_WORKERS、BACKGROUND_MAX_PENDING、AUDIO_INGEST_WORKERS）只在导入时读取，
+    # 修改时需要改本文件中的默认值
+    request_metrics.slow_threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    request_metrics.slow_log = app.config['SLOW_REQUEST_LOG']
+    catalog.verify_interval = app.config['CATALOG_VERIFY_INTERVAL']
+    chapter_store.max_entries = app.config['CHAPTER_CACHE_MAX_ENTRIES']
+    chapter_store.max_bytes = app.config['CHAPTER_CACHE_MAX_BYTES']
+    chapter_store.write_behind = app.config['WRITE_BEHIND']
+    chapter_store.flush_interval = app.config['WRITE_BEHIND_INTERVAL']
+    chapter_store.flush_threshold = app.config['WRITE_BEHIND_MAX_DIRTY']
+    asr_pool.health_interval = app.config['ASR_HEALTH_INTERVAL']
+    asr_pool.timeout = app.config['ASR_TIMEOUT']
+    dictation_sessions.idle_timeout = app.config['DICTATION_IDLE_TIMEOUT']
+    dictation_traces.max_bytes = app.config['DICTATION_TRACE_MAX_BYTES']
+    audio_packer.delay = app.config['AUDIO_PACK_DELAY']
+    audio_sweeper.dry_run = app.config['AUDIO_GC_DRY_RUN']
+    audio_sweeper.grace = app.config['AUDIO_GC_GRACE']
+    audio_sweeper.delay = app.config['AUDIO_GC_DELAY']
+    audio_sweeper.interval = app.config['AUDIO_GC_INTERVAL']
+
+def start_background_workers(port=None):
+    # 启动需要常驻的后台线程，由入口（main.py和本文件的__main__）调用。
+    # 导入本模块时只创建对象，不启动线程：录音入库的进程池以spawn方式启动子进程，
+    # 子进程会重新导入启动脚本，不能在其中再启动一套后台线程。
+    # 其余后台线程（写回、压缩、识别任务、打包）在第一次使用时才启动。
+    apply_config()
+    audio_sweeper.start()
+    start_search_build()
+    if port is not None:
+        write_server_info(port)
+
+# 服务器运行期间在书籍目录中记录进程号和端口，直接修改书籍目录的命令行工具（rerecognize.py）
+# 据此判断是否有服务器正在使用同一书库
+SERVER_INFO_FILENAME = 'server.json'
+
+def server_info_path():
+    return os.path.join(app.config['BOOKS_FOLDER'], SERVER_INFO_FILENAME)
+
+def write_server_info(port):
+    import json
+    path = server_info_path()
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'pid': os.getpid(), 'port': port}, f)
+    
+    def remove():
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                if json.load(f).get('pid') == os.getpid():
+                    os.remove(path)
+        except (OSError, ValueError):
+            pass
+    atexit.register(remove)
+
+def running_server(timeout=1.0):
+    # 返回正在使用本书库的服务器信息，没有时返回None
+    # 服务器异常退出时记录会残留，因此再尝试连接记录的端口确认
+    import json
+    import socket
+    try:
+        with open(server_info_path(), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if info.get('pid') == os.getpid() or not info.get('port'):
+        return None
+    try:
+        socket.create_connection(('127.0.0.1', info['port']), timeout=timeout).close()
+    except OSError:
+        return None
+    return info
+
+def stored_audio(audio_path):
+    # 需要文件路径时使用：录音已打包时临时写出到文件
+    return audio_pack.materialize(audio_packs, audio_path)
+
+def stored_audio_exists(audio_path):
+    # 录音文件存在，或已打包到章节音频包中
+    if os.path.exists(audio_path):
+        return True
+    return audio_packs.get(os.path.dirname(audio_path)).entry(os.path.basename(audio_path)) is not None
+
+def audio_owner(audio_path):
+    # 由录音路径得到(book_id, chapter_id, paragraph_id)，不在书籍目录中时返回None
+    # 路径格式：{BOOKS_FOLDER}/{book_id}/chapters/{chapter_id}/audio/{paragraph_id}_{timestamp}.wav
+    relative = os.path.relpath(os.path.abspath(audio_path), os.path.abspath(app.config['BOOKS_FOLDER']))
+    parts = relative.split(os.sep)
+    if len(parts) != 5 or parts[1] != 'chapters' or parts[3] != 'audio':
+        return None
+    return parts[0], parts[2], parts[4].split('_')[0]
+
+def recognize_stored(audio_path):
+    with stored_audio(audio_path) as path:
+        return asr_pool.recognize(path)
+
+def ingest_upload(audio_file, audio_dir, filename):
+    # 保存上传的录音并转换为标准格式，返回音频信息；无法转换时按原样保存，返回None
+    audio_path = os.path.join(audio_dir, filename)
+    upload_path = audio_path + '.upload'
+    audio_file.save(upload_path)
+    try:
+        with request_metrics.phase('subprocess'):
+            meta = audio_ingestor.normalize(upload_path, audio_path)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        os.replace(upload_path, audio_path)
+        return None
+    
+    if app.config['AUDIO_KEEP_ORIGINAL']:
+        originals_dir = os.path.join(audio_dir, audio_ingest.ORIGINALS_DIR)
+        os.makedirs(originals_dir, exist_ok=True)
+        # 原始录音按实际格式命名，MediaRecorder录制的webm上传时文件名也是.wav
+        extension = audio_ingest.guess_extension(upload_path)
+        os.replace(upload_path, os.path.join(originals_dir, os.path.splitext(filename)[0] + extension))
+    else:
+        os.remove(upload_path)
+    return meta
+
+def transcribe_delay(start_time, audio_duration):
+    # 从开始录音到转录完成的总时间减去音频长度，得到真正的转录处理时间（秒）
+    if not start_time:
+        return None
+    try:
+        current_time = datetime.datetime.now().timestamp() * 1000  # 转换为毫秒
+        total_delay = (current_time - float(start_time)) / 1000  # 转换为秒
+        return max(0, round(total_delay - audio_duration, 2))  # 确保非负，保留两位小数
+    except ValueError:
+        return None
+
+def publish_recognition(job_id, book_id, chapter_id, paragraph_id, result, start_time=None, audio_filename=None,
+                        audio_meta=None, trace=None):
+    # 在章节锁内写入识别结果（和录音文件），并推送给订阅该章节的编辑器
+    recognized_text = result['text']
+    if trace is not None:
+        trace.mark('final_text')
+    event = {'success': bool(recognized_text), 'text': recognized_text}
+    if not recognized_text:
+        event['message'] = '识别失败：未获取到识别结果'
+    
+    if recognized_text or audio_filename:
+        fields = {}
+        delay = transcribe_delay(start_time, result['duration'])
+        if delay is not None:
+            fields['transcribe_delay'] = delay
+        
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            base_revision = chapter.revision if chapter else 0
+            paragraph = chapter.get_paragraph(paragraph_id) if chapter else None
+            if paragraph and audio_filename:
+                chapter.add_audio(paragraph_id, audio_filename, audio_meta)
+            if paragraph and recognized_text:
+                chapter.update_paragraph(paragraph_id, recognized_text, **fields)
+            if paragraph:
+                chapter_store.commit(chapter)
+                if trace is not None:
+                    trace.mark('chapter_saved')
+                event.update(chapter_delta_data(
+                    chapter, base_revision, [upsert_change(chapter, paragraph)], text=recognized_text))
+                event['success'] = bool(recognized_text)
+    
+    event.update({'type': 'recognition', 'job_id': job_id, 'paragraph_id': paragraph_id})
+    event_bus.publish((book_id, chapter_id), event)
+    if trace is not None:
+        record_trace(trace, result, start_time, event['success'])
+    return event
+
+def record_trace(trace, result, start_time=None, success=True):
+    # 没有浏览器上传的停止时间时，按开始录音时间加音频长度估算
+    trace.audio_duration = result.get('duration')
+    if start_time and trace.audio_duration:
+        started = dictation_trace.client_time(start_time)
+        if started is not None:
+            trace.mark('record_stop', started + trace.audio_duration)
+    trace.success = success
+    dictation_traces.record(trace)
+
+def run_recognition(job, book_id, chapter_id, paragraph_id, audio_path, start_time=None, trace=None):
+    # 识别任务：识别完成后写入段落并推送结果
+    try:
+        with stored_audio(audio_path) as path:
+            result = asr_pool.recognize(path, trace=trace)
+    except Exception as e:
+        event_bus.publish((book_id, chapter_id), {
+            'type': 'recognition', 'job_id': job.id, 'paragraph_id': paragraph_id,
+            'success': False, 'message': f'语音识别失败: {str(e)}'
+        })
+        if trace is not None:
+            record_trace(trace, {}, start_time, False)
+        raise
+    event = publish_recognition(job.id, book_id, chapter_id, paragraph_id, result, start_time, trace=trace)
+    return {'text': result['text'], 'duration': result['duration'], 'event': event}
+
+def submit_recognition(book_id, chapter_id, paragraph_id, audio_path, start_time=None, priority=jobs.INTERACTIVE,
+                       trace=None):
+    return job_queue.submit(
+        run_recognition, book_id, chapter_id, paragraph_id, audio_path, start_time, trace, priority=priority)
+
+# 训练数据导出，见dataset.py
+def dataset_dir(book_id):
+    return os.path.join(app.config['BOOKS_FOLDER'], book_id, 'dataset')
+
+def dataset_samples(book_id):
+    # 逐章生成有录音的段落，同一时间只有一个章节在内存中
+    # 章节直接从磁盘读取，不放入章节缓存，避免导出时把编辑中的章节挤出缓存
+    book = Book.load(book_id)
+    if not book:
+        return
+    for chapter_info in book.chapters:
+        chapter_store.flush(book_id, chapter_info['id'])
+        chapter = Chapter.load(chapter_info['id'], book_id)
+        if not chapter:
+            continue
+        pack = audio_packs.get(chapter.audio_dir)
+        for paragraph in chapter.paragraphs:
+            if paragraph.get('audio'):
+                sample = {
+                    'book_id': book_id,
+                    'chapter_id': chapter.id,
+                    'paragraph_id': paragraph['id'],
+                    'text': paragraph['text'],
+                    'audio_path': os.path.join(chapter.audio_dir, paragraph['audio']),
+                    'audio_meta': paragraph.get('audio_meta')
+                }
+                # 已打包的录音按包中的位置判断是否变化，从包中读取内容
+                entry = pack.entry(paragraph['audio']) if not os.path.exists(sample['audio_path']) else None
+                if entry is not None:
+                    sample['audio_signature'] = list(entry)
+                    sample['read_audio'] = lambda name=paragraph['audio']: pack.read(name)
+                yield sample
+
+def run_dataset_export(job, book_id, options):
+    # 同一本书同时只进行一次导出
+    with keyed_locks.hold(('dataset', book_id)):
+        return dataset.export(dataset_samples(book_id), dataset_dir(book_id), **options)
+
+# 整书导出：逐章读取，同一时间只有一个章节在内存中，见book_export.py
+def book_chapter_texts(book):
+    # 章节直接从磁盘读取，不放入章节缓存，避免导出时把编辑中的章节挤出缓存
+    for chapter_info in book.chapters:
+        with chapter_lock(book.id, chapter_info['id']):
+            chapter_store.flush(book.id, chapter_info['id'])
+            chapter = Chapter.load(chapter_info['id'], book.id)
+        paragraphs = [p['text'] for p in chapter.paragraphs if not p.get('is_end_paragraph')] if chapter else []
+        yield chapter_info['title'], paragraphs
+
+# 全文搜索：重建索引
+search_build_thread = None
+search_build_lock = threading.Lock()
+
+def rebuild_search_index(book_id=None, log=None):
+    # 从章节内容重建整个书库或一本书的索引；逐章在章节锁内读取并写入，重建期间的修改不会丢失
+    start_time = datetime.datetime.now()
+    book_ids = [book_id] if book_id else [summary['id'] for summary in Book.get_all_books()]
+    result = {'books': 0, 'chapters': 0, 'paragraphs': 0}
+    for bid in book_ids:
+        book = Book.load(bid)
+        if not book:
+            search_index.remove(bid)
+            continue
+        for chapter_info in book.chapters:
+            with chapter_lock(bid, chapter_info['id']):
+                chapter_store.flush(bid, chapter_info['id'])
+                chapter = Chapter.load(chapter_info['id'], bid)
+                if not chapter:
+                    continue
+                search_index.replace_chapter(bid, chapter.id, chapter.paragraphs)
+            result['chapters'] += 1
+            result['paragraphs'] += len(chapter.paragraphs) - 1
+        search_index.retain(book_id=bid, chapter_ids={chapter_info['id'] for chapter_info in book.chapters})
+        result['books'] += 1
+        if log:
+            log(f"{book.title}：{len(book.chapters)} 个章节")
+    if not book_id:
+        search_index.retain(book_ids=set(book_ids))
+        search_index.mark_built()
+    result['elapsed'] = round((datetime.datetime.now() - start_time).total_seconds(), 2)
+    return result
+
+def submit_search_rebuild(book_id=None):
+    return background_jobs.submit(lambda job: rebuild_search_index(book_id), priority=jobs.BATCH)
+
+def start_search_build():
+    # 索引尚未建立时在单独的线程中从已有的书籍建立，服务器启动时调用，搜索时发现未建立也会调用
+    # 返回是否正在建立；已经在建立时不重复启动
+    global search_build_thread
+    with search_build_lock:
+        if search_build_thread is not None and search_build_thread.is_alive():
+            return True
+        if search_index.is_built():
+            return False
+        search_build_thread = threading.Thread(target=build_search_index, name='search-build', daemon=True)
+        search_build_thread.start()
+        return True
+
+def build_search_index():
+    try:
+        rebuild_search_index()
+    except Exception:
+        # 下次搜索时重新尝试
+        import traceback
+        traceback.print_exc()
+
+# 批量重新识别：结果按标签保存在段落的asr字段中，不覆盖作者的文本，见rerecognize.py
+def recognition_targets(book_id=None, chapter_id=None):
+    # 列出有录音的段落；book_id为None时遍历整个书库，chapter_id为None时遍历整本书
+    if book_id is None:
+        book_ids = [summary['id'] for summary in Book.get_all_books()]
+    else:
+        book_ids = [book_id]
+    targets = []
+    for bid in book_ids:
+        book = Book.load(bid)
+        if not book:
+            continue
+        for chapter_info in book.chapters:
+            if chapter_id is not None and chapter_info['id'] != chapter_id:
+                continue
+            # 章节直接从磁盘读取，不放入章节缓存，避免遍历书库时把编辑中的章节挤出缓存
+            with chapter_lock(bid, chapter_info['id']):
+                chapter_store.flush(bid, chapter_info['id'])
+                chapter = Chapter.load(chapter_info['id'], bid)
+                if not chapter:
+                    continue
+                for paragraph in chapter.paragraphs:
+                    if not paragraph.get('audio'):
+                        continue
+                    targets.append({
+                        'book_id': bid,
+                        'chapter_id': chapter.id,
+                        'paragraph_id': paragraph['id'],
+                        'audio': paragraph['audio'],
+                        'audio_path': os.path.join(chapter.audio_dir, paragraph['audio']),
+                        'text': paragraph['text'],
+                        'asr': dict(paragraph.get('asr') or {})
+                    })
+    return targets
+
+def store_asr_result(target, tag, entry):
+    # 识别期间录音被替换或段落被删除时不保存
+    with chapter_lock(target['book_id'], target['chapter_id']):
+        chapter = chapter_store.get(target['book_id'], target['chapter_id'])
+        paragraph = chapter.get_paragraph(target['paragraph_id']) if chapter else None
+        if not paragraph or paragraph.get('audio') != target['audio']:
+            return False
+        results = dict(paragraph.get('asr') or {})
+        results[tag] = entry
+        chapter.update_paragraph(paragraph['id'], paragraph['text'], asr=results)
+        chapter_store.commit(chapter, defer=True)
+    return True
+
+recognition_runs = {}
+recognition_runs_lock = threading.Lock()
+
+def start_recognition_run(tag, targets, workers=2, force=False):
+    # 同时进行的识别数不超过任务队列中可以处理批量任务的工作线程数（ASR_POOL_SIZE - ASR_RESERVED_INTERACTIVE），
+    # 超过时按该数量进行，请求的数量记录在requested_workers中
+    run = rerecognize.RecognitionRun(
+        tag, targets, recognize_stored, store_asr_result,
+        lambda func, *args: job_queue.submit(func, *args, priority=jobs.BATCH),
+        workers=min(workers, job_queue.workers - job_queue.reserved), force=force, requested_workers=workers
+    )
+    with recognition_runs_lock:
+        # 只保留最近的记录
+        finished = [r.id for r in recognition_runs.values() if r.finished]
+        for run_id in finished[:max(0, len(recognition_runs) - 20)]:
+            del recognition_runs[run_id]
+        recognition_runs[run.id] = run
+    return run.start()
+
+def wants_full_response():
+    # 旧版客户端需要完整的段落列表和全文，通过full参数（查询参数或JSON字段）开启
+    if request.args.get('full') in ('1', 'true'):
+        return True
+    data = request.get_json(silent=True)
+    return isinstance(data, dict) and bool(data.get('full'))
+
+def upsert_change(chapter, paragraph):
+    return {'type': 'upsert', 'index': chapter.index_of(paragraph['id']), 'paragraph': paragraph}
+
+def chapter_delta_data(chapter, base_revision, changes, full=False, **extra):
+    # 段落修改的增量数据：只包含变化的段落及其位置和章节修订号
+    # base_revision为修改前的修订号，客户端发现与本地不一致时重新加载整章
+    data = {
+        'success': True,
+        'revision': chapter.revision,
+        'base_revision': base_revision,
+        'changes': changes
+    }
+    data.update(extra)
+    if full:
+        data['paragraphs'] = chapter.paragraphs
+        data['full_text'] = chapter.get_full_text()
+    return data
+
+def chapter_delta(chapter, base_revision, changes, **extra):
+    # 段落修改接口的增量响应
+    return jsonify(chapter_delta_data(chapter, base_revision, changes, full=wants_full_response(), **extra))
 
 @app.route('/')
 def index():
@@ -350,99 +1277,184 @@ def get_book(book_id):
 
 @app.route('/api/book/<book_id>/update', methods=['POST'])
 def update_book(book_id):
-    book = Book.load(book_id)
-    if not book:
-        return jsonify({'success': False, 'message': '书籍不存在'})
-    
-    title = request.json.get('title')
-    author = request.json.get('author')
-    
-    if title:
-        book.title = title
-    if author is not None:
-        book.author = author
-    
-    book.save()
-    return jsonify({
-        'success': True,
-        'book': {
-            'id': book.id,
-            'title': book.title,
-            'author': book.author
-        }
-    })
+    # 在书籍锁内完成“读取-修改-保存”
+    with book_lock(book_id):
+        book = Book.load(book_id)
+        if not book:
+            return jsonify({'success': False, 'message': '书籍不存在'})
+        
+        title = request.json.get('title')
+        author = request.json.get('author')
+        
+        if title:
+            book.title = title
+        if author is not None:
+            book.author = author
+        
+        book.save()
+        return jsonify({
+            'success': True,
+            'book': {
+                'id': book.id,
+                'title': book.title,
+                'author': book.author
+            }
+        })
 
 @app.route('/api/book/<book_id>/delete', methods=['DELETE'])
 def delete_book(book_id):
     book_dir = os.path.join(app.config['BOOKS_FOLDER'], book_id)
-    if os.path.exists(book_dir):
-        import shutil
-        shutil.rmtree(book_dir)
-        return jsonify({'success': True})
+    with book_lock(book_id):
+        found = False
+        if os.path.exists(book_dir):
+            import shutil
+            audio_packs.forget(book_dir)
+            shutil.rmtree(book_dir)
+            found = True
+        db = sqlite_storage()
+        if db is not None and db.load_book(book_id) is not None:
+            db.delete_book(book_id)
+            found = True
+        if found:
+            chapter_store.invalidate(book_id)
+            catalog.remove(book_id)
+            search_index.remove(book_id)
+            return jsonify({'success': True})
     return jsonify({'success': False, 'message': '书籍不存在'})
 
 # 章节相关API
 @app.route('/api/book/<book_id>/chapter/new', methods=['POST'])
 def new_chapter(book_id):
-    book = Book.load(book_id)
-    if not book:
-        return jsonify({'success': False, 'message': '书籍不存在'})
-    
-    title = request.json.get('title', '新章节')
-    chapter = book.add_chapter(title)
-    
-    return jsonify({'success': True, 'chapter': chapter})
+    # 在书籍锁内完成“读取-修改-保存”
+    with book_lock(book_id):
+        book = Book.load(book_id)
+        if not book:
+            return jsonify({'success': False, 'message': '书籍不存在'})
+        
+        title = request.json.get('title', '新章节')
+        chapter = book.add_chapter(title)
+        
+        return jsonify({'success': True, 'chapter': chapter})
 
 @app.route('/api/book/<book_id>/chapter/<chapter_id>/update', methods=['POST'])
 def update_chapter(book_id, chapter_id):
-    book = Book.load(book_id)
-    if not book:
-        return jsonify({'success': False, 'message': '书籍不存在'})
-    
-    title = request.json.get('title')
-    if not title:
-        return jsonify({'success': False, 'message': '章节标题不能为空'})
-    
-    chapter = book.update_chapter(chapter_id, title)
-    if chapter:
-        return jsonify({'success': True, 'chapter': chapter})
-    return jsonify({'success': False, 'message': '章节不存在'})
+    # 在书籍锁内完成“读取-修改-保存”
+    with book_lock(book_id):
+        book = Book.load(book_id)
+        if not book:
+            return jsonify({'success': False, 'message': '书籍不存在'})
+        
+        title = request.json.get('title')
+        if not title:
+            return jsonify({'success': False, 'message': '章节标题不能为空'})
+        
+        chapter = book.update_chapter(chapter_id, title)
+        if chapter:
+            return jsonify({'success': True, 'chapter': chapter})
+        return jsonify({'success': False, 'message': '章节不存在'})
 
 @app.route('/api/book/<book_id>/chapter/<chapter_id>/delete', methods=['DELETE'])
 def delete_chapter(book_id, chapter_id):
+    # 在书籍锁内完成“读取-修改-保存”
+    with book_lock(book_id):
+        book = Book.load(book_id)
+        if not book:
+            return jsonify({'success': False, 'message': '书籍不存在'})
+        
+        if book.delete_chapter(chapter_id):
+            return jsonify({'success': True})
+        return jsonify({'success': False, 'message': '章节不存在'})
+
+@app.route('/api/book/<book_id>/export', methods=['GET'])
+def export_book(book_id):
+    # 导出整本书，format为txt、md或epub；边生成边发送，不等整本书生成完
+    fmt = request.args.get('format', 'txt')
+    if fmt not in book_export.FORMATS:
+        return jsonify({'success': False, 'message': '不支持的导出格式'})
     book = Book.load(book_id)
     if not book:
         return jsonify({'success': False, 'message': '书籍不存在'})
     
-    if book.delete_chapter(chapter_id):
-        return jsonify({'success': True})
-    return jsonify({'success': False, 'message': '章节不存在'})
+    from urllib.parse import quote
+    mimetype, extension = book_export.FORMATS[fmt]
+    filename = book_export.safe_filename(book.title, extension)
+    return Response(
+        book_export.export(fmt, book.id, book.title, book.author, book_chapter_texts(book)),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f"attachment; filename=\"book{extension}\"; filename*=UTF-8''{quote(filename)}",
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@app.route('/api/book/<book_id>/dataset/export', methods=['POST'])
+def export_dataset(book_id):
+    # 导出（文本，音频）训练数据，作为批量任务执行，结果通过/api/jobs查询
+    try:
+        if not Book.load(book_id):
+            return jsonify({'success': False, 'message': '书籍不存在'})
+        data = request.json or {}
+        options = {'full': bool(data.get('full'))}
+        if data.get('shard_size_mb'):
+            options['shard_size'] = int(float(data['shard_size_mb']) * 1024 * 1024)
+        for name, convert in (('min_duration', float), ('max_duration', float), ('min_chars', int), ('max_chars', int)):
+            if data.get(name) is not None:
+                options[name] = convert(data[name])
+        try:
+            job = background_jobs.submit(run_dataset_export, book_id, options, priority=jobs.BATCH)
+        except queue.Full as e:
+            return jsonify({'success': False, 'message': str(e)})
+        return jsonify({'success': True, 'job_id': job.id})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'导出训练数据失败: {str(e)}'})
 
 # 段落相关API
 @app.route('/api/chapter/<book_id>/<chapter_id>/paragraphs', methods=['GET'])
 def get_paragraphs(book_id, chapter_id):
-    chapter = Chapter.load(chapter_id, book_id)
-    if chapter:
-        return jsonify({
-            'success': True,
-            'paragraphs': chapter.paragraphs,
-            'full_text': chapter.get_full_text()
-        })
+    # 切换章节时把其他章节未保存的修改写入磁盘
+    chapter_store.flush_all(exclude=(book_id, chapter_id))
+    # 序列化期间持有章节锁，避免与并发的修改交错
+    with chapter_lock(book_id, chapter_id):
+        chapter = chapter_store.get(book_id, chapter_id)
+        if chapter:
+            return jsonify({
+                'success': True,
+                'revision': chapter.revision,
+                'paragraphs': chapter.paragraphs,
+                'full_text': chapter.get_full_text()
+            })
     return jsonify({'success': False, 'message': '章节不存在'})
 
+@app.route('/api/chapter/<book_id>/<chapter_id>/flush', methods=['POST'])
+def flush_chapter(book_id, chapter_id):
+    # 编辑器失去焦点或离开页面时调用，立即写入未保存的修改
+    try:
+        flushed = chapter_store.flush(book_id, chapter_id)
+        return jsonify({'success': True, 'flushed': flushed})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'保存章节失败: {str(e)}'})
+
 @app.route('/api/chapter/<book_id>/<chapter_id>/paragraph/add', methods=['POST'])
 def add_paragraph(book_id, chapter_id):
     try:
-        chapter = Chapter.load(chapter_id, book_id)
-        if not chapter:
-            return jsonify({'success': False, 'message': '章节不存在'})
-        
-        text = request.json.get('text', '')
-        after_id = request.json.get('after_id')
-        paragraph = chapter.add_paragraph(text, after_id)
-        chapter.save()
-        
-        return jsonify({'success': True, 'paragraphs': chapter.paragraphs, 'full_text': chapter.get_full_text()})
+        # 在章节锁内完成“读取-修改-保存”，同一章节的并发修改不会互相覆盖
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            if not chapter:
+                return jsonify({'success': False, 'message': '章节不存在'})
+            
+            text = request.json.get('text', '')
+            after_id = request.json.get('after_id')
+            base_revision = chapter.revision
+            paragraph = chapter.add_paragraph(text, after_id)
+            chapter_store.commit(chapter)
+            
+            return chapter_delta(chapter, base_revision, [upsert_change(chapter, paragraph)], paragraph=paragraph)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -451,22 +1463,26 @@ def add_paragraph(book_id, chapter_id):
 @app.route('/api/chapter/<book_id>/<chapter_id>/paragraph/update', methods=['POST'])
 def update_paragraph(book_id, chapter_id):
     try:
-        chapter = Chapter.load(chapter_id, book_id)
-        if not chapter:
-            return jsonify({'success': False, 'message': '章节不存在'})
-        
-        paragraph_id = request.json.get('id')
-        text = request.json.get('text')
-        
-        if not paragraph_id or text is None:
-            return jsonify({'success': False, 'message': '参数错误'})
-        
-        paragraph = chapter.update_paragraph(paragraph_id, text)
-        if paragraph:
-            chapter.save()
-            return jsonify({'success': True, 'paragraph': paragraph, 'full_text': chapter.get_full_text()})
-        
-        return jsonify({'success': False, 'message': '段落不存在'})
+        # 在章节锁内完成“读取-修改-保存”，同一章节的并发修改不会互相覆盖
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            if not chapter:
+                return jsonify({'success': False, 'message': '章节不存在'})
+            
+            paragraph_id = request.json.get('id')
+            text = request.json.get('text')
+            
+            if not paragraph_id or text is None:
+                return jsonify({'success': False, 'message': '参数错误'})
+            
+            base_revision = chapter.revision
+            paragraph = chapter.update_paragraph(paragraph_id, text)
+            if paragraph:
+                # 按键触发的更新走写回模式，只在内存中确认，由后台合并写入磁盘
+                chapter_store.commit(chapter, defer=True)
+                return chapter_delta(chapter, base_revision, [upsert_change(chapter, paragraph)], paragraph=paragraph)
+            
+            return jsonify({'success': False, 'message': '段落不存在'})
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -475,15 +1491,18 @@ def update_paragraph(book_id, chapter_id):
 @app.route('/api/chapter/<book_id>/<chapter_id>/paragraph/delete/<paragraph_id>', methods=['DELETE'])
 def delete_paragraph(book_id, chapter_id, paragraph_id):
     try:
-        chapter = Chapter.load(chapter_id, book_id)
-        if not chapter:
-            return jsonify({'success': False, 'message': '章节不存在'})
-        
-        if chapter.delete_paragraph(paragraph_id):
-            chapter.save()
-            return jsonify({'success': True, 'full_text': chapter.get_full_text()})
-        
-        return jsonify({'success': False, 'message': '段落不存在'})
+        # 在章节锁内完成“读取-修改-保存”，同一章节的并发修改不会互相覆盖
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            if not chapter:
+                return jsonify({'success': False, 'message': '章节不存在'})
+            
+            base_revision = chapter.revision
+            if chapter.delete_paragraph(paragraph_id):
+                chapter_store.commit(chapter)
+                return chapter_delta(chapter, base_revision, [{'type': 'delete', 'id': paragraph_id}])
+            
+            return jsonify({'success': False, 'message': '段落不存在'})
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -492,26 +1511,154 @@ def delete_paragraph(book_id, chapter_id, paragraph_id):
 @app.route('/api/chapter/<book_id>/<chapter_id>/paragraph/move/<paragraph_id>/<direction>', methods=['POST'])
 def move_paragraph(book_id, chapter_id, paragraph_id, direction):
     try:
-        chapter = Chapter.load(chapter_id, book_id)
-        if not chapter:
-            return jsonify({'success': False, 'message': '章节不存在'})
-        
-        direction = 1 if direction == 'down' else -1
-        if chapter.move_paragraph(paragraph_id, direction):
-            chapter.save()
-            return jsonify({'success': True, 'paragraphs': chapter.paragraphs, 'full_text': chapter.get_full_text()})
+        # 在章节锁内完成“读取-修改-保存”，同一章节的并发修改不会互相覆盖
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            if not chapter:
+                return jsonify({'success': False, 'message': '章节不存在'})
+            
+            direction = 1 if direction == 'down' else -1
+            base_revision = chapter.revision
+            if chapter.move_paragraph(paragraph_id, direction):
+                chapter_store.commit(chapter)
+                change = {'type': 'move', 'id': paragraph_id, 'index': chapter.index_of(paragraph_id)}
+                return chapter_delta(chapter, base_revision, [change])
+            
+            return jsonify({'success': False, 'message': '移动失败'})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'移动段落失败: {str(e)}'})
+
+@app.route('/api/chapter/<book_id>/<chapter_id>/paragraph/move-to', methods=['POST'])
+def move_paragraph_to(book_id, chapter_id):
+    # 把段落移动到任意位置（拖拽排序），参数为 {"id": "...", "index": 3} 或 {"id": "...", "after_id": "..."}
+    # after_id为null时移动到最前面
+    try:
+        paragraph_id = request.json.get('id')
+        index = request.json.get('index')
+        after_id = request.json.get('after_id')
+        if not paragraph_id or (index is not None and not isinstance(index, int)):
+            return jsonify({'success': False, 'message': '参数错误'})
         
-        return jsonify({'success': False, 'message': '移动失败'})
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            if not chapter:
+                return jsonify({'success': False, 'message': '章节不存在'})
+            
+            base_revision = chapter.revision
+            if chapter.move_paragraph_to(paragraph_id, index, after_id):
+                chapter_store.commit(chapter)
+                change = {'type': 'move', 'id': paragraph_id, 'index': chapter.index_of(paragraph_id)}
+                return chapter_delta(chapter, base_revision, [change])
+            
+            return jsonify({'success': False, 'message': '移动失败'})
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'移动段落失败: {str(e)}'})
 
+@app.route('/api/chapter/<book_id>/<chapter_id>/paragraphs/batch', methods=['POST'])
+def batch_paragraphs(book_id, chapter_id):
+    # 按顺序原子地执行一组段落操作，只读取和保存一次章节
+    # 操作格式：
+    #   {"op": "add", "text": "...", "after_id": "..."}
+    # id和after_id可以是"$N"，表示第N个操作（从0开始）得到的段落
+    #   {"op": "update", "id": "...", "text": "..."}
+    #   {"op": "move", "id": "...", "direction": "up" | "down"}
+    #   {"op": "move", "id": "...", "index": 3} 或 {"op": "move", "id": "...", "after_id": "..."}
+    #   {"op": "delete", "id": "..."}
+    # 任意一个操作失败时全部回滚，返回失败操作的位置
+    try:
+        ops = request.json.get('ops')
+        if not isinstance(ops, list) or not ops:
+            return jsonify({'success': False, 'message': '参数错误'})
+        if len(ops) > app.config['BATCH_MAX_OPS']:
+            return jsonify({'success': False, 'message': f'操作数超过上限 {app.config["BATCH_MAX_OPS"]}'})
+        
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            if not chapter:
+                return jsonify({'success': False, 'message': '章节不存在'})
+            
+            base_revision = chapter.revision
+            state = chapter.checkpoint()
+            results = []
+            changes = []
+            
+            for i, op in enumerate(ops):
+                error, result, change = apply_batch_op(chapter, op, results)
+                if error:
+                    chapter.rollback(state)
+                    return jsonify({
+                        'success': False,
+                        'message': f'第 {i + 1} 个操作失败: {error}',
+                        'failed_index': i,
+                        'results': results
+                    })
+                results.append(result)
+                changes.append(change)
+            
+            chapter_store.commit(chapter)
+            return chapter_delta(chapter, base_revision, changes, results=results)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'批量修改段落失败: {str(e)}'})
+
+def resolve_batch_ref(paragraph_id, results):
+    # "$N"引用本批次中第N个操作得到的段落
+    if isinstance(paragraph_id, str) and paragraph_id.startswith('$'):
+        return results[int(paragraph_id[1:])]['id']
+    return paragraph_id
+
+def apply_batch_op(chapter, op, results):
+    # 执行单个批量操作，返回 (错误信息, 操作结果, 增量修改)
+    if not isinstance(op, dict):
+        return '参数错误', None, None
+    kind = op.get('op')
+    try:
+        paragraph_id = resolve_batch_ref(op.get('id'), results)
+        after_id = resolve_batch_ref(op.get('after_id'), results)
+    except (ValueError, IndexError, KeyError, TypeError):
+        return '引用的操作不存在', None, None
+    
+    if kind == 'add':
+        paragraph = chapter.add_paragraph(op.get('text', ''), after_id)
+        return None, {'op': kind, 'id': paragraph['id']}, upsert_change(chapter, paragraph)
+    
+    if kind == 'update':
+        if not paragraph_id or op.get('text') is None:
+            return '参数错误', None, None
+        paragraph = chapter.update_paragraph(paragraph_id, op['text'])
+        if not paragraph:
+            return '段落不存在', None, None
+        return None, {'op': kind, 'id': paragraph_id}, upsert_change(chapter, paragraph)
+    
+    if kind == 'move':
+        if 'index' in op or 'after_id' in op:
+            index = op.get('index')
+            if index is not None and not isinstance(index, int):
+                return '参数错误', None, None
+            moved = chapter.move_paragraph_to(paragraph_id, index, after_id)
+        else:
+            moved = chapter.move_paragraph(paragraph_id, 1 if op.get('direction') == 'down' else -1)
+        if not moved:
+            return '移动失败', None, None
+        return None, {'op': kind, 'id': paragraph_id}, {'type': 'move', 'id': paragraph_id, 'index': chapter.index_of(paragraph_id)}
+    
+    if kind == 'delete':
+        if not chapter.delete_paragraph(paragraph_id):
+            return '段落不存在', None, None
+        return None, {'op': kind, 'id': paragraph_id}, {'type': 'delete', 'id': paragraph_id}
+    
+    return f'未知操作 {kind}', None, None
+
 # 音频相关API
 @app.route('/api/chapter/<book_id>/<chapter_id>/audio/upload/<paragraph_id>', methods=['POST'])
 def upload_audio(book_id, chapter_id, paragraph_id):
     try:
-        chapter = Chapter.load(chapter_id, book_id)
+        chapter = chapter_store.get(book_id, chapter_id)
         if not chapter:
             return jsonify({'success': False, 'message': '章节不存在'})
         
@@ -522,74 +1669,244 @@ def upload_audio(book_id, chapter_id, paragraph_id):
         if audio_file.filename == '':
             return jsonify({'success': False, 'message': '没有选择文件'})
         
-        # 获取录音开始时间
+        # 获取录音开始时间；stop_time为停止录音的时间，用于统计上传耗时
         start_time = request.form.get('start_time')
+        recognize = request.form.get('recognize') in ('1', 'true')
+        trace = None
+        if recognize:
+            trace = dictation_trace.Trace(book_id, chapter_id, paragraph_id, 'upload')
+            trace.mark('upload_received')
+            stop_time = dictation_trace.client_time(request.form.get('stop_time'))
+            if stop_time is not None:
+                trace.mark('record_stop', stop_time)
         
         # 生成唯一的文件名
-        filename = f"{paragraph_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.wav"
+        filename = chapter.new_audio_filename(paragraph_id)
         
-        # 保存文件到章节的音频目录
+        # 保存文件到章节的音频目录并转换为标准格式，耗时较长，放在章节锁外进行
         audio_path = os.path.join(chapter.audio_dir, filename)
-        audio_file.save(audio_path)
+        audio_meta = ingest_upload(audio_file, chapter.audio_dir, filename)
+        if trace is not None:
+            trace.mark('audio_saved')
         
         # 更新段落的音频信息
-        paragraph = chapter.add_audio(paragraph_id, filename)
-        if paragraph:
-            chapter.save()
-            # 返回音频文件的完整路径和开始时间
-            return jsonify({
-                'success': True, 
-                'paragraph': paragraph,
-                'audio_path': audio_path,
-                'start_time': start_time
-            })
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            base_revision = chapter.revision if chapter else 0
+            paragraph = chapter.add_audio(paragraph_id, filename, audio_meta) if chapter else None
+            if paragraph:
+                chapter_store.commit(chapter)
+                delta = chapter_delta_data(
+                    chapter, base_revision, [upsert_change(chapter, paragraph)],
+                    full=wants_full_response(),
+                    paragraph=paragraph,
+                    audio_path=audio_path,
+                    start_time=start_time
+                )
+            else:
+                delta = None
+        if not delta:
+            return jsonify({'success': False, 'message': '段落不存在'})
         
-        return jsonify({'success': False, 'message': '段落不存在'})
+        # recognize=1时同时提交识别任务，识别结果通过/api/events推送
+        if recognize:
+            try:
+                delta['job_id'] = submit_recognition(
+                    book_id, chapter_id, paragraph_id, audio_path, start_time, trace=trace).id
+            except queue.Full as e:
+                delta['job_error'] = str(e)
+        # 返回音频文件的完整路径和开始时间
+        return jsonify(delta)
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'上传录音失败: {str(e)}'})
 
+# 录音播放：支持Range请求（拖动进度条）和ETag/Last-Modified条件请求
+# 带时间戳的录音文件名不会对应其他内容（见Chapter.new_audio_filename），浏览器可以长期缓存，不再重复下载；
+# 其他文件（识别结果等）每次使用前按ETag验证
+# 部署在Apache/lighttpd之后时可以开启USE_X_SENDFILE，由前端服务器直接发送文件
+AUDIO_FILENAME_PATTERN = re.compile(r'^[0-9a-f-]{36}_\d{8}_\d{6}(_\d+)?\.wav$')
+app.config.setdefault('AUDIO_CACHE_MAX_AGE', 365 * 24 * 3600)
+
 @app.route('/api/audio/<book_id>/<chapter_id>/<filename>')
 def get_audio(book_id, chapter_id, filename):
     audio_dir = os.path.join(app.config['BOOKS_FOLDER'], book_id, 'chapters', chapter_id, 'audio')
-    return send_from_directory(audio_dir, filename)
+    immutable = bool(AUDIO_FILENAME_PATTERN.match(filename))
+    max_age = app.config['AUDIO_CACHE_MAX_AGE'] if immutable else 0
+    pack = audio_packs.get(audio_dir)
+    entry = pack.entry(filename) if not os.path.exists(os.path.join(audio_dir, filename)) else None
+    if entry is not None:
+        # 直接发送章节音频包中对应的区间，不复制到内存；ETag由包文件名和位置组成
+        from werkzeug.exceptions import RequestedRangeNotSatisfiable
+        clip = pack.open(filename)
+        if clip is None:
+            return jsonify({'success': False, 'message': '录音不存在'}), 404
+        response = send_file(
+            clip, mimetype='audio/wav' if filename.endswith('.wav') else None,
+            download_name=filename, conditional=False, etag='-'.join(str(part) for part in entry),
+            last_modified=os.path.getmtime(os.path.join(audio_dir, audio_pack.INDEX_FILENAME)),
+            max_age=max_age
+        )
+        # send_file不知道文件对象的长度，在这里设置后再处理Range和条件请求
+        response.content_length = clip.length
+        try:
+            response = response.make_conditional(request.environ, accept_ranges=True, complete_length=clip.length)
+        except RequestedRangeNotSatisfiable:
+            clip.close()
+            raise
+    else:
+        response = send_from_directory(audio_dir, filename, conditional=True, etag=True, max_age=max_age)
+    if immutable:
+        response.headers['Cache-Control'] = f"private, max-age={app.config['AUDIO_CACHE_MAX_AGE']}, immutable"
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/chapter/<book_id>/<chapter_id>/audio/delete/<paragraph_id>', methods=['POST'])
 def delete_audio(book_id, chapter_id, paragraph_id):
     try:
-        chapter = Chapter.load(chapter_id, book_id)
-        if not chapter:
-            return jsonify({'success': False, 'message': '章节不存在'})
-        
-        # 删除段落的音频文件
-        for i, paragraph in enumerate(chapter.paragraphs):
-            if paragraph['id'] == paragraph_id:
-                # 删除关联的音频文件和所有识别结果文件
-                if paragraph['audio']:
-                    # 获取音频文件的基本名称（不含扩展名）
-                    audio_filename = paragraph['audio']
-                    base_name = os.path.splitext(audio_filename)[0]
-                    
-                    # 定义所有可能的文件扩展名
-                    extensions = ['.wav', '.merge.txt', '.txt', '.srt', '.json']
-                    
-                    # 删除所有相关文件
-                    for ext in extensions:
-                        file_path = os.path.join(chapter.audio_dir, base_name + ext)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                # 更新段落信息
-                paragraph['audio'] = ''
-                chapter.save()
-                return jsonify({'success': True, 'paragraph': paragraph})
-        
-        return jsonify({'success': False, 'message': '段落不存在'})
+        # 在章节锁内完成“读取-修改-保存”，同一章节的并发修改不会互相覆盖
+        with chapter_lock(book_id, chapter_id):
+            chapter = chapter_store.get(book_id, chapter_id)
+            if not chapter:
+                return jsonify({'success': False, 'message': '章节不存在'})
+            
+            # 去掉段落的录音，音频文件和识别结果文件由后台清理
+            base_revision = chapter.revision
+            paragraph = chapter.remove_audio(paragraph_id)
+            if paragraph:
+                chapter_store.commit(chapter)
+                return chapter_delta(chapter, base_revision, [upsert_change(chapter, paragraph)], paragraph=paragraph)
+            
+            return jsonify({'success': False, 'message': '段落不存在'})
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'删除录音失败: {str(e)}'})
 
+# 全文搜索API
+@app.route('/api/search', methods=['GET'])
+def search_paragraphs():
+    try:
+        query = request.args.get('q', '').strip()
+        book_id = request.args.get('book_id') or None
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        
+        # 索引在服务器启动时由单独的线程建立，建立完成前只能搜到之后修改过的段落，
+        # 此时立即返回已有的结果和indexing，不在请求线程中等待
+        indexing = start_search_build()
+        
+        start_time = datetime.datetime.now()
+        total, results = search_index.search(query, book_id, limit=limit, offset=offset)
+        
+        # 补充书名和章节标题，同一本书只读取一次
+        books = {}
+        for result in results:
+            if result['book_id'] not in books:
+                books[result['book_id']] = Book.load(result['book_id'])
+            book = books[result['book_id']]
+            result['book_title'] = book.title if book else ''
+            result['chapter_title'] = next(
+                (c['title'] for c in book.chapters if c['id'] == result['chapter_id']), '') if book else ''
+        return jsonify({
+            'success': True,
+            'query': query,
+            'total': total,
+            'more': total >= search.MAX_COUNT,
+            'results': results,
+            # indexing为True时结果还不完整，索引建立完成后需要重新搜索
+            'indexing': indexing,
+            'message': '正在建立搜索索引，结果可能不完整' if indexing else '',
+            'took_ms': round((datetime.datetime.now() - start_time).total_seconds() * 1000, 1)
+        })
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'搜索失败: {str(e)}'})
+
+@app.route('/api/search/rebuild', methods=['POST'])
+def rebuild_search():
+    # 重建整个书库或一本书的索引，作为批量任务执行，结果通过/api/jobs查询
+    try:
+        data = request.json or {}
+        try:
+            job = submit_search_rebuild(data.get('book_id') or None)
+        except queue.Full as e:
+            return jsonify({'success': False, 'message': str(e)})
+        return jsonify({'success': True, 'job_id': job.id})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'重建搜索索引失败: {str(e)}'})
+
+# 录音清理API
+@app.route('/api/audio-gc/report', methods=['GET'])
+def audio_gc_report():
+    # 列出可以删除的录音文件，不删除
+    try:
+        report = audio_sweeper.report(request.args.get('book_id') or None)
+        return jsonify({'success': True, 'report': report})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'生成清理报告失败: {str(e)}'})
+
+@app.route('/api/audio-gc/sweep', methods=['POST'])
+def audio_gc_sweep():
+    # 立即清理整个书库或一本书，作为后台任务执行，结果通过/api/jobs查询
+    # AUDIO_GC_DRY_RUN为True时只生成报告，apply为True时确认过报告，实际删除
+    try:
+        data = request.json or {}
+        dry_run = audio_sweeper.dry_run and not data.get('apply')
+        try:
+            job = background_jobs.submit(lambda job, book_id: audio_sweeper.sweep(book_id, dry_run=dry_run),
+                                         data.get('book_id') or None, priority=jobs.BATCH)
+        except queue.Full as e:
+            return jsonify({'success': False, 'message': str(e)})
+        return jsonify({'success': True, 'job_id': job.id, 'dry_run': dry_run})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'清理录音失败: {str(e)}'})
+
+# 运行状态API
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    # 章节缓存命中情况、书架目录和锁等待时间，用于观察缓存效果和锁竞争
+    return jsonify({
+        'success': True,
+        'chapter_cache': chapter_store.stats(),
+        'catalog': catalog.stats(),
+        'asr': asr_pool.stats(),
+        'jobs': job_queue.stats(),
+        'background_jobs': background_jobs.stats(),
+        'events': event_bus.stats(),
+        'dictation': dictation_sessions.stats(),
+        'audio_ingest': audio_ingestor.stats(),
+        'audio_pack': audio_packer.stats(),
+        'audio_gc': audio_sweeper.stats(),
+        'search': search_index.stats(),
+        'locks': keyed_locks.stats(),
+        'requests': request_metrics.stats(),
+        'dictation_trace': dictation_traces.stats(),
+        'startup': app.config.get('STARTUP')
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus文本格式：各接口的耗时直方图和请求数，以及/api/stats中的数值统计
+    gauges, counters = metrics.flatten_stats({
+        'chapter_cache': chapter_store.stats(),
+        'jobs': job_queue.stats(),
+        'background_jobs': background_jobs.stats(),
+        'events': event_bus.stats(),
+        'audio_ingest': audio_ingestor.stats(),
+        'locks': keyed_locks.stats()
+    })
+    return Response(request_metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
+
 # 语音识别API
 @app.route('/api/recognize-audio', methods=['POST'])
 def recognize_audio():
@@ -598,132 +1915,273 @@ def recognize_audio():
         data = request.json
         audio_path = data.get('audio_path')
         start_time = data.get('start_time')
+        book_id = data.get('book_id')
+        chapter_id = data.get('chapter_id')
+        paragraph_id = data.get('paragraph_id')
+        
+        if book_id and chapter_id and paragraph_id:
+            # 直接指定段落时，未指定音频文件则识别段落当前的录音
+            if not audio_path:
+                chapter = chapter_store.get(book_id, chapter_id)
+                paragraph = chapter.get_paragraph(paragraph_id) if chapter else None
+                if not paragraph or not paragraph.get('audio'):
+                    return jsonify({'success': False, 'message': '段落没有录音'})
+                audio_path = os.path.join(chapter.audio_dir, paragraph['audio'])
+        elif audio_path:
+            # 从音频文件路径中提取book_id、chapter_id和paragraph_id
+            owner = audio_owner(audio_path)
+            if owner is None:
+                return jsonify({'success': False, 'message': '音频文件不在书籍目录中'})
+            book_id, chapter_id, paragraph_id = owner
         
-        if not audio_path or not os.path.exists(audio_path):
+        if not audio_path or not stored_audio_exists(audio_path):
             return jsonify({'success': False, 'message': '音频文件不存在'})
         
-        # 从音频文件路径中提取book_id、chapter_id和paragraph_id
-        # 音频文件路径格式：books/{book_id}/chapters/{chapter_id}/audio/{paragraph_id}_{timestamp}.wav
-        parts = audio_path.split(os.sep)
-        # 查找books目录的索引
-        books_index = parts.index('books')
-        book_id = parts[books_index + 1]
-        chapter_id = parts[books_index + 3]
-        # 从文件名中提取paragraph_id
-        audio_filename = parts[-1]
-        paragraph_id = audio_filename.split('_')[0]
-        
-        # 调用start_client.exe进行语音识别
-        start_client_path = os.path.join('CW', 'start_client.exe')
-        cmd = [
-            start_client_path,
-            audio_path
-        ]
-        
-        # 启动start_client.exe进程，并实时读取输出
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            cwd=os.path.dirname(os.path.abspath(__file__)),
-            universal_newlines=True
-        )
+        # 作为任务提交给识别队列，不占用请求线程；结果通过/api/events推送
+        priority = jobs.BATCH if data.get('priority') == 'batch' else jobs.INTERACTIVE
+        trace = None
+        if priority == jobs.INTERACTIVE:
+            trace = dictation_trace.Trace(book_id, chapter_id, paragraph_id, 'recognize')
+            trace.mark('audio_saved')
+            stop_time = dictation_trace.client_time(data.get('stop_time'))
+            if stop_time is not None:
+                trace.mark('record_stop', stop_time)
+        try:
+            job = submit_recognition(book_id, chapter_id, paragraph_id, audio_path, start_time, priority, trace)
+        except queue.Full as e:
+            return jsonify({'success': False, 'message': str(e)})
         
-        # 实时读取输出，提取识别结果和音频长度
-        audio_duration = 0.0  # 音频长度（秒）
-        recognized_text = ''
-        in_recognition_result = False
-        recognition_done = False
+        if not data.get('wait'):
+            return jsonify({'success': True, 'job_id': job.id})
         
-        while True:
-            line = process.stdout.readline()
-            if not line:
-                break
-            
-            # 打印start_client.exe的输出，方便调试
-            print(line.strip())
-            
-            # 提取音频长度
-            if "音频长度：" in line:
-                try:
-                    # 格式："    音频长度：3.12s "
-                    duration_str = line.split("音频长度：")[1].strip()
-                    audio_duration = float(duration_str.replace("s", ""))
-                except (IndexError, ValueError):
-                    pass
-            
-            # 提取识别结果
-            if "识别结果：" in line:
-                in_recognition_result = True
-            elif in_recognition_result:
-                # 跳过空行
-                if line.strip():
-                    recognized_text = line.strip()
-                    in_recognition_result = False
-                    recognition_done = True
-                    # 一旦获取到识别结果，就可以跳出循环，不需要等待结束标志
-                    break
-            
-            # 检查是否识别结束（冗余检查，防止异常情况）
-            if "RECOGNITION_COMPLETE" in line:
-                recognition_done = True
-                break
+        # 兼容需要同步结果的调用方：等待任务完成后返回识别结果
+        with request_metrics.phase('subprocess'):
+            finished = job.wait(app.config['ASR_TIMEOUT'])
+        if not finished:
+            return jsonify({'success': False, 'job_id': job.id, 'message': '语音识别超时'})
+        if job.status == 'failed':
+            return jsonify({'success': False, 'job_id': job.id, 'message': f'语音识别失败: {job.error}'})
+        if not job.result['text']:
+            return jsonify({'success': False, 'job_id': job.id, 'message': '识别失败：未获取到识别结果'})
+        return jsonify(dict(job.result['event'], job_id=job.id))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'语音识别失败: {str(e)}'})
+
+# 批量重新识别：对章节、整本书或整个书库中有录音的段落重新识别，进度通过查询接口获取
+@app.route('/api/recognition-runs', methods=['POST'])
+def create_recognition_run():
+    try:
+        data = request.json or {}
+        tag = (data.get('tag') or '').strip()
+        book_id = data.get('book_id')
+        chapter_id = data.get('chapter_id')
+        if not tag:
+            return jsonify({'success': False, 'message': '请指定识别结果的标签'})
+        if chapter_id and not book_id:
+            return jsonify({'success': False, 'message': '指定章节时需要同时指定书籍'})
+        if book_id and not Book.load(book_id):
+            return jsonify({'success': False, 'message': '书籍不存在'})
         
-        # 杀死start_client.exe进程
-        process.terminate()
-        try:
-            process.wait(timeout=5)  # 等待进程终止，最多5秒
-        except subprocess.TimeoutExpired:
-            process.kill()
-        
-        # 直接更新content.json文件中的对应段落内容
-        if recognition_done and recognized_text:
-            chapter = Chapter.load(chapter_id, book_id)
-            if chapter:
-                # 计算转录延迟
-                transcribe_delay = None
-                if start_time:
-                    try:
-                        # 计算从开始录音到转录完成的总时间（秒）
-                        current_time = datetime.datetime.now().timestamp() * 1000  # 转换为毫秒
-                        total_delay_ms = current_time - float(start_time)
-                        total_delay = total_delay_ms / 1000  # 转换为秒
-                        
-                        # 减去音频长度，得到真正的转录处理时间
-                        transcribe_delay = max(0, round(total_delay - audio_duration, 2))  # 确保非负，保留两位小数
-                    except ValueError:
-                        pass
-                
-                # 更新对应段落的文本和转录延迟
-                for paragraph in chapter.paragraphs:
-                    if paragraph['id'] == paragraph_id:
-                        paragraph['text'] = recognized_text
-                        if transcribe_delay is not None:
-                            paragraph['transcribe_delay'] = transcribe_delay
-                        break
-                # 保存更新后的章节内容
-                chapter.save()
-            
-            return jsonify({
-                'success': True,
-                'text': recognized_text
+        targets = recognition_targets(book_id, chapter_id)
+        run = start_recognition_run(tag, targets, int(data.get('workers', 2)), bool(data.get('force')))
+        result = {'success': True, 'run': run.to_dict()}
+        if run.workers < run.requested_workers:
+            result['message'] = (f'任务队列只有 {run.workers} 个工作线程处理批量任务，同时识别数由 '
+                                 f'{run.requested_workers} 降为 {run.workers}（可调整ASR_POOL_SIZE，'
+                                 f'或停止服务器后使用rerecognize.py）')
+        return jsonify(result)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'启动批量识别失败: {str(e)}'})
+
+@app.route('/api/recognition-runs', methods=['GET'])
+def list_recognition_runs():
+    with recognition_runs_lock:
+        runs = list(recognition_runs.values())
+    return jsonify({'success': True, 'runs': [run.to_dict() for run in runs]})
+
+@app.route('/api/recognition-runs/<run_id>', methods=['GET'])
+def get_recognition_run(run_id):
+    run = recognition_runs.get(run_id)
+    if not run:
+        return jsonify({'success': False, 'message': '批量识别不存在'})
+    return jsonify({'success': True, 'run': run.to_dict()})
+
+@app.route('/api/recognition-runs/<run_id>/cancel', methods=['POST'])
+def cancel_recognition_run(run_id):
+    run = recognition_runs.get(run_id)
+    if not run:
+        return jsonify({'success': False, 'message': '批量识别不存在'})
+    # 已提交的识别会继续完成，之后可以用同一标签继续
+    run.cancel()
+    return jsonify({'success': True, 'run': run.to_dict()})
+
+@app.route('/api/recognition-report', methods=['GET'])
+def recognition_report():
+    # 汇总已保存的识别结果，比较不同标签（模型）的字错误率
+    try:
+        tags = request.args.getlist('tag')
+        if not tags:
+            return jsonify({'success': False, 'message': '请指定识别结果的标签'})
+        targets = recognition_targets(request.args.get('book_id'), request.args.get('chapter_id'))
+        return jsonify({'success': True, 'reports': [rerecognize.summarize(tag, targets) for tag in tags]})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'获取识别报告失败: {str(e)}'})
+
+# 边录边识别：录音过程中分块上传16kHz单声道int16 PCM，服务端同时写入WAV并送入识别流
+# 中间结果和最终结果通过/api/events推送
+@app.route('/api/chapter/<book_id>/<chapter_id>/dictation/start', methods=['POST'])
+def start_dictation(book_id, chapter_id):
+    try:
+        paragraph_id = request.json.get('id')
+        start_time = request.json.get('start_time')
+        chapter = chapter_store.get(book_id, chapter_id)
+        if not chapter:
+            return jsonify({'success': False, 'message': '章节不存在'})
+        if not paragraph_id or not chapter.get_paragraph(paragraph_id):
+            return jsonify({'success': False, 'message': '段落不存在'})
+        
+        filename = chapter.new_audio_filename(paragraph_id)
+        session = dictation.DictationSession(
+            book_id, chapter_id, paragraph_id, os.path.join(chapter.audio_dir, filename), start_time)
+        session.trace = dictation_trace.Trace(book_id, chapter_id, paragraph_id, 'stream')
+        
+        def on_partial(text):
+            session.trace.mark('first_output')
+            event_bus.publish((book_id, chapter_id), {
+                'type': 'partial', 'session_id': session.id, 'paragraph_id': paragraph_id, 'text': text
             })
+        
+        message = None
+        try:
+            session.stream = asr_pool.open_stream(on_partial, wait=app.config['ASR_STREAM_WAIT'])
+            if session.stream is not None:
+                session.trace.mark('recognizer_start')
+            elif asr_pool.streaming is False:
+                message = '识别服务不支持边录边识别，录音结束后识别'
+            else:
+                message = '边录边识别的连接已全部占用，录音结束后识别'
+        except Exception:
+            # 识别客户端不可用时仍然录音，结束后作为普通识别任务处理
+            import traceback
+            traceback.print_exc()
+            message = '连接识别服务失败，录音结束后识别'
+        dictation_sessions.add(session)
+        return jsonify({'success': True, 'session_id': session.id, 'streaming': session.stream is not None,
+                        'message': message})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'开始录音失败: {str(e)}'})
+
+@app.route('/api/dictation/<session_id>/chunk', methods=['POST'])
+def dictation_chunk(session_id):
+    session = dictation_sessions.get(session_id)
+    if not session:
+        return jsonify({'success': False, 'message': '录音会话不存在'})
+    try:
+        seq = int(request.args.get('seq', session.next_seq))
+        session.append(seq, request.get_data())
+        return jsonify({'success': True, 'next_seq': session.next_seq})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e), 'next_seq': session.next_seq})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        dictation.abort(dictation_sessions.pop(session_id) or session)
+        return jsonify({'success': False, 'message': f'上传音频失败: {str(e)}'})
+
+@app.route('/api/dictation/<session_id>/finish', methods=['POST'])
+def finish_dictation(session_id):
+    session = dictation_sessions.pop(session_id)
+    if not session:
+        return jsonify({'success': False, 'message': '录音会话不存在'})
+    # 结束请求在最后一块音频上传完成后发出；stop_time为浏览器停止录音的时间
+    session.trace.mark('upload_received')
+    stop_time = dictation_trace.client_time((request.get_json(silent=True) or {}).get('stop_time'))
+    if stop_time is not None:
+        session.trace.mark('record_stop', stop_time)
+    session.close()
+    session.trace.mark('audio_saved')
+    try:
+        job = job_queue.submit(run_dictation_finish, session, priority=jobs.INTERACTIVE)
+    except queue.Full as e:
+        dictation.abort(session)
+        return jsonify({'success': False, 'message': str(e)})
+    return jsonify({'success': True, 'job_id': job.id, 'duration': session.duration})
+
+@app.route('/api/dictation/<session_id>/cancel', methods=['POST'])
+def cancel_dictation(session_id):
+    session = dictation_sessions.pop(session_id)
+    if session:
+        dictation.abort(session)
+        if os.path.exists(session.audio_path):
+            os.remove(session.audio_path)
+    return jsonify({'success': True})
+
+def run_dictation_finish(job, session):
+    # 录音结束：取得最终识别结果，把WAV文件和识别文本写入段落
+    try:
+        if session.stream is not None:
+            result = session.stream.finish(session.audio_path)
         else:
-            error_msg = f"识别失败：未获取到识别结果"
-            print(error_msg)
-            return jsonify({
-                'success': False,
-                'message': error_msg
-            })
+            result = asr_pool.recognize(session.audio_path, trace=session.trace)
+    except Exception as e:
+        # 识别失败时仍然保存录音
+        result = {'text': '', 'duration': session.duration}
+        publish_recognition(job.id, session.book_id, session.chapter_id, session.paragraph_id, result,
+                            session.start_time, os.path.basename(session.audio_path), session.audio_meta(),
+                            session.trace)
+        raise
+    event = publish_recognition(job.id, session.book_id, session.chapter_id, session.paragraph_id, result,
+                                session.start_time, os.path.basename(session.audio_path), session.audio_meta(),
+                                session.trace)
+    return {'text': result['text'], 'duration': result['duration'], 'event': event}
+
+# 录音识别各阶段耗时的p50/p90/p99，按阶段、书籍和日期分组
+@app.route('/api/dictation/latency', methods=['GET'])
+def dictation_latency():
+    try:
+        days = request.args.get('days', type=int)
+        report = dictation_traces.report(request.args.get('book_id'), days, request.args.get('mode'))
+        titles = {}
+        for book_id in report['books']:
+            book = Book.load(book_id)
+            titles[book_id] = book.title if book else None
+        return jsonify(dict(report, success=True, titles=titles))
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({'success': False, 'message': f'语音识别失败: {str(e)}'})
+        return jsonify({'success': False, 'message': f'统计识别耗时失败: {str(e)}'})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id) or background_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '任务不存在'})
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/api/events/<book_id>/<chapter_id>')
+def chapter_events(book_id, chapter_id):
+    # 编辑器订阅本章节的事件（识别结果等），使用Server-Sent Events推送
+    return Response(
+        stream_with_context(event_bus.stream((book_id, chapter_id))),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 if __name__ == '__main__':
     import argparse
+    import multiprocessing
+    import server
+    
+    # 录音入库使用进程池，打包为exe后子进程也从本程序启动，需要先交给multiprocessing处理
+    multiprocessing.freeze_support()
     
     # 解析命令行参数
     parser = argparse.ArgumentParser(description='DBInputNote App Server')
@@ -731,8 +2189,15 @@ if __name__ == '__main__':
     parser.add_argument('--ssl', action='store_true', help='是否使用SSL')
     parser.add_argument('--cert', type=str, default='localhost.crt', help='SSL证书文件路径')
     parser.add_argument('--key', type=str, default='localhost.key', help='SSL密钥文件路径')
+    parser.add_argument('--server', choices=server.MODES, default='production', help='production为cheroot多线程服务器，dev为Flask开发服务器')
+    parser.add_argument('--threads', type=int, default=32, help='生产模式的请求线程数')
+    parser.add_argument('--timeout', type=float, default=30.0, help='生产模式下空闲连接的超时时间（秒）')
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help='关闭时等待进行中请求完成的最长时间（秒）')
     
     args = parser.parse_args()
+    start_background_workers(args.port)
+    server_options = dict(mode=args.server, threads=args.threads, timeout=args.timeout,
+                          drain_timeout=args.drain_timeout, on_stop=event_bus.close)
     
     if args.ssl:
         # 使用HTTPS模式运行
@@ -741,18 +2206,15 @@ if __name__ == '__main__':
         print(f"使用证书：{args.cert} 和 {args.key}")
         
         try:
-            import ssl
-            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            ssl_context.load_cert_chain(args.cert, args.key)
-            app.run(debug=False, host='0.0.0.0', port=args.port, ssl_context=ssl_context)
+            server.run(app, '0.0.0.0', args.port, args.cert, args.key, **server_options)
         except Exception as e:
             print(f"HTTPS启动失败：{str(e)}")
             print("正在尝试回退到HTTP模式...")
             # 回退到HTTP模式
             print(f"HTTP访问地址：http://0.0.0.0:{args.port}")
-            app.run(debug=False, host='0.0.0.0', port=args.port)
+            server.run(app, '0.0.0.0', args.port, **server_options)
     else:
         # 直接运行时使用HTTP
         print(f"\napp.py 独立运行模式")
         print(f"HTTP访问地址：http://0.0.0.0:{args.port}")
-        app.run(debug=False, host='0.0.0.0', port=args.port)
+        server.run(app, '0.0.0.0', args.port, **server_options)
@@ -0,0 +1,642 @@
+import base64
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+import traceback
+import uuid
+import wave
+from array import array
+
+# 语音识别客户端池
+# 原先每次识别都启动一次CW/start_client.exe，再从它的输出中解析结果，
+# 每条录音都要付出进程启动和连接服务端的开销。这里由app.py常驻一组识别客户端，
+# 请求到来时取一个空闲客户端识别，单条录音的延迟只剩下服务端的解码时间。
+#
+# 识别后端需要提供：
+#   recognize(audio_path, trace=None) -> {'text': 识别结果, 'duration': 音频长度（秒）}
+#                         trace不为None时，收到第一个输出时调用trace.mark('first_output')，见dictation_trace.py
+#   healthy()             连接是否可用，不可用的客户端会被关闭并重新创建
+#   close()
+# 支持边录边识别的后端还可以提供：
+#   open_stream(on_partial) -> 流对象，feed(16kHz单声道int16 PCM)逐块送入音频，
+#                              finish(audio_path)返回最终结果，abort()放弃识别
+# 不支持的后端只录音，录音结束后作为普通识别任务处理。
+#
+# 可用的后端：
+#   cw      通过websocket连接CW服务端（CapsWriter-Offline协议），需要安装websocket-client；
+#           连接失败时暂时改用cw-exe，之后定期重新连接
+#   cw-exe  每次识别启动CW/start_client.exe（原有方式），没有websocket-client时使用
+#   fake    不做识别，用于测试（支持边录边识别，中间结果为已收到的秒数）
+
+SAMPLE_RATE = 16000
+
+# CapsWriter文件识别的分段参数（秒），与CW客户端识别文件时使用的值一致
+SEG_DURATION = 60
+SEG_OVERLAP = 4
+# 边录边识别（麦克风）时的分段参数，与CW客户端录音时使用的值一致
+MIC_SEG_DURATION = 15
+MIC_SEG_OVERLAP = 2
+
+
+def pcm16_to_f32(data):
+    samples = array('h')
+    samples.frombytes(data)
+    return array('f', [s / 32768.0 for s in samples]).tobytes()
+
+
+def read_wav_f32(audio_path):
+    # 读取PCM WAV文件，转换为16kHz单声道float32，返回 (数据, 时长)
+    # 不是PCM WAV时返回None
+    try:
+        with wave.open(audio_path, 'rb') as f:
+            channels = f.getnchannels()
+            width = f.getsampwidth()
+            rate = f.getframerate()
+            frames = f.readframes(f.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width not in (1, 2, 4):
+        return None
+    if channels == 1 and width == 2 and rate == SAMPLE_RATE:
+        # 上传时已转换为16kHz单声道16位PCM的录音，不需要混音和重采样
+        return pcm16_to_f32(frames), len(frames) / 2 / SAMPLE_RATE
+
+    samples = array({1: 'B', 2: 'h', 4: 'i'}[width])
+    samples.frombytes(frames)
+    if width == 1:
+        samples = [s - 128 for s in samples]
+    scale = float(1 << (width * 8 - 1))
+
+    # 多声道取平均
+    if channels > 1:
+        samples = [sum(frame) / channels for frame in zip(*(samples[c::channels] for c in range(channels)))]
+
+    # 重采样到16kHz：整数倍降采样直接抽取，其余情况线性插值
+    if rate != SAMPLE_RATE and rate % SAMPLE_RATE == 0:
+        samples = samples[::rate // SAMPLE_RATE]
+    elif rate != SAMPLE_RATE and samples:
+        count = int(len(samples) * SAMPLE_RATE / rate)
+        ratio = rate / SAMPLE_RATE
+        last = len(samples) - 1
+        resampled = []
+        for i in range(count):
+            pos = i * ratio
+            j = int(pos)
+            k = min(j + 1, last)
+            resampled.append(samples[j] + (samples[k] - samples[j]) * (pos - j))
+        samples = resampled
+
+    data = array('f', [s / scale for s in samples])
+    return data.tobytes(), len(data) / SAMPLE_RATE
+
+
+def find_ffmpeg(base_dir):
+    for path in (os.path.join(base_dir, 'CW', 'ffmpeg.exe'), os.path.join(base_dir, 'CW', 'ffmpeg')):
+        if os.path.exists(path):
+            return path
+    return shutil.which('ffmpeg')
+
+
+def decode_f32(audio_path, base_dir):
+    # 把音频解码为16kHz单声道float32；浏览器录制的音频通常是webm/ogg，需要ffmpeg解码
+    result = read_wav_f32(audio_path)
+    if result is not None:
+        return result
+    ffmpeg = find_ffmpeg(base_dir)
+    if not ffmpeg:
+        raise RuntimeError('音频不是PCM WAV格式，且未找到ffmpeg，无法解码')
+    process = subprocess.run(
+        [ffmpeg, '-v', 'error', '-i', audio_path, '-f', 'f32le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg解码失败：{process.stderr.decode("utf-8", "ignore").strip()}')
+    return process.stdout, len(process.stdout) / 4 / SAMPLE_RATE
+
+
+class CapsWriterBackend:
+    # 与CW服务端保持一个websocket长连接
+    def __init__(self, server, base_dir, timeout=60):
+        import websocket
+
+        self.server = server
+        self.base_dir = base_dir
+        self.timeout = timeout
+        self._ws = websocket.create_connection(server, timeout=timeout)
+
+    def recognize(self, audio_path, trace=None):
+        data, duration = decode_f32(audio_path, self.base_dir)
+        task_id = str(uuid.uuid4())
+        time_start = time.time()
+
+        # 按SEG_DURATION秒分块发送，最后发送一条is_final消息
+        chunk_size = SEG_DURATION * SAMPLE_RATE * 4
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        for i, chunk in enumerate(chunks + [b'']):
+            self._ws.send(json.dumps({
+                'task_id': task_id,
+                'seg_duration': SEG_DURATION,
+                'seg_overlap': SEG_OVERLAP,
+                'is_final': i == len(chunks),
+                'time_start': time_start,
+                'time_frame': time.time(),
+                'source': 'file',
+                'data': base64.b64encode(chunk).decode('utf-8')
+            }))
+
+        while True:
+            message = self._ws.recv()
+            if not message:
+                raise ConnectionError('CW服务端已断开连接')
+            message = json.loads(message)
+            if message.get('task_id') != task_id:
+                continue
+            if trace is not None:
+                trace.mark('first_output')
+            if message.get('is_final'):
+                return {'text': message.get('text', '').strip(), 'duration': duration}
+
+    def open_stream(self, on_partial=None):
+        return CapsWriterStream(self._ws, on_partial, self.timeout)
+
+    def healthy(self):
+        if not self._ws.connected:
+            return False
+        try:
+            self._ws.ping()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self._ws.close()
+        except Exception:
+            pass
+
+
+class CapsWriterStream:
+    # 边录边识别：音频块一到就以麦克风模式发给CW服务端，服务端按分段解码，
+    # 结束时只需要解码最后一段，停止录音后很快就能得到最终结果
+    def __init__(self, ws, on_partial, timeout):
+        self._ws = ws
+        self.on_partial = on_partial
+        self.timeout = timeout
+        self.task_id = str(uuid.uuid4())
+        self.time_start = time.time()
+        self.samples = 0
+        self._result = None
+        self._error = None
+        self._done = threading.Event()
+        self._reader = threading.Thread(target=self._read, name='asr-stream', daemon=True)
+        self._reader.start()
+
+    def _send(self, data, is_final):
+        self._ws.send(json.dumps({
+            'task_id': self.task_id,
+            'seg_duration': MIC_SEG_DURATION,
+            'seg_overlap': MIC_SEG_OVERLAP,
+            'is_final': is_final,
+            'time_start': self.time_start,
+            'time_frame': time.time(),
+            'source': 'mic',
+            'data': base64.b64encode(data).decode('utf-8')
+        }))
+
+    def _read(self):
+        # 在单独的线程中接收服务端消息，非最终结果作为中间结果回调
+        import websocket
+
+        try:
+            while not self._done.is_set():
+                try:
+                    message = self._ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if not message:
+                    raise ConnectionError('CW服务端已断开连接')
+                message = json.loads(message)
+                if message.get('task_id') != self.task_id:
+                    continue
+                if message.get('is_final'):
+                    self._result = message.get('text', '').strip()
+                    break
+                if self.on_partial and message.get('text'):
+                    self.on_partial(message['text'].strip())
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done.set()
+
+    def feed(self, data):
+        self.samples += len(data) // 2
+        self._send(pcm16_to_f32(data), False)
+
+    def finish(self, audio_path=None):
+        self._send(b'', True)
+        if not self._done.wait(self.timeout):
+            raise TimeoutError('等待识别结果超时')
+        if self._error is not None:
+            raise self._error
+        return {'text': self._result, 'duration': self.samples / SAMPLE_RATE}
+
+    def abort(self):
+        self._done.set()
+
+
+class CwExeBackend:
+    # 每次识别启动一次CW/start_client.exe，从输出中解析识别结果和音频长度
+    # fallback为True时是连接CW服务端失败后的替代：healthy()返回False，
+    # 客户端池的健康检查会关闭它并重新尝试连接CW服务端，恢复常驻连接
+    def __init__(self, base_dir, timeout=60, fallback=False):
+        self.base_dir = base_dir
+        self.timeout = timeout
+        self.fallback = fallback
+
+    def recognize(self, audio_path, trace=None):
+        process = subprocess.Popen(
+            [os.path.join('CW', 'start_client.exe'), audio_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            cwd=self.base_dir,
+            universal_newlines=True
+        )
+
+        # 输出由后台线程读取，超过timeout秒仍未得到结果时结束进程；
+        # 不依赖管道关闭，start_client.exe启动的子进程仍占用输出管道时也不会一直等待
+        lines = queue.Queue()
+
+        def read_output():
+            for line in process.stdout:
+                lines.put(line)
+            lines.put(None)
+
+        threading.Thread(target=read_output, name='cw-exe-output', daemon=True).start()
+        deadline = time.monotonic() + self.timeout
+
+        duration = 0.0
+        text = ''
+        in_recognition_result = False
+        try:
+            while True:
+                try:
+                    line = lines.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    raise TimeoutError(f'start_client.exe超过{self.timeout}秒未返回识别结果')
+                if line is None:
+                    break
+                # 进程启动后的第一行输出
+                if trace is not None:
+                    trace.mark('first_output')
+                # 打印start_client.exe的输出，方便调试
+                print(line.strip())
+
+                # 格式："    音频长度：3.12s "
+                if '音频长度：' in line:
+                    try:
+                        duration = float(line.split('音频长度：')[1].strip().replace('s', ''))
+                    except (IndexError, ValueError):
+                        pass
+
+                if '识别结果：' in line:
+                    in_recognition_result = True
+                elif in_recognition_result and line.strip():
+                    text = line.strip()
+                    break
+
+                if 'RECOGNITION_COMPLETE' in line:
+                    break
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        return {'text': text, 'duration': duration}
+
+    def healthy(self):
+        if self.fallback:
+            return False
+        return os.path.exists(os.path.join(self.base_dir, 'CW', 'start_client.exe'))
+
+    def close(self):
+        pass
+
+
+class FakeBackend:
+    # 测试用：音频旁边有同名.txt时返回其内容，否则返回文件名
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def recognize(self, audio_path, trace=None):
+        if self.delay:
+            time.sleep(self.delay)
+        if trace is not None:
+            trace.mark('first_output')
+        text_file = os.path.splitext(audio_path)[0] + '.txt'
+        if os.path.exists(text_file):
+            with open(text_file, 'r', encoding='utf-8') as f:
+                text = f.read().strip()
+        else:
+            text = os.path.basename(audio_path)
+        result = read_wav_f32(audio_path)
+        return {'text': text, 'duration': result[1] if result else 0.0}
+
+    def open_stream(self, on_partial=None):
+        return FakeStream(self, on_partial)
+
+    def healthy(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class FakeStream:
+    # 测试用：每收到一块音频回调一次已收到的秒数，结束时按完整的WAV文件识别
+    def __init__(self, backend, on_partial):
+        self.backend = backend
+        self.on_partial = on_partial
+        self.samples = 0
+
+    def feed(self, data):
+        self.samples += len(data) // 2
+        if self.on_partial:
+            self.on_partial(f'{self.samples / SAMPLE_RATE:.2f}')
+
+    def finish(self, audio_path=None):
+        return self.backend.recognize(audio_path)
+
+    def abort(self):
+        pass
+
+
+# 最近一次连接CW服务端是否失败
+_cw_unreachable = threading.Event()
+
+
+def create_backend(name, server='ws://127.0.0.1:6016', base_dir='.', timeout=60):
+    if name == 'cw':
+        # websocket连接失败时（未安装websocket-client、CW服务端未启动或协议不兼容）
+        # 改用start_client.exe识别，不让这次识别失败；客户端池的健康检查（ASR_HEALTH_INTERVAL）
+        # 会关闭替代的客户端并重新尝试连接
+        try:
+            backend = CapsWriterBackend(server, base_dir, timeout)
+        except ImportError:
+            print('未安装websocket-client，改为每次识别启动CW/start_client.exe')
+            return CwExeBackend(base_dir, timeout)
+        except Exception as e:
+            # 暂时改用start_client.exe，健康检查时再次尝试连接；连续失败只输出一次
+            if not _cw_unreachable.is_set():
+                print(f'连接CW服务端{server}失败：{str(e)}，暂时改为每次识别启动CW/start_client.exe')
+                _cw_unreachable.set()
+            return CwExeBackend(base_dir, timeout, fallback=True)
+        if _cw_unreachable.is_set():
+            print(f'已重新连接CW服务端{server}')
+            _cw_unreachable.clear()
+        return backend
+    if name == 'cw-exe':
+        return CwExeBackend(base_dir, timeout)
+    if name == 'fake':
+        return FakeBackend()
+    raise ValueError(f'未知的语音识别后端：{name}')
+
+
+class RecognizerPool:
+    # 常驻的识别客户端池
+    # 客户端在第一次使用时创建（CW服务端可能晚于app启动）；识别出错且客户端已不可用时关闭并重建，
+    # 后台线程定期检查空闲客户端的连接状态
+    # 边录边识别在整个录音期间占用一个连接，使用单独的max_streams个常驻连接，
+    # 不占用识别任务的客户端
+    def __init__(self, factory, size=2, health_interval=30.0, timeout=60.0, max_streams=2):
+        self.factory = factory
+        self.size = size
+        self.max_streams = max_streams
+        self.health_interval = health_interval
+        self.timeout = timeout
+        # 空闲客户端；None表示该位置的客户端尚未创建或已被关闭
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+        # 边录边识别的空闲连接
+        self._stream_idle = queue.Queue()
+        for _ in range(max_streams):
+            self._stream_idle.put(None)
+        self._lock = threading.Lock()
+        self._health_thread = None
+        self._closed = False
+
+        # 统计信息
+        self.requests = 0
+        self.failures = 0
+        self.restarts = 0
+        self.busy = 0
+        self.streams = 0
+        self.streams_declined = 0
+        # 最近一次创建的客户端是否支持边录边识别；None表示还没有创建过
+        self.streaming = None
+        self.decode_total = 0.0
+        self.wait_total = 0.0
+
+    def recognize(self, audio_path, trace=None):
+        self._ensure_health_thread()
+        start = time.perf_counter()
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError('语音识别客户端全部繁忙，请稍后再试')
+        acquired = time.perf_counter()
+        if trace is not None:
+            trace.mark('recognizer_start')
+        with self._lock:
+            self.busy += 1
+            self.wait_total += acquired - start
+
+        try:
+            # 连接失效时重建客户端并重试一次
+            for attempt in range(2):
+                if worker is None:
+                    worker = self._create()
+                try:
+                    result = worker.recognize(audio_path, trace=trace)
+                    break
+                except Exception:
+                    if worker.healthy() or attempt == 1:
+                        raise
+                    traceback.print_exc()
+                    self._discard(worker)
+                    worker = None
+            with self._lock:
+                self.requests += 1
+                self.decode_total += time.perf_counter() - acquired
+            return result
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            if worker is not None and not worker.healthy():
+                self._discard(worker)
+                worker = None
+            raise
+        finally:
+            with self._lock:
+                self.busy -= 1
+            self._idle.put(worker)
+
+    def open_stream(self, on_partial=None, wait=0.0):
+        # 边录边识别期间独占一个连接，finish()或abort()后归还
+        # 最多等待wait秒取得空闲连接；连接已全部占用或后端不支持边录边识别（例如暂时改用了
+        # start_client.exe）时返回None，由调用方改为只录音，原因见streaming。
+        # 在请求线程中调用，不能像recognize那样长时间等待
+        self._ensure_health_thread()
+        try:
+            worker = self._stream_idle.get(timeout=wait) if wait > 0 else self._stream_idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.streams_declined += 1
+            return None
+        try:
+            if worker is None:
+                worker = self._create()
+            stream = worker.open_stream(on_partial) if hasattr(worker, 'open_stream') else None
+        except Exception:
+            if worker is not None and not worker.healthy():
+                self._discard(worker)
+                worker = None
+            self._stream_idle.put(worker)
+            raise
+        with self._lock:
+            self.streaming = stream is not None
+            if stream is None:
+                self.streams_declined += 1
+            else:
+                self.streams += 1
+        if stream is None:
+            # 替代的客户端不再保留，下次开始录音时重新尝试连接
+            if not worker.healthy():
+                self._discard(worker)
+                worker = None
+            self._stream_idle.put(worker)
+            return None
+        return PooledStream(self, worker, stream)
+
+    def _release(self, worker, discard=False):
+        if discard and worker is not None:
+            self._discard(worker)
+            worker = None
+        with self._lock:
+            self.streams -= 1
+        self._stream_idle.put(worker)
+
+    def _create(self):
+        worker = self.factory()
+        with self._lock:
+            self.streaming = hasattr(worker, 'open_stream')
+        return worker
+
+    def _discard(self, worker):
+        # 关闭已失效的客户端，下次使用时重新创建
+        worker.close()
+        with self._lock:
+            self.restarts += 1
+
+    def _ensure_health_thread(self):
+        with self._lock:
+            if self.health_interval and (self._health_thread is None or not self._health_thread.is_alive()):
+                self._health_thread = threading.Thread(target=self._health_loop, name='asr-health', daemon=True)
+                self._health_thread.start()
+
+    def _health_loop(self):
+        while not self._closed:
+            time.sleep(self.health_interval)
+            # 只检查当前空闲的客户端，正在使用的客户端由recognize和识别流处理
+            for idle in (self._idle, self._stream_idle):
+                checked = []
+                while True:
+                    try:
+                        worker = idle.get_nowait()
+                    except queue.Empty:
+                        break
+                    if worker is not None and not worker.healthy():
+                        self._discard(worker)
+                        worker = None
+                        try:
+                            worker = self._create()
+                        except Exception:
+                            # 服务端暂时不可用，下次使用时再创建
+                            traceback.print_exc()
+                    checked.append(worker)
+                for worker in checked:
+                    idle.put(worker)
+
+    def close(self):
+        self._closed = True
+        for idle in (self._idle, self._stream_idle):
+            while True:
+                try:
+                    worker = idle.get_nowait()
+                except queue.Empty:
+                    break
+                if worker is not None:
+                    worker.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'busy': self.busy,
+                'streams': self.streams,
+                'max_streams': self.max_streams,
+                'streams_declined': self.streams_declined,
+                'streaming': self.streaming,
+                'requests': self.requests,
+                'failures': self.failures,
+                'restarts': self.restarts,
+                'decode_avg': round(self.decode_total / self.requests, 3) if self.requests else 0.0,
+                'wait_avg': round(self.wait_total / self.requests, 3) if self.requests else 0.0
+            }
+
+
+class PooledStream:
+    # 从池中借出的客户端上的识别流，结束后把客户端归还给池
+    def __init__(self, pool, worker, stream):
+        self.pool = pool
+        self.worker = worker
+        self.stream = stream
+        self._released = False
+
+    def feed(self, data):
+        self.stream.feed(data)
+
+    def finish(self, audio_path):
+        start = time.perf_counter()
+        discard = False
+        try:
+            result = self.stream.finish(audio_path)
+            with self.pool._lock:
+                self.pool.requests += 1
+                self.pool.decode_total += time.perf_counter() - start
+            return result
+        except Exception:
+            with self.pool._lock:
+                self.pool.failures += 1
+            discard = True
+            raise
+        finally:
+            self._release(discard)
+
+    def abort(self):
+        # 服务端可能还在处理这个任务，丢弃该连接，避免之后收到它的结果
+        self.stream.abort()
+        self._release(discard=True)
+
+    def _release(self, discard):
+        if not self._released:
+            self._released = True
+            self.pool._release(self.worker, discard)
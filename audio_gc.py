@@ -0,0 +1,294 @@
+import os
+import shutil
+import threading
+import time
+import traceback
+
+# 录音垃圾回收
+# 删除段落、重新录音或删除录音时，模型中只去掉对录音文件的引用，请求立即返回；
+# 后台清理线程把章节audio目录中的文件与段落引用的录音对照，删除不再被引用的文件：
+#   - 录音及其识别结果文件（.wav/.merge.txt/.txt/.srt/.json）
+#   - 入库时保留的原始录音（originals目录）和转换中断留下的临时文件
+#   - 章节音频包中不再被引用的录音（只在索引中标记删除，由打包线程压缩）
+#   - 不属于任何章节的章节目录（删除章节时中途失败留下的）
+# 最近grace秒内修改过的文件不会被删除：上传中的录音在转换完成前还没有被段落引用。
+# 录音文件名不会重复使用（见Chapter.new_audio_filename），已不被引用的录音不会重新被引用。
+#
+# 有删除的章节在delay秒后统一清理，另外每隔interval秒核对整个书库，回收崩溃等原因遗留的文件。
+# dry_run为True时只生成报告不删除；命令行 python audio_gc.py 默认也只输出报告。
+
+# 与录音同名的文件后缀，去掉后缀即为录音的基本名称
+AUDIO_SUFFIXES = ('.wav.upload', '.wav.tmp', '.merge.txt', '.wav', '.txt', '.srt', '.json')
+
+
+def audio_base(name):
+    for suffix in AUDIO_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        total += sum(_file_size(os.path.join(dirpath, name)) for name in filenames)
+    return total
+
+
+def _old_enough(path, grace, now):
+    try:
+        return now - os.path.getmtime(path) >= grace
+    except OSError:
+        return False
+
+
+def find_orphans(audio_dir, live, grace, pack=None, now=None):
+    # live为段落引用的录音文件名集合，返回 [(类型, 路径或包内文件名, 字节数)]
+    now = time.time() if now is None else now
+    live_bases = {os.path.splitext(name)[0] for name in live}
+    orphans = []
+    try:
+        names = os.listdir(audio_dir)
+    except OSError:
+        return orphans
+
+    for name in names:
+        path = os.path.join(audio_dir, name)
+        base = audio_base(name)
+        if base is None or base in live_bases or not os.path.isfile(path):
+            continue
+        if _old_enough(path, grace, now):
+            orphans.append(('file', path, _file_size(path)))
+
+    originals_dir = os.path.join(audio_dir, 'originals')
+    if os.path.isdir(originals_dir):
+        for name in os.listdir(originals_dir):
+            path = os.path.join(originals_dir, name)
+            if os.path.splitext(name)[0] not in live_bases and _old_enough(path, grace, now):
+                orphans.append(('file', path, _file_size(path)))
+
+    if pack is not None and pack.exists:
+        for name in pack.names():
+            base = audio_base(name)
+            if base is not None and base not in live_bases:
+                entry = pack.entry(name)
+                orphans.append(('packed', name, entry[2] if entry else 0))
+    return orphans
+
+
+class AudioSweeper:
+    def __init__(self, root, book_chapters, live_audio, packs, grace=600.0, delay=30.0,
+                 interval=6 * 3600.0, batch_size=200, dry_run=False, packed_removed=None):
+        # root() -> 书籍目录
+        # book_chapters(book_id) -> 书中章节id的列表，书籍不存在时返回None
+        # live_audio(book_id, chapter_id) -> 段落引用的录音文件名集合，章节不存在时返回None
+        # packs为audio_pack.PackRegistry；packed_removed(audio_dir)在从音频包中删除录音后调用，用于安排压缩
+        self.root = root
+        self.book_chapters = book_chapters
+        self.live_audio = live_audio
+        self.packs = packs
+        self.packed_removed_callback = packed_removed
+        self.grace = grace
+        self.delay = delay
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self._pending = {}
+        self._cond = threading.Condition()
+        # 同一时间只进行一次清理
+        self._sweep_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._next_full = time.monotonic() + interval
+
+        # 统计信息
+        self.sweeps = 0
+        self.files_removed = 0
+        self.packed_removed = 0
+        self.dirs_removed = 0
+        self.bytes_reclaimed = 0
+        self.last_report = None
+
+    def schedule(self, book_id, chapter_id):
+        # 章节中有录音不再被引用，稍后统一清理
+        with self._cond:
+            if self._closed:
+                return
+            self._pending.setdefault((book_id, chapter_id), time.monotonic())
+            self._ensure_thread()
+            self._cond.notify()
+
+    def _ensure_thread(self):
+        # 调用方需持有self._cond
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='audio-gc', daemon=True)
+            self._thread.start()
+
+    def start(self):
+        # 启动定期核对整个书库的线程
+        with self._cond:
+            self._ensure_thread()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                due = [key for key, t in self._pending.items() if now - t >= self.delay]
+                full = now >= self._next_full
+                if not due and not full:
+                    waits = [self.delay - (now - t) for t in self._pending.values()]
+                    self._cond.wait(min(waits + [self._next_full - now]))
+                    continue
+                for key in due:
+                    del self._pending[key]
+                if full:
+                    self._next_full = now + self.interval
+            try:
+                if full:
+                    self.sweep()
+                else:
+                    for book_id, chapter_id in due:
+                        self.sweep(book_id, chapter_id)
+            except Exception:
+                traceback.print_exc()
+
+    def report(self, book_id=None, chapter_id=None):
+        # 只统计，不删除
+        return self.sweep(book_id, chapter_id, dry_run=True)
+
+    def sweep(self, book_id=None, chapter_id=None, dry_run=None):
+        # 核对整个书库、一本书或一个章节，返回报告
+        dry_run = self.dry_run if dry_run is None else dry_run
+        with self._sweep_lock:
+            return self._sweep(book_id, chapter_id, dry_run)
+
+    def _sweep(self, book_id, chapter_id, dry_run):
+        now = time.time()
+        root = self.root()
+        report = {'dry_run': dry_run, 'chapters': 0, 'files': 0, 'packed': 0, 'dirs': 0, 'bytes': 0, 'items': []}
+        book_ids = [book_id] if book_id is not None else sorted(os.listdir(root)) if os.path.isdir(root) else []
+        for bid in book_ids:
+            chapters_dir = os.path.join(root, bid, 'chapters')
+            if not os.path.isdir(chapters_dir):
+                continue
+            chapter_ids = self.book_chapters(bid)
+            if chapter_ids is None:
+                continue
+            if chapter_id is not None:
+                candidates = [chapter_id]
+            else:
+                candidates = sorted(os.listdir(chapters_dir))
+            for cid in candidates:
+                chapter_dir = os.path.join(chapters_dir, cid)
+                if not os.path.isdir(chapter_dir):
+                    continue
+                if cid not in chapter_ids:
+                    # 不属于任何章节的章节目录
+                    if _old_enough(chapter_dir, self.grace, now):
+                        size = _tree_size(chapter_dir)
+                        report['dirs'] += 1
+                        report['bytes'] += size
+                        report['items'].append({'type': 'dir', 'path': chapter_dir, 'bytes': size})
+                        if not dry_run:
+                            self.packs.forget(chapter_dir)
+                            shutil.rmtree(chapter_dir, ignore_errors=True)
+                            self._count('dirs_removed', size)
+                    continue
+                self._sweep_chapter(bid, cid, os.path.join(chapter_dir, 'audio'), report, dry_run, now)
+
+        with self._cond:
+            self.sweeps += 1
+            report['items'] = report['items'][:1000]
+            self.last_report = dict(report, items=len(report['items']), finished_at=time.time())
+        return report
+
+    def _sweep_chapter(self, book_id, chapter_id, audio_dir, report, dry_run, now):
+        if not os.path.isdir(audio_dir):
+            return
+        live = self.live_audio(book_id, chapter_id)
+        if live is None:
+            return
+        pack = self.packs.get(audio_dir)
+        orphans = find_orphans(audio_dir, live, self.grace, pack, now)
+        report['chapters'] += 1
+        for kind, target, size in orphans:
+            report['packed' if kind == 'packed' else 'files'] += 1
+            report['bytes'] += size
+            report['items'].append({'type': kind, 'path': target if kind == 'file' else os.path.join(audio_dir, target), 'bytes': size})
+        if dry_run:
+            return
+
+        # 分批删除，每批之间让出磁盘
+        for start in range(0, len(orphans), self.batch_size):
+            batch = orphans[start:start + self.batch_size]
+            packed = [target for kind, target, _ in batch if kind == 'packed']
+            if packed:
+                pack.remove(packed)
+                self._count('packed_removed', sum(size for kind, _, size in batch if kind == 'packed'), len(packed))
+                if self.packed_removed_callback:
+                    self.packed_removed_callback(audio_dir)
+            for kind, target, size in batch:
+                if kind != 'file':
+                    continue
+                try:
+                    os.remove(target)
+                    self._count('files_removed', size)
+                except FileNotFoundError:
+                    pass
+            if start + self.batch_size < len(orphans):
+                time.sleep(0.05)
+
+    def _count(self, counter, size, count=1):
+        with self._cond:
+            setattr(self, counter, getattr(self, counter) + count)
+            self.bytes_reclaimed += size
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'dry_run': self.dry_run,
+                'pending': len(self._pending),
+                'sweeps': self.sweeps,
+                'files_removed': self.files_removed,
+                'packed_removed': self.packed_removed,
+                'dirs_removed': self.dirs_removed,
+                'bytes_reclaimed': self.bytes_reclaimed,
+                'last_report': self.last_report
+            }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='清理不再被段落引用的录音文件，默认只输出报告')
+    parser.add_argument('--book', type=str, default=None, help='书籍id，不指定时核对整个书库')
+    parser.add_argument('--apply', action='store_true', help='实际删除文件')
+    parser.add_argument('--verbose', action='store_true', help='列出每个待删除的文件')
+    args = parser.parse_args()
+
+    import app as webapp
+
+    result = webapp.audio_sweeper.sweep(args.book, dry_run=not args.apply)
+    if args.verbose:
+        for item in result['items']:
+            print(f"{item['type']:6} {item['bytes']:>10}  {item['path']}")
+    action = '已删除' if args.apply else '可删除'
+    print(f"核对 {result['chapters']} 个章节：{action} {result['files']} 个文件、{result['packed']} 个已打包的录音、"
+          f"{result['dirs']} 个章节目录，共 {result['bytes'] / 1024 / 1024:.1f} MB")
+    if not args.apply:
+        print('确认无误后加上 --apply 实际删除')
@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+import traceback
+import wave
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import asr
+
+# 录音入库
+# 浏览器MediaRecorder录制的通常是webm/opus，只是以.wav的文件名保存，
+# 识别和训练每次使用时都要重新解码、重采样。这里在上传时把音频一次性转换为
+# 16kHz单声道16位PCM WAV，并统计时长、采样率和峰值，之后使用录音时直接读取PCM。
+#
+# 解码和重采样是CPU密集的操作，放在进程池中执行，不占用Web服务器进程的GIL。
+# 进程池中执行的是模块级函数normalize。进程池固定使用spawn方式启动子进程：Linux默认的fork
+# 会复制已经运行着多个线程的Web服务器进程，而Windows和macOS本来就只能用spawn。
+# spawn的子进程会重新导入启动脚本（作为__mp_main__），因此app和main导入时只创建对象，
+# 不启动后台线程，后台线程由入口调用app.start_background_workers()启动。
+# Windows下打包为单文件程序时，入口需要调用multiprocessing.freeze_support()。
+
+SAMPLE_RATE = asr.SAMPLE_RATE
+# AUDIO_KEEP_ORIGINAL开启时，原始录音保存在章节音频目录下的这个子目录中
+ORIGINALS_DIR = 'originals'
+
+
+def guess_extension(audio_path):
+    # 按文件头判断音频的实际格式，浏览器上传的文件名和内容类型不可靠
+    with open(audio_path, 'rb') as f:
+        header = f.read(12)
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return '.wav'
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return '.webm'
+    if header[:4] == b'OggS':
+        return '.ogg'
+    if header[4:8] == b'ftyp':
+        return '.m4a'
+    if header[:3] == b'ID3' or header[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return '.mp3'
+    return '.bin'
+
+
+def read_pcm16(audio_path, base_dir):
+    # 把音频解码为16kHz单声道int16，返回array('h')
+    try:
+        with wave.open(audio_path, 'rb') as f:
+            params = f.getparams()
+            if params.nchannels == 1 and params.sampwidth == 2 and params.framerate == SAMPLE_RATE:
+                # 已经是目标格式，直接读取
+                samples = array('h')
+                samples.frombytes(f.readframes(params.nframes))
+                return samples
+    except (wave.Error, EOFError):
+        pass
+
+    result = asr.read_wav_f32(audio_path)
+    if result is not None:
+        data = array('f')
+        data.frombytes(result[0])
+        return array('h', [max(-32768, min(32767, int(s * 32768.0))) for s in data])
+
+    ffmpeg = asr.find_ffmpeg(base_dir)
+    if not ffmpeg:
+        raise RuntimeError('音频不是PCM WAV格式，且未找到ffmpeg，无法转换')
+    process = subprocess.run(
+        [ffmpeg, '-v', 'error', '-i', audio_path, '-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg转换失败：{process.stderr.decode("utf-8", "ignore").strip()}')
+    samples = array('h')
+    samples.frombytes(process.stdout[:len(process.stdout) // 2 * 2])
+    return samples
+
+
+def pcm16_meta(samples):
+    # samples为16kHz单声道int16，峰值为0~1之间的比例
+    peak = max(max(samples), -min(samples)) / 32768.0 if samples else 0.0
+    return {
+        'duration': round(len(samples) / SAMPLE_RATE, 3),
+        'sample_rate': SAMPLE_RATE,
+        'channels': 1,
+        'peak': round(min(peak, 1.0), 4)
+    }
+
+
+def normalize(source_path, target_path, base_dir):
+    # 在进程池中执行：把source_path转换为16kHz单声道16位PCM WAV写入target_path，返回音频信息
+    samples = read_pcm16(source_path, base_dir)
+    temp_path = target_path + '.tmp'
+    with wave.open(temp_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+    os.replace(temp_path, target_path)
+    return pcm16_meta(samples)
+
+
+class AudioIngest:
+    def __init__(self, base_dir, workers=2, timeout=120.0):
+        self.base_dir = base_dir
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.processed = 0
+        self.failed = 0
+        self.total_time = 0.0
+        self.total_audio = 0.0
+
+    def _get_executor(self):
+        # 第一次使用时才创建进程池
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def normalize(self, source_path, target_path):
+        # 阻塞等待转换完成，返回音频信息；转换失败时抛出异常
+        start = time.monotonic()
+        try:
+            meta = self._get_executor().submit(
+                normalize, source_path, target_path, self.base_dir).result(self.timeout)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                # 子进程异常退出后进程池不可再用，下次使用时重新创建
+                if isinstance(e, BrokenProcessPool):
+                    self._executor = None
+            raise
+        with self._lock:
+            self.processed += 1
+            self.total_time += time.monotonic() - start
+            self.total_audio += meta['duration']
+        return meta
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            try:
+                executor.shutdown(wait=False, cancel_futures=True)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'processed': self.processed,
+                'failed': self.failed,
+                'avg_time': round(self.total_time / self.processed, 3) if self.processed else 0,
+                'audio_seconds': round(self.total_audio, 1)
+            }
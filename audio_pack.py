@@ -0,0 +1,530 @@
+import contextlib
+import io
+import json
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import weakref
+
+# 章节音频包
+# 每个章节目录下可能积累成千上万个 段落id_时间戳.wav 以及.txt/.srt/.json/.merge.txt等识别结果文件，
+# 备份到NAS、占用inode和训练时顺序读取都很不方便。AUDIO_STORAGE为'pack'时，
+# 录音在一段时间不再变化后被追加到章节音频目录下的一个包文件中，原文件删除：
+#   audio-<代数>.pack   录音内容依次追加，只追加不修改
+#   audio.pack.idx      索引，第一行为包文件名，之后每行一条记录：
+#                         {"name": 文件名, "offset": 偏移, "length": 长度}   追加了一个文件
+#                         {"name": 文件名, "deleted": true}                 文件已删除
+# 先写入内容再追加索引，崩溃时最多在包末尾留下一段未被索引的数据，压缩时丢弃。
+#
+# 被删除或替换的录音只在索引中标记，无用数据超过一定比例时压缩：把有效的录音写入新一代包文件和索引，
+# 替换索引（提交点）之后再删除旧的包文件。
+#
+# 读取单个录音时通过mmap直接取出对应区间；播放时用open()得到包文件中对应区间的文件对象，直接发送，
+# 不复制到内存；训练时可以用iter_clips()顺序读取整个章节的录音。
+# 不论当前是否为打包模式，读取和删除录音时都会检查包文件，切换模式后已打包的录音仍然可用。
+
+INDEX_FILENAME = 'audio.pack.idx'
+PACK_PATTERN = re.compile(r'^audio-(\d+)\.pack$')
+# 打包的文件：录音和识别结果文件，保留的原始录音等子目录不打包
+PACKED_EXTENSIONS = ('.wav', '.merge.txt', '.txt', '.srt', '.json')
+
+
+def pack_filename(generation):
+    return f'audio-{generation}.pack'
+
+
+class AudioPack:
+    def __init__(self, audio_dir):
+        self.audio_dir = audio_dir
+        self.index_file = os.path.join(audio_dir, INDEX_FILENAME)
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._entries = {}
+        self._pack_name = None
+        self._dead_bytes = 0
+        self._end = 0
+        self._mmap = None
+        self._mmap_file = None
+
+    # 索引
+    def _load(self):
+        # 调用方需持有self._lock
+        if self._loaded:
+            return
+        self._entries = {}
+        self._pack_name = None
+        self._dead_bytes = 0
+        self._end = 0
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            lines = []
+        if lines:
+            self._pack_name = json.loads(lines[0])['pack']
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 最后一行可能只写了一半
+                break
+            old = self._entries.pop(record['name'], None)
+            if old is not None:
+                self._dead_bytes += old[1]
+            if not record.get('deleted'):
+                self._entries[record['name']] = (record['offset'], record['length'])
+                self._end = max(self._end, record['offset'] + record['length'])
+        self._loaded = True
+
+    def _append_index(self, records):
+        if self._pack_name is None:
+            return
+        with open(self.index_file, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    @property
+    def exists(self):
+        return os.path.exists(self.index_file)
+
+    def names(self):
+        with self._lock:
+            self._load()
+            return list(self._entries)
+
+    def entry(self, name):
+        # 返回 (包文件名, 偏移, 长度)，不在包中时返回None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(name)
+            return (self._pack_name, entry[0], entry[1]) if entry else None
+
+    # 写入
+    def add(self, paths):
+        # 把文件追加到包中并删除原文件，返回打包的文件数
+        with self._lock:
+            self._load()
+            if self._pack_name is None:
+                self._pack_name = pack_filename(1)
+                with open(self.index_file, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps({'pack': self._pack_name}) + '\n')
+            pack_path = os.path.join(self.audio_dir, self._pack_name)
+            records = []
+            with open(pack_path, 'ab') as pack:
+                # 从索引记录的末尾开始写，覆盖崩溃时留下的未索引数据
+                pack.truncate(self._end)
+                pack.seek(self._end)
+                for path in paths:
+                    try:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                    except FileNotFoundError:
+                        continue
+                    name = os.path.basename(path)
+                    pack.write(data)
+                    records.append({'name': name, 'offset': self._end, 'length': len(data)})
+                    self._end += len(data)
+                pack.flush()
+                os.fsync(pack.fileno())
+            self._append_index(records)
+            for record in records:
+                old = self._entries.get(record['name'])
+                if old is not None:
+                    self._dead_bytes += old[1]
+                self._entries[record['name']] = (record['offset'], record['length'])
+                os.remove(os.path.join(self.audio_dir, record['name']))
+            return len(records)
+
+    def remove(self, names):
+        # 删除录音：同时删除未打包的文件和包中的记录
+        with self._lock:
+            for name in names:
+                path = os.path.join(self.audio_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            if not self.exists:
+                return
+            self._load()
+            records = []
+            for name in names:
+                entry = self._entries.pop(name, None)
+                if entry is not None:
+                    self._dead_bytes += entry[1]
+                    records.append({'name': name, 'deleted': True})
+            self._append_index(records)
+
+    def compact(self):
+        # 把有效的录音写入新一代包文件，丢弃已删除和被替换的数据
+        with self._lock:
+            self._load()
+            if self._pack_name is None:
+                return False
+            old_name = self._pack_name
+            generation = int(PACK_PATTERN.match(old_name).group(1)) + 1
+            new_name = pack_filename(generation)
+            old_path = os.path.join(self.audio_dir, old_name)
+            entries = sorted(self._entries.items(), key=lambda item: item[1][0])
+            new_entries = {}
+            offset = 0
+            with open(old_path, 'rb') as src, open(os.path.join(self.audio_dir, new_name), 'wb') as dst:
+                for name, (start, length) in entries:
+                    src.seek(start)
+                    dst.write(src.read(length))
+                    new_entries[name] = (offset, length)
+                    offset += length
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            temp_index = self.index_file + '.tmp'
+            with open(temp_index, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'pack': new_name}) + '\n')
+                for name, (start, length) in new_entries.items():
+                    f.write(json.dumps({'name': name, 'offset': start, 'length': length}, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._close_mmap()
+            os.replace(temp_index, self.index_file)
+            self._pack_name = new_name
+            self._entries = new_entries
+            self._dead_bytes = 0
+            self._end = offset
+            self._remove_stale_packs()
+            return True
+
+    def _remove_stale_packs(self):
+        # 删除旧一代的包文件；Windows上仍有播放中的录音打开着旧包时删除失败，下次压缩时再删除
+        for name in os.listdir(self.audio_dir):
+            if PACK_PATTERN.match(name) and name != self._pack_name:
+                try:
+                    os.remove(os.path.join(self.audio_dir, name))
+                except OSError:
+                    pass
+
+    def unpack(self):
+        # 把包中的录音全部写回单独的文件并删除包
+        with self._lock:
+            self._load()
+            count = 0
+            for name, data in self.iter_clips():
+                with open(os.path.join(self.audio_dir, name), 'wb') as f:
+                    f.write(data)
+                count += 1
+            self._close_mmap()
+            if self._pack_name:
+                os.remove(os.path.join(self.audio_dir, self._pack_name))
+            if os.path.exists(self.index_file):
+                os.remove(self.index_file)
+            self._loaded = False
+            return count
+
+    # 读取
+    def _map(self, end):
+        # 调用方需持有self._lock；包文件在映射之后增长时重新映射
+        if self._mmap is not None and len(self._mmap) >= end and self._mmap_file == self._pack_name:
+            return self._mmap
+        self._close_mmap()
+        with open(os.path.join(self.audio_dir, self._pack_name), 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmap_file = self._pack_name
+        return self._mmap
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self._mmap_file = None
+
+    def read(self, name):
+        # 返回录音内容，不在包中时返回None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            offset, length = entry
+            return self._map(offset + length)[offset:offset + length]
+
+    def open(self, name):
+        # 返回包文件中该录音区间的只读文件对象，不在包中时返回None
+        # 打开的文件不受之后的压缩影响：压缩写入新一代包文件，不修改旧的包文件
+        with self._lock:
+            self._load()
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            return PackSlice(open(os.path.join(self.audio_dir, self._pack_name), 'rb'), *entry)
+
+    def iter_clips(self):
+        # 按包中的顺序依次返回 (文件名, 内容)，整个章节只需一次顺序读取
+        with self._lock:
+            self._load()
+            if self._pack_name is None:
+                return
+            entries = sorted(self._entries.items(), key=lambda item: item[1][0])
+            pack_path = os.path.join(self.audio_dir, self._pack_name)
+        with open(pack_path, 'rb') as f:
+            position = 0
+            for name, (offset, length) in entries:
+                if offset != position:
+                    f.seek(offset)
+                yield name, f.read(length)
+                position = offset + length
+
+    def close(self):
+        # 释放mmap和索引，之后使用时重新加载
+        with self._lock:
+            self._close_mmap()
+            self._entries = {}
+            self._loaded = False
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            live = sum(length for _, length in self._entries.values())
+            return {'clips': len(self._entries), 'live_bytes': live, 'dead_bytes': self._dead_bytes}
+
+
+class PackSlice(io.RawIOBase):
+    # 包文件中一个录音的区间，按普通文件读取和定位，关闭时关闭包文件
+    def __init__(self, f, offset, length):
+        self._file = f
+        self.offset = offset
+        self.length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.length - self._position)
+        if size <= 0:
+            return 0
+        self._file.seek(self.offset + self._position)
+        n = self._file.readinto(memoryview(buffer)[:size])
+        self._position += n
+        return n
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self.length
+        self._position = max(0, min(position, self.length))
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class PackRegistry:
+    # 每个章节音频目录一个AudioPack对象，最近使用的max_open个保持打开的mmap和索引，
+    # 更早的释放mmap和索引，下次使用时重新加载。
+    # 同一目录始终只有一个AudioPack对象（调用方仍持有的对象不会被替换），
+    # 打包、压缩和删除都在它的锁内串行执行
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self._open = {}
+        self._packs = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, audio_dir):
+        with self._lock:
+            pack = self._packs.get(audio_dir)
+            if pack is None:
+                pack = self._packs[audio_dir] = AudioPack(audio_dir)
+            self._open.pop(audio_dir, None)
+            self._open[audio_dir] = pack
+            evicted = []
+            while len(self._open) > self.max_open:
+                evicted.append(self._open.pop(next(iter(self._open))))
+        # 在锁外释放：正在使用的包要等当前操作完成
+        for old in evicted:
+            old.close()
+        return pack
+
+    def forget(self, prefix):
+        # 章节或书籍目录被删除时调用
+        with self._lock:
+            packs = [pack for audio_dir, pack in list(self._packs.items())
+                     if audio_dir == prefix or audio_dir.startswith(prefix + os.sep)]
+            for pack in packs:
+                self._open.pop(pack.audio_dir, None)
+        for pack in packs:
+            pack.close()
+
+    def close(self):
+        with self._lock:
+            packs = list(self._packs.values())
+            self._open.clear()
+        for pack in packs:
+            pack.close()
+
+
+def loose_files(audio_dir, older_than=None):
+    # 章节音频目录中尚未打包的录音和识别结果文件
+    now = time.time()
+    paths = []
+    try:
+        names = os.listdir(audio_dir)
+    except OSError:
+        return paths
+    for name in names:
+        if not name.endswith(PACKED_EXTENSIONS) or name.endswith('.tmp'):
+            continue
+        path = os.path.join(audio_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        # 空文件为刚占用的录音文件名，内容尚未写入
+        if not os.path.isfile(path) or st.st_size == 0:
+            continue
+        if older_than is not None and now - st.st_mtime < older_than:
+            continue
+        paths.append(path)
+    return sorted(paths)
+
+
+@contextlib.contextmanager
+def materialize(registry, audio_path):
+    # 需要文件路径的调用方（识别客户端、ffmpeg等）使用：录音已打包时临时写出到文件
+    if os.path.exists(audio_path):
+        yield audio_path
+        return
+    data = registry.get(os.path.dirname(audio_path)).read(os.path.basename(audio_path))
+    if data is None:
+        raise FileNotFoundError(audio_path)
+    fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(audio_path)[1])
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        yield temp_path
+    finally:
+        os.remove(temp_path)
+
+
+class Packer:
+    # 后台打包线程：有新录音的章节被放入待处理列表，录音超过delay秒不再变化后打包，
+    # 无用数据超过compact_ratio时压缩
+    def __init__(self, registry, delay=300.0, compact_ratio=0.5, compact_min_bytes=1024 * 1024):
+        self.registry = registry
+        self.delay = delay
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+        # 统计信息
+        self.packed = 0
+        self.compactions = 0
+
+    def schedule(self, audio_dir):
+        with self._cond:
+            if self._closed:
+                return
+            self._pending[audio_dir] = time.monotonic()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='audio-packer', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._pending:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                now = time.monotonic()
+                due = [d for d, t in self._pending.items() if now - t >= self.delay]
+                if not due:
+                    self._cond.wait(min(self.delay - (now - t) for t in self._pending.values()))
+                    continue
+                for audio_dir in due:
+                    del self._pending[audio_dir]
+            for audio_dir in due:
+                try:
+                    self.process(audio_dir)
+                except Exception:
+                    traceback.print_exc()
+
+    def process(self, audio_dir, older_than=None):
+        # 打包目录中不再变化的录音，必要时压缩
+        if not os.path.isdir(audio_dir):
+            return
+        pack = self.registry.get(audio_dir)
+        paths = loose_files(audio_dir, self.delay if older_than is None else older_than)
+        if paths:
+            self.packed += pack.add(paths)
+        if pack.exists:
+            stats = pack.stats()
+            total = stats['live_bytes'] + stats['dead_bytes']
+            if stats['dead_bytes'] >= self.compact_min_bytes and stats['dead_bytes'] >= total * self.compact_ratio:
+                if pack.compact():
+                    self.compactions += 1
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'packed': self.packed,
+                'compactions': self.compactions
+            }
+
+
+def walk_audio_dirs(books_folder):
+    for book_id in sorted(os.listdir(books_folder)):
+        chapters_dir = os.path.join(books_folder, book_id, 'chapters')
+        if not os.path.isdir(chapters_dir):
+            continue
+        for chapter_id in sorted(os.listdir(chapters_dir)):
+            audio_dir = os.path.join(chapters_dir, chapter_id, 'audio')
+            if os.path.isdir(audio_dir):
+                yield audio_dir
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='打包、压缩或解包章节录音（请在app未运行时使用）')
+    parser.add_argument('action', choices=['pack', 'compact', 'unpack', 'stats'])
+    parser.add_argument('--books', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'books'), help='书籍目录')
+    args = parser.parse_args()
+
+    registry = PackRegistry()
+    totals = {'chapters': 0, 'files': 0, 'live_bytes': 0, 'dead_bytes': 0}
+    for audio_dir in walk_audio_dirs(args.books):
+        pack = registry.get(audio_dir)
+        if args.action == 'pack':
+            totals['files'] += pack.add(loose_files(audio_dir))
+        elif args.action == 'compact' and pack.exists:
+            pack.compact()
+        elif args.action == 'unpack' and pack.exists:
+            totals['files'] += pack.unpack()
+        if pack.exists:
+            stats = pack.stats()
+            totals['chapters'] += 1
+            totals['live_bytes'] += stats['live_bytes']
+            totals['dead_bytes'] += stats['dead_bytes']
+        registry.close()
+    print(totals)
@@ -0,0 +1,421 @@
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import wave
+
+# 性能基准测试
+# 在临时目录中生成指定规模的书库（书籍数 × 每本章节数 × 每章段落数），通过Flask测试客户端
+# 调用接口，统计每个场景的延迟分位数（p50/p90/p99）和吞吐量：
+#   keystroke  逐字输入时的段落更新（/paragraph/update，写回模式下只在内存中确认）
+#   add        添加段落
+#   move       上下移动段落
+#   paragraphs 打开章节（/paragraphs），在书库中随机选择章节，包含缓存未命中的情况
+#   books      书架列表（/api/books）
+#   upload     上传1秒的录音（包含转换为标准格式）
+# 每个场景结束后把未保存的修改写入磁盘，耗时单独记为flush_ms。
+#
+# 结果写入JSON文件；指定 --baseline 时与保存的基准结果逐项对比，p99或吞吐量变差超过threshold时
+# 标记为变慢，可以用来判断存储和缓存的改动是否真的更快。
+# 同一组参数和seed生成的书库和操作序列相同；--matrix 依次在子进程中测试MATRIX中的各个规模。
+#
+#   python benchmark.py --books 100 --paragraphs 500 --output result.json
+#   python benchmark.py --matrix --output baseline.json
+#   python benchmark.py --matrix --baseline baseline.json --output result.json
+
+SCENARIOS = ('keystroke', 'add', 'move', 'paragraphs', 'books', 'upload')
+
+# --matrix 测试的书库规模：(书籍数, 每本章节数, 每章段落数)
+MATRIX = [
+    (1, 1, 10),
+    (1, 3, 500),
+    (1, 3, 5000),
+    (100, 3, 500),
+    (1000, 3, 10),
+]
+
+RESULT_VERSION = 1
+
+# 生成段落文本使用的字符
+TEXT_CHARS = '的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严'
+PUNCTUATION = '，，，。、；'
+
+
+def percentile(sorted_values, p):
+    # 最近秩法，sorted_values需已排序
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100.0 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize(latencies, elapsed, errors):
+    values = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        'count': len(values),
+        'errors': errors,
+        'mean_ms': ms(sum(values) / len(values)) if values else None,
+        'p50_ms': ms(percentile(values, 50)),
+        'p90_ms': ms(percentile(values, 90)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None,
+        'throughput': round(len(values) / elapsed, 1) if elapsed > 0 else None
+    }
+
+
+def random_text(rng, length):
+    chars = []
+    for i in range(length):
+        chars.append(rng.choice(PUNCTUATION) if i and i % rng.randint(8, 20) == 0 else rng.choice(TEXT_CHARS))
+    return ''.join(chars) + '。'
+
+
+def silent_wav(seconds=1.0, sample_rate=16000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(b'\x00\x00' * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+def generate_library(webapp, books, chapters, paragraphs, seed=0, paragraph_length=60):
+    # 直接通过Book/Chapter模型写入磁盘（或数据库），生成时不更新搜索索引；返回 [(书籍id, [章节id])]
+    rng = random.Random(seed)
+    created_at = '2024-01-01T00:00:00'
+    library = []
+    for b in range(books):
+        book = webapp.Book(str(uuid.UUID(int=rng.getrandbits(128), version=4)), f'测试书籍{b + 1}', '测试')
+        os.makedirs(book.book_dir, exist_ok=True)
+        chapter_ids = []
+        for c in range(chapters):
+            chapter = webapp.Chapter(str(uuid.UUID(int=rng.getrandbits(128), version=4)), f'第{c + 1}章', book.id)
+            chapter.paragraphs = [{
+                'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                'text': random_text(rng, rng.randint(paragraph_length // 2, paragraph_length * 3 // 2)),
+                'audio': '',
+                'created_at': created_at
+            } for _ in range(paragraphs)]
+            chapter.ensure_dirs()
+            db = webapp.sqlite_storage()
+            with webapp.chapter_lock(book.id, chapter.id):
+                if db is not None:
+                    chapter._save_to_db(db)
+                else:
+                    chapter._write_snapshot()
+            book.chapters.append({'id': chapter.id, 'title': chapter.title, 'created_at': created_at})
+            chapter_ids.append(chapter.id)
+        book.save()
+        library.append((book.id, chapter_ids))
+    return library
+
+
+class Runner:
+    def __init__(self, webapp, library, seed=0, threads=1):
+        self.webapp = webapp
+        self.library = library
+        self.seed = seed
+        self.threads = threads
+        # 写操作集中在第一本书的章节中，与实际使用时编辑一个章节的情况一致
+        self.book_id, chapter_ids = library[0]
+        self.chapter_ids = chapter_ids
+        self.wav = silent_wav()
+
+    def paragraph_ids(self, client, chapter_id):
+        response = client.get(f'/api/chapter/{self.book_id}/{chapter_id}/paragraphs').get_json()
+        return [p['id'] for p in response['paragraphs'] if not p.get('is_end_paragraph')]
+
+    def requests(self, scenario, client, rng, count):
+        # 生成 (调用函数) 序列，准备数据的请求不计入结果
+        chapter_id = rng.choice(self.chapter_ids)
+        base = f'/api/chapter/{self.book_id}/{chapter_id}'
+        if scenario == 'keystroke':
+            ids = self.paragraph_ids(client, chapter_id) or [None]
+            paragraph_id = rng.choice(ids)
+            if paragraph_id is None:
+                paragraph_id = client.post(base + '/paragraph/add', json={'text': ''}).get_json()['paragraph']['id']
+            text = ''
+            for _ in range(count):
+                text += rng.choice(TEXT_CHARS)
+                yield lambda text=text: client.post(base + '/paragraph/update', json={'id': paragraph_id, 'text': text})
+        elif scenario == 'add':
+            ids = self.paragraph_ids(client, chapter_id)
+            for _ in range(count):
+                after_id = rng.choice(ids) if ids else None
+                yield lambda after_id=after_id: client.post(
+                    base + '/paragraph/add', json={'text': random_text(rng, 40), 'after_id': after_id})
+        elif scenario == 'move':
+            ids = self.paragraph_ids(client, chapter_id)
+            if len(ids) < 2:
+                return
+            # 从中间部分选择段落，避免移到开头或末尾后无法继续移动被计为失败
+            if len(ids) >= 4:
+                ids = ids[len(ids) // 4:len(ids) - len(ids) // 4]
+            for _ in range(count):
+                paragraph_id = rng.choice(ids)
+                direction = rng.choice(('up', 'down'))
+                yield lambda p=paragraph_id, d=direction: client.post(f'{base}/paragraph/move/{p}/{d}')
+        elif scenario == 'paragraphs':
+            for _ in range(count):
+                book_id, chapter_ids = rng.choice(self.library)
+                url = f'/api/chapter/{book_id}/{rng.choice(chapter_ids)}/paragraphs'
+                yield lambda url=url: client.get(url)
+        elif scenario == 'books':
+            for _ in range(count):
+                yield lambda: client.get('/api/books')
+        elif scenario == 'upload':
+            ids = self.paragraph_ids(client, chapter_id)
+            for _ in range(count):
+                paragraph_id = rng.choice(ids)
+                yield lambda p=paragraph_id: client.post(
+                    f'{base}/audio/upload/{p}',
+                    data={'audio': (io.BytesIO(self.wav), 'recording.wav')},
+                    content_type='multipart/form-data')
+        else:
+            raise ValueError(f'未知的场景：{scenario}')
+
+    def run_scenario(self, scenario, ops, warmup=20):
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        per_thread = max(1, ops // self.threads)
+
+        def worker(index):
+            client = self.webapp.app.test_client()
+            rng = random.Random(f'{self.seed}-{scenario}-{index}')
+            local = []
+            local_errors = 0
+            for i, call in enumerate(self.requests(scenario, client, rng, per_thread + warmup)):
+                start = time.perf_counter()
+                response = call()
+                elapsed = time.perf_counter() - start
+                data = response.get_json(silent=True)
+                if response.status_code != 200 or (isinstance(data, dict) and data.get('success') is False):
+                    local_errors += 1
+                elif i >= warmup:
+                    local.append(elapsed)
+            with lock:
+                latencies.extend(local)
+                errors[0] += local_errors
+
+        start = time.perf_counter()
+        if self.threads == 1:
+            worker(0)
+        else:
+            workers = [threading.Thread(target=worker, args=(i,)) for i in range(self.threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+        elapsed = time.perf_counter() - start
+
+        # 写回模式下未保存的修改计入单独的写盘时间
+        flush_start = time.perf_counter()
+        self.webapp.chapter_store.flush_all()
+        result = summarize(latencies, elapsed, errors[0])
+        result['flush_ms'] = round((time.perf_counter() - flush_start) * 1000, 3)
+        return result
+
+
+def library_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+def run_benchmark(books, chapters, paragraphs, ops=200, warmup=20, scenarios=SCENARIOS, storage='snapshot',
+                  write_behind=True, threads=1, seed=0, workdir=None, keep=False):
+    # 在临时书库上运行一组场景，返回一条结果记录
+    root = tempfile.mkdtemp(prefix='dbinputnote-bench-', dir=workdir)
+    import app as webapp
+
+    webapp.app.config['BOOKS_FOLDER'] = root
+    webapp.app.config['STORAGE_MODE'] = storage
+    webapp.app.config['SQLITE_PATH'] = None
+    webapp.app.config['SEARCH_INDEX_PATH'] = os.path.join(root, 'search.db')
+    webapp.chapter_store.write_behind = write_behind
+    try:
+        start = time.perf_counter()
+        library = generate_library(webapp, books, chapters, paragraphs, seed=seed)
+        generate_seconds = time.perf_counter() - start
+
+        runner = Runner(webapp, library, seed=seed, threads=threads)
+        results = {}
+        for scenario in scenarios:
+            results[scenario] = runner.run_scenario(scenario, ops, warmup=warmup)
+            print(f"  {scenario:<11}p50 {results[scenario]['p50_ms']} ms  p99 {results[scenario]['p99_ms']} ms  "
+                  f"{results[scenario]['throughput']} 次/秒", file=sys.stderr)
+        webapp.search_index.flush()
+        return {
+            'key': run_key(books, chapters, paragraphs, storage, write_behind, threads),
+            'library': {
+                'books': books,
+                'chapters': chapters,
+                'paragraphs': paragraphs,
+                'bytes': library_size(root),
+                'generate_seconds': round(generate_seconds, 3)
+            },
+            'config': {'storage': storage, 'write_behind': write_behind, 'threads': threads,
+                       'ops': ops, 'warmup': warmup, 'seed': seed},
+            'scenarios': results
+        }
+    finally:
+        # 删除临时书库前写入所有未保存的数据，退出时不再写入已删除的目录
+        webapp.chapter_store.close()
+        webapp.search_index.close()
+        webapp.catalog.close()
+        webapp.audio_sweeper.close()
+        if keep:
+            print(f'书库保留在 {root}', file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def run_key(books, chapters, paragraphs, storage, write_behind, threads):
+    # 与基准结果对比时按此匹配
+    return f"{books}x{chapters}x{paragraphs}/{storage}/{'wb' if write_behind else 'sync'}/t{threads}"
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def compare(runs, baseline_runs, threshold=0.2):
+    # 返回逐项对比结果；p99变大或吞吐量变小超过threshold时为变慢
+    baseline = {run['key']: run for run in baseline_runs}
+    comparison = []
+    for run in runs:
+        base = baseline.get(run['key'])
+        if base is None:
+            continue
+        for scenario, result in run['scenarios'].items():
+            base_result = base['scenarios'].get(scenario)
+            if not base_result or not result['count'] or not base_result['count']:
+                continue
+            item = {'key': run['key'], 'scenario': scenario}
+            for field in ('p50_ms', 'p99_ms', 'throughput'):
+                item[field] = result[field]
+                item['baseline_' + field] = base_result[field]
+                item[field.replace('_ms', '') + '_ratio'] = (
+                    round(result[field] / base_result[field], 3) if base_result[field] else None)
+            item['regression'] = bool(
+                (item['p99_ratio'] is not None and item['p99_ratio'] > 1 + threshold)
+                or (item['throughput_ratio'] is not None and item['throughput_ratio'] < 1 / (1 + threshold)))
+            comparison.append(item)
+    return comparison
+
+
+def print_comparison(comparison):
+    print(f"{'规模/配置':<28}{'场景':<12}{'p50(ms)':>18}{'p99(ms)':>18}{'次/秒':>16}")
+    for item in comparison:
+        flag = '  变慢' if item['regression'] else ''
+        columns = ''.join(f"{str(item['baseline_' + field]):>8} → {str(item[field]):<8}"
+                          for field in ('p50_ms', 'p99_ms', 'throughput'))
+        print(f"{item['key']:<30}{item['scenario']:<12}{columns}{flag}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='DBInputNote接口性能基准测试')
+    parser.add_argument('--books', type=int, default=10, help='书籍数')
+    parser.add_argument('--chapters', type=int, default=3, help='每本书的章节数')
+    parser.add_argument('--paragraphs', type=int, default=500, help='每章的段落数')
+    parser.add_argument('--matrix', action='store_true', help='依次测试MATRIX中的各个规模，忽略上面三个参数')
+    parser.add_argument('--ops', type=int, default=200, help='每个场景计入结果的请求数')
+    parser.add_argument('--warmup', type=int, default=20, help='每个场景开始时不计入结果的请求数')
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS), help='逗号分隔的场景列表')
+    parser.add_argument('--storage', choices=('snapshot', 'oplog', 'sqlite'), default='snapshot', help='章节存储模式')
+    parser.add_argument('--sync', action='store_true', help='关闭写回模式，段落更新立即写入磁盘')
+    parser.add_argument('--threads', type=int, default=1, help='并发请求的线程数')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--workdir', type=str, default=None, help='临时书库所在目录，默认为系统临时目录')
+    parser.add_argument('--keep', action='store_true', help='测试结束后保留临时书库')
+    parser.add_argument('--output', type=str, default=None, help='结果JSON文件')
+    parser.add_argument('--baseline', type=str, default=None, help='与之对比的基准结果JSON文件')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p99或吞吐量变差超过该比例时视为变慢')
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'未知的场景：{name}')
+
+    options = dict(ops=args.ops, warmup=args.warmup, scenarios=scenarios, storage=args.storage,
+                   write_behind=not args.sync, threads=args.threads, seed=args.seed,
+                   workdir=args.workdir, keep=args.keep)
+    runs = []
+    if args.matrix:
+        # 每个规模在单独的子进程中运行，互不影响缓存、线程和进程池
+        for books, chapters, paragraphs in MATRIX:
+            fd, path = tempfile.mkstemp(suffix='.json')
+            os.close(fd)
+            try:
+                command = [sys.executable, os.path.abspath(__file__), '--books', str(books), '--chapters', str(chapters),
+                           '--paragraphs', str(paragraphs), '--ops', str(args.ops), '--warmup', str(args.warmup),
+                           '--scenarios', ','.join(scenarios), '--storage', args.storage, '--threads', str(args.threads),
+                           '--seed', str(args.seed), '--output', path]
+                if args.sync:
+                    command.append('--sync')
+                if args.workdir:
+                    command += ['--workdir', args.workdir]
+                if args.keep:
+                    command.append('--keep')
+                subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+                with open(path, 'r', encoding='utf-8') as f:
+                    runs.extend(json.load(f)['runs'])
+            finally:
+                os.remove(path)
+    else:
+        print(f'{args.books} 本书 × {args.chapters} 章 × {args.paragraphs} 段：', file=sys.stderr)
+        runs.append(run_benchmark(args.books, args.chapters, args.paragraphs, **options))
+
+    result = {
+        'version': RESULT_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'runs': runs
+    }
+    regressions = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        comparison = compare(runs, baseline.get('runs', []), args.threshold)
+        result['baseline'] = {'path': args.baseline, 'created_at': baseline.get('created_at'),
+                              'threshold': args.threshold, 'comparison': comparison}
+        print_comparison(comparison)
+        regressions = sum(1 for item in comparison if item['regression'])
+        if not comparison:
+            print('基准结果中没有相同规模和配置的记录')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'结果已写入 {args.output}', file=sys.stderr)
+    else:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    # 有变慢的项目时返回非零，便于在脚本中使用
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,230 @@
+import datetime
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# 整书导出
+# 按Book.chapters的顺序逐章读取并输出TXT、Markdown或EPUB，以生成器的形式逐块返回bytes，
+# 同一时间只有一个章节在内存中，Web接口边生成边发送，第一章写完就开始传输。
+#
+# chapters为可迭代的 (章节标题, 段落文本列表)，由调用方逐章读取。
+# EPUB是一个zip文件：章节逐个写入，目录（nav.xhtml、toc.ncx）和content.opf在最后写入，
+# container.xml中指明了content.opf的位置，它不需要在zip中靠前。
+
+FORMATS = {
+    'txt': ('text/plain', '.txt'),
+    'md': ('text/markdown', '.md'),
+    'epub': ('application/epub+zip', '.epub'),
+}
+
+# Markdown中位于行首时有特殊含义的内容
+MARKDOWN_LINE_START = re.compile(r'^(\s*)([#>*+\-=|]|\d+[.)]|`{3}|~{3})')
+
+
+def _paragraph_texts(paragraphs):
+    # 与Chapter.get_full_text一致：跳过空段落
+    return [text for text in paragraphs if text.strip()]
+
+
+def export_txt(title, author, chapters):
+    header = title + ('\n作者：' + author if author else '') + '\n'
+    yield header.encode('utf-8')
+    for chapter_title, paragraphs in chapters:
+        lines = ['', '', chapter_title, ''] + _paragraph_texts(paragraphs)
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def markdown_escape(text):
+    return '\n'.join(MARKDOWN_LINE_START.sub(r'\1\\\2', line) for line in text.split('\n'))
+
+
+def export_markdown(title, author, chapters):
+    header = f'# {title}\n' + (f'\n作者：{markdown_escape(author)}\n' if author else '')
+    yield header.encode('utf-8')
+    for chapter_title, paragraphs in chapters:
+        # 段落内的换行在Markdown中保留为硬换行
+        blocks = [f'## {chapter_title}'] + [markdown_escape(text).replace('\n', '  \n')
+                                            for text in _paragraph_texts(paragraphs)]
+        yield ('\n' + '\n\n'.join(blocks) + '\n').encode('utf-8')
+
+
+class _ZipSink(io.RawIOBase):
+    # zipfile写完一个文件后会回到该文件的文件头补写CRC和大小。
+    # 这里保留当前文件的数据，文件写完后由take()取出发送，只需要一个章节大小的内存，
+    # 生成的EPUB不含数据描述符，与写入普通文件时相同
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self._position
+        elif whence == 2:
+            position += self._offset + len(self._buffer)
+        if position < self._offset:
+            raise OSError('已发送的数据不能再修改')
+        self._position = position
+        return position
+
+    def write(self, data):
+        start = self._position - self._offset
+        self._buffer[start:start + len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def take(self):
+        data = bytes(self._buffer)
+        self._offset += len(data)
+        self._buffer.clear()
+        return data
+
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+STYLESHEET = '''body { line-height: 1.6; }
+h1 { text-align: center; margin: 1em 0; }
+p { text-indent: 2em; margin: 0.4em 0; }
+'''
+
+
+XHTML_TAIL = '</body>\n</html>\n'
+
+
+def _xhtml_head(title):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh" xml:lang="zh">\n'
+        f'<head><meta charset="UTF-8"/><title>{escape(title)}</title>'
+        '<link rel="stylesheet" type="text/css" href="style.css"/></head>\n'
+        '<body>\n'
+    )
+
+
+def export_epub(book_id, title, author, chapters, language='zh'):
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED)
+    # mimetype必须是第一个文件且不压缩
+    archive.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+    archive.writestr('META-INF/container.xml', CONTAINER_XML)
+    archive.writestr('OEBPS/style.css', STYLESHEET)
+    yield sink.take()
+
+    titles = []
+    for chapter_title, paragraphs in chapters:
+        titles.append(chapter_title)
+        with archive.open(f'OEBPS/chapter-{len(titles):04d}.xhtml', 'w') as f:
+            f.write((_xhtml_head(chapter_title) + f'<h1>{escape(chapter_title)}</h1>\n').encode('utf-8'))
+            for text in _paragraph_texts(paragraphs):
+                f.write(f"<p>{escape(text).replace(chr(10), '<br/>')}</p>\n".encode('utf-8'))
+            f.write(XHTML_TAIL.encode('utf-8'))
+        yield sink.take()
+
+    names = [f'chapter-{i:04d}.xhtml' for i in range(1, len(titles) + 1)]
+    nav_items = ''.join(f'      <li><a href="{name}">{escape(t)}</a></li>\n' for name, t in zip(names, titles))
+    archive.writestr('OEBPS/nav.xhtml', (
+        _xhtml_head(title) +
+        '<nav epub:type="toc" id="toc">\n'
+        f'  <h1>{escape(title)}</h1>\n'
+        f'  <ol>\n{nav_items}  </ol>\n'
+        '</nav>\n' + XHTML_TAIL))
+
+    uid = f'urn:uuid:{book_id}'
+    nav_points = ''.join(
+        f'    <navPoint id="nav-{i}" playOrder="{i}"><navLabel><text>{escape(t)}</text></navLabel>'
+        f'<content src="{name}"/></navPoint>\n'
+        for i, (name, t) in enumerate(zip(names, titles), 1))
+    archive.writestr('OEBPS/toc.ncx', (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+        f'  <head><meta name="dtb:uid" content="{escape(uid)}"/></head>\n'
+        f'  <docTitle><text>{escape(title)}</text></docTitle>\n'
+        f'  <navMap>\n{nav_points}  </navMap>\n'
+        '</ncx>\n'))
+
+    modified = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    manifest = ''.join(
+        f'    <item id="chapter-{i}" href="{name}" media-type="application/xhtml+xml"/>\n'
+        for i, name in enumerate(names, 1))
+    spine = ''.join(f'    <itemref idref="chapter-{i}"/>\n' for i in range(1, len(names) + 1))
+    archive.writestr('OEBPS/content.opf', (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+        '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+        f'    <dc:identifier id="book-id">{escape(uid)}</dc:identifier>\n'
+        f'    <dc:title>{escape(title)}</dc:title>\n'
+        + (f'    <dc:creator>{escape(author)}</dc:creator>\n' if author else '') +
+        f'    <dc:language>{language}</dc:language>\n'
+        f'    <meta property="dcterms:modified">{modified}</meta>\n'
+        '  </metadata>\n'
+        '  <manifest>\n'
+        '    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+        '    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+        '    <item id="style" href="style.css" media-type="text/css"/>\n'
+        f'{manifest}'
+        '  </manifest>\n'
+        f'  <spine toc="ncx">\n{spine}  </spine>\n'
+        '</package>\n'))
+    archive.close()
+    yield sink.take()
+
+
+def export(fmt, book_id, title, author, chapters):
+    # 返回逐块生成bytes的生成器
+    if fmt == 'txt':
+        return export_txt(title, author, chapters)
+    if fmt == 'md':
+        return export_markdown(title, author, chapters)
+    if fmt == 'epub':
+        return export_epub(book_id, title, author, chapters)
+    raise ValueError(f'不支持的导出格式：{fmt}')
+
+
+def safe_filename(title, extension):
+    # 去掉文件名中不允许的字符
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', title).strip(' .') or 'book'
+    return name + extension
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='导出整本书为TXT、Markdown或EPUB')
+    parser.add_argument('--book', type=str, required=True, help='书籍id')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='txt', help='导出格式')
+    parser.add_argument('--output', type=str, default=None, help='输出文件，默认为当前目录下的“书名.扩展名”')
+    args = parser.parse_args()
+
+    import app as webapp
+
+    book = webapp.Book.load(args.book)
+    if not book:
+        parser.error('书籍不存在')
+    output = args.output or safe_filename(book.title, FORMATS[args.format][1])
+    temp_output = output + '.tmp'
+    size = 0
+    with open(temp_output, 'wb') as f:
+        for chunk in export(args.format, book.id, book.title, book.author, webapp.book_chapter_texts(book)):
+            f.write(chunk)
+            size += len(chunk)
+    os.replace(temp_output, output)
+    print(f'已导出 {len(book.chapters)} 个章节，{size / 1024:.1f} KB -> {output}')
@@ -0,0 +1,226 @@
+import datetime
+import json
+import os
+import threading
+import time
+import traceback
+
+# 书架目录
+# 书架页面只需要每本书的摘要（书名、作者、章节数、更新时间、字数），
+# 这里把摘要保存在内存中并持久化到书籍目录下的catalog.json，
+# 不再在每次请求时遍历所有书籍目录并解析完整的book_info.json。
+#
+# 摘要由Book.save()和章节保存增量更新。以下情况会重新核对磁盘：
+#   - 书籍目录的mtime变化（进程外新增/删除了书籍）
+#   - 距上次核对超过verify_interval秒（进程外修改了book_info.json）
+# 核对时只重新解析mtime变化的book_info.json，章节字数按章节文件签名复用。
+# 章节文件签名只在启动后第一次核对时逐一检查，用于发现上次退出前未写入catalog.json的字数变化。
+
+CATALOG_FILENAME = 'catalog.json'
+CATALOG_VERSION = 1
+
+
+def _normalize_signature(signature):
+    # 文件签名在JSON中保存为列表，统一成列表后再比较
+    if signature is None:
+        return None
+    return [list(s) if s is not None else None for s in signature]
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Catalog:
+    def __init__(self, root, chapter_signature, chapter_words, verify_interval=30.0):
+        # root() -> 书籍目录
+        # chapter_signature(book_id, chapter_id) -> 章节文件签名
+        # chapter_words(book_id, chapter_id) -> 章节字数，章节不存在时返回0
+        self.root = root
+        self.chapter_signature = chapter_signature
+        self.chapter_words = chapter_words
+        self.verify_interval = verify_interval
+        self._lock = threading.RLock()
+
+        # book_id -> 摘要，摘要中以下划线开头的字段只在内部使用
+        self._books = {}
+        self._loaded_root = None
+        self._root_mtime = None
+        self._verified_at = None
+        self._verify_chapters = False
+        self._dirty = False
+
+        # 统计信息
+        self.rescans = 0
+        self.parsed = 0
+        self.persists = 0
+
+    def books(self):
+        with self._lock:
+            self._refresh()
+            if self._dirty:
+                self._persist()
+            return [self._public(entry) for entry in self._books.values()]
+
+    def book_saved(self, data, info_file):
+        # Book.save()写入book_info.json之后调用
+        with self._lock:
+            if not self._ensure_loaded():
+                return
+            old = self._books.get(data['id'])
+            self._books[data['id']] = self._summarize(data, _mtime_ns(info_file), old)
+            self._dirty = True
+
+    def chapter_saved(self, book_id, chapter_id, words, signature):
+        # 章节写入磁盘之后调用，只更新该章节的字数
+        with self._lock:
+            if not self._ensure_loaded():
+                return
+            entry = self._books.get(book_id)
+            if entry is None or chapter_id not in entry['_chapters']:
+                return
+            entry['_chapters'][chapter_id] = [words, _normalize_signature(signature)]
+            entry['word_count'] = sum(c[0] for c in entry['_chapters'].values())
+            entry['updated_at'] = datetime.datetime.now().isoformat()
+            self._dirty = True
+
+    def remove(self, book_id):
+        with self._lock:
+            if self._ensure_loaded() and self._books.pop(book_id, None) is not None:
+                self._dirty = True
+
+    def close(self):
+        with self._lock:
+            if self._dirty:
+                try:
+                    self._persist()
+                except Exception:
+                    traceback.print_exc()
+
+    def _ensure_loaded(self):
+        # 书籍目录变化（例如修改了配置）时丢弃内存中的目录，从catalog.json重新读取
+        # 调用方需持有self._lock
+        root = self.root()
+        if not os.path.isdir(root):
+            return False
+        if root == self._loaded_root:
+            return True
+        self._books = {}
+        self._loaded_root = root
+        self._root_mtime = None
+        self._verified_at = None
+        self._verify_chapters = True
+        self._dirty = False
+        try:
+            with open(os.path.join(root, CATALOG_FILENAME), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == CATALOG_VERSION:
+                self._books = data.get('books', {})
+        except (OSError, ValueError):
+            # 没有或无法解析catalog.json时完整重建
+            pass
+        return True
+
+    def _refresh(self):
+        # 调用方需持有self._lock
+        if not self._ensure_loaded():
+            self._books = {}
+            return
+        root = self._loaded_root
+        root_mtime = _mtime_ns(root)
+        now = time.monotonic()
+        if (root_mtime == self._root_mtime and self._verified_at is not None
+                and now - self._verified_at < self.verify_interval):
+            return
+
+        self.rescans += 1
+        books = {}
+        for book_id in os.listdir(root):
+            info_file = os.path.join(root, book_id, 'book_info.json')
+            info_mtime = _mtime_ns(info_file)
+            if info_mtime is None:
+                continue
+            old = self._books.get(book_id)
+            if (old is not None and old['_info_mtime'] == info_mtime
+                    and not (self._verify_chapters and not self._chapters_current(book_id, old))):
+                books[book_id] = old
+                continue
+            try:
+                with open(info_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                books[book_id] = self._summarize(data, info_mtime, old)
+            except (OSError, ValueError, KeyError):
+                traceback.print_exc()
+                continue
+            self.parsed += 1
+            self._dirty = True
+
+        if set(books) != set(self._books):
+            self._dirty = True
+        self._books = books
+        self._root_mtime = root_mtime
+        self._verified_at = now
+        self._verify_chapters = False
+
+    def _chapters_current(self, book_id, entry):
+        # 章节文件签名是否与记录的一致（章节在进程外被修改时需要重新统计字数）
+        for chapter_id, (words, signature) in entry['_chapters'].items():
+            if _normalize_signature(self.chapter_signature(book_id, chapter_id)) != signature:
+                return False
+        return True
+
+    def _summarize(self, data, info_mtime, old=None):
+        old_chapters = old['_chapters'] if old is not None else {}
+        chapters = {}
+        for chapter in data.get('chapters', []):
+            signature = _normalize_signature(self.chapter_signature(data['id'], chapter['id']))
+            cached = old_chapters.get(chapter['id'])
+            if cached is not None and cached[1] == signature:
+                chapters[chapter['id']] = cached
+            else:
+                chapters[chapter['id']] = [self.chapter_words(data['id'], chapter['id']), signature]
+
+        first_chapter = data['chapters'][0] if data.get('chapters') else None
+        return {
+            'id': data['id'],
+            'title': data['title'],
+            'author': data.get('author', ''),
+            'chapter_count': len(chapters),
+            'word_count': sum(c[0] for c in chapters.values()),
+            'created_at': first_chapter.get('created_at') if first_chapter else None,
+            'updated_at': datetime.datetime.fromtimestamp(info_mtime / 1e9).isoformat() if info_mtime else None,
+            '_info_mtime': info_mtime,
+            '_chapters': chapters
+        }
+
+    @staticmethod
+    def _public(entry):
+        return {key: value for key, value in entry.items() if not key.startswith('_')}
+
+    def _persist(self):
+        # 调用方需持有self._lock
+        root = self._loaded_root
+        catalog_file = os.path.join(root, CATALOG_FILENAME)
+        temp_file = catalog_file + '.tmp'
+        root_mtime = _mtime_ns(root)
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': CATALOG_VERSION, 'books': self._books}, f, ensure_ascii=False)
+        os.replace(temp_file, catalog_file)
+        self._dirty = False
+        self.persists += 1
+        # 写入catalog.json本身会改变书籍目录的mtime，不应因此触发重新核对
+        if root_mtime == self._root_mtime:
+            self._root_mtime = _mtime_ns(root)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'books': len(self._books),
+                'rescans': self.rescans,
+                'parsed': self.parsed,
+                'persists': self.persists,
+                'dirty': self._dirty
+            }
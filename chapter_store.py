@@ -0,0 +1,249 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+# 进程内常驻的章节缓存
+# 段落接口每次请求都会用到章节对象，这里把热点章节保留在内存里，
+# 避免每次按键都重新读取并解析整个content.json。
+#
+# 缓存的章节对象需要提供：
+#   is_stale()       判断磁盘上的文件是否已被进程外修改（按mtime/大小比较）
+#   size_estimate    章节占用内存的估算值（字节）
+#   save()           把章节完整写入磁盘
+#
+# 写回模式（write_behind=True）下，commit(chapter, defer=True)只在内存中确认修改，
+# 同一章节的多次修改合并为一次保存。脏章节在以下时机写入磁盘：
+#   - 距第一次未保存的修改超过flush_interval秒（最大数据丢失窗口）
+#   - 未保存的修改次数达到flush_threshold
+#   - 切换章节、调用flush接口或进程退出时
+
+
+class ChapterStore:
+    def __init__(self, loader, max_entries=64, max_bytes=64 * 1024 * 1024,
+                 write_behind=False, flush_interval=1.0, flush_threshold=50):
+        # loader(chapter_id, book_id) -> Chapter 或 None
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 脏章节：key -> [章节对象, 第一次未保存修改的时间, 未保存修改次数]
+        # 脏章节不会被淘汰，也不会因为磁盘文件变化而被丢弃，内存中的修改优先
+        self._dirty = {}
+        self._flush_wakeup = threading.Condition(self._lock)
+        self._flusher = None
+        self._closed = False
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.deferred_commits = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def get(self, book_id, chapter_id):
+        key = (book_id, chapter_id)
+        with self._lock:
+            chapter = self._entries.get(key)
+            dirty = key in self._dirty
+        # is_stale()需要读取文件或数据库，在锁外检查，避免阻塞其他章节的读取
+        if chapter is not None and (dirty or not chapter.is_stale()):
+            with self._lock:
+                if self._entries.get(key) is chapter:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return chapter
+        with self._lock:
+            if chapter is not None and self._entries.get(key) is chapter and key not in self._dirty:
+                # 文件在进程外被修改或删除，丢弃缓存
+                del self._entries[key]
+                self.invalidations += 1
+            self.misses += 1
+
+        # 在锁外加载，避免大章节的解析阻塞其他章节的读取
+        chapter = self.loader(chapter_id, book_id)
+        if chapter is None:
+            return None
+
+        with self._lock:
+            existing = self._entries.get(key)
+            dirty = key in self._dirty
+        if existing is not None and (dirty or not existing.is_stale()):
+            with self._lock:
+                if self._entries.get(key) is existing:
+                    # 并发加载时以先放入缓存的对象为准，保证同一章节只有一个内存副本
+                    self._entries.move_to_end(key)
+                    return existing
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and (current is not existing or key in self._dirty):
+                # 检查期间其他线程放入了新的对象或提交了修改，内存中的对象优先
+                self._entries.move_to_end(key)
+                return current
+            self._entries[key] = chapter
+            self._evict()
+        return chapter
+
+    def put(self, chapter):
+        key = (chapter.book_id, chapter.id)
+        with self._lock:
+            self._entries[key] = chapter
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, book_id, chapter_id=None):
+        # 用于章节/书籍被删除后，未保存的修改一并丢弃
+        with self._lock:
+            if chapter_id is not None:
+                keys = [(book_id, chapter_id)]
+            else:
+                keys = [key for key in self._entries if key[0] == book_id]
+                keys += [key for key in self._dirty if key[0] == book_id and key not in keys]
+            for key in keys:
+                self._dirty.pop(key, None)
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        self.flush_all()
+        with self._lock:
+            self._entries.clear()
+
+    def commit(self, chapter, defer=False):
+        # 修改章节后的统一提交入口
+        # defer=True且开启写回模式时只标记为脏，由后台线程合并写入
+        if not (defer and self.write_behind):
+            self._save(chapter)
+            return True
+
+        key = (chapter.book_id, chapter.id)
+        flush_now = False
+        with self._lock:
+            state = self._dirty.get(key)
+            if state is None:
+                self._dirty[key] = [chapter, time.monotonic(), 1]
+            else:
+                state[0] = chapter
+                state[2] += 1
+                flush_now = state[2] >= self.flush_threshold
+            self.deferred_commits += 1
+            self._ensure_flusher()
+            self._flush_wakeup.notify()
+        if flush_now:
+            self.flush(chapter.book_id, chapter.id)
+        return False
+
+    def is_dirty(self, book_id, chapter_id):
+        with self._lock:
+            return (book_id, chapter_id) in self._dirty
+
+    def flush(self, book_id, chapter_id):
+        with self._lock:
+            state = self._dirty.get((book_id, chapter_id))
+        if state is None:
+            return False
+        self._save(state[0])
+        return True
+
+    def flush_all(self, exclude=None):
+        with self._lock:
+            chapters = [state[0] for key, state in self._dirty.items() if key != exclude]
+        for chapter in chapters:
+            try:
+                self._save(chapter)
+            except Exception:
+                traceback.print_exc()
+        return len(chapters)
+
+    def close(self):
+        # 进程退出时调用：停止后台线程并写入所有未保存的修改
+        with self._lock:
+            self._closed = True
+            self._flush_wakeup.notify_all()
+        self.flush_all()
+
+    def _save(self, chapter):
+        key = (chapter.book_id, chapter.id)
+        with self._lock:
+            state = self._dirty.pop(key, None)
+        try:
+            chapter.save()
+        except Exception:
+            # 保存失败时恢复脏标记，等待下一次重试
+            with self._lock:
+                self.flush_errors += 1
+                if state is not None and key not in self._dirty:
+                    self._dirty[key] = state
+            raise
+        with self._lock:
+            self.flushes += 1
+            self._evict()
+
+    def _ensure_flusher(self):
+        # 调用方需持有self._lock
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name='chapter-flusher', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                due = [state[0] for state in self._dirty.values() if now - state[1] >= self.flush_interval]
+                if not due:
+                    if self._dirty:
+                        oldest = min(state[1] for state in self._dirty.values())
+                        timeout = max(0.01, oldest + self.flush_interval - now)
+                    else:
+                        timeout = None
+                    self._flush_wakeup.wait(timeout)
+                    continue
+            for chapter in due:
+                try:
+                    self._save(chapter)
+                except Exception:
+                    traceback.print_exc()
+                    # 避免保存持续失败时空转
+                    time.sleep(self.flush_interval)
+
+    def total_bytes(self):
+        return sum(chapter.size_estimate for chapter in self._entries.values())
+
+    def _evict(self):
+        # 先按条目数淘汰，再按内存上限淘汰；最近使用的章节至少保留一个，脏章节跳过
+        total = self.total_bytes()
+        for key in list(self._entries)[:-1]:
+            if len(self._entries) <= self.max_entries and total <= self.max_bytes:
+                break
+            if key in self._dirty:
+                continue
+            chapter = self._entries.pop(key)
+            total -= chapter.size_estimate
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes(),
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'write_behind': self.write_behind,
+                'dirty': len(self._dirty),
+                'deferred_commits': self.deferred_commits,
+                'flushes': self.flushes,
+                'flush_errors': self.flush_errors
+            }
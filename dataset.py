@@ -0,0 +1,264 @@
+import hashlib
+import io
+import json
+import os
+import re
+import tarfile
+import time
+import wave
+
+# 训练数据导出
+# 把书中每个有录音的段落导出为（文本，音频）样本：
+#   manifest.jsonl      每行一个样本，音频以“分片文件:成员名”引用
+#   shard-000000.tar    WebDataset格式的分片，每个样本为<key>.wav、<key>.txt、<key>.json三个成员
+#   export_state.json   增量导出的状态
+#
+# 样本由调用方以生成器逐章提供，导出时只持有当前样本，不会把整本书读入内存。
+# 增量导出：按文本、录音文件名、大小和修改时间计算样本指纹，与上次导出相同的样本不再读取音频，
+# 只把变化和新增的样本写入新的分片；已删除的段落从清单中移除。
+# 分片写入后不再修改，旧分片中被替换的样本成为无用数据，不再包含有效样本的分片会被删除；
+# 需要时用full=True重新完整导出。
+
+STATE_FILENAME = 'export_state.json'
+MANIFEST_FILENAME = 'manifest.jsonl'
+STATE_VERSION = 1
+SHARD_PATTERN = re.compile(r'^shard-(\d{6})\.tar$')
+
+
+def shard_name(index):
+    return f'shard-{index:06d}.tar'
+
+
+def count_chars(text):
+    # 与章节字数统计一致：不计空白字符
+    return sum(1 for c in text if not c.isspace())
+
+
+def wav_info(audio):
+    # audio为文件路径或文件对象，返回 (时长, 采样率)，不是PCM WAV时返回None
+    try:
+        with wave.open(audio, 'rb') as f:
+            return f.getnframes() / f.getframerate(), f.getframerate()
+    except (wave.Error, EOFError, ZeroDivisionError):
+        return None
+
+
+class ShardWriter:
+    # 按大小切分的tar分片，超过shard_size字节后开始新的分片
+    def __init__(self, output_dir, first_index, shard_size):
+        self.output_dir = output_dir
+        self.index = first_index
+        self.shard_size = shard_size
+        self.written = []
+        self._tar = None
+        self._size = 0
+
+    def add(self, key, files):
+        # files: [(成员扩展名, bytes或文件路径)]；返回样本所在的分片文件名
+        if self._tar is None or self._size >= self.shard_size:
+            self._open()
+        for extension, content in files:
+            info = tarfile.TarInfo(f'{key}.{extension}')
+            info.mtime = int(time.time())
+            if isinstance(content, bytes):
+                info.size = len(content)
+                self._tar.addfile(info, io.BytesIO(content))
+            else:
+                info.size = os.path.getsize(content)
+                with open(content, 'rb') as f:
+                    self._tar.addfile(info, f)
+            self._size += info.size + 512
+        return self.written[-1]
+
+    def _open(self):
+        self.close()
+        if self.written:
+            self.index += 1
+        name = shard_name(self.index)
+        self._tar = tarfile.open(os.path.join(self.output_dir, name), 'w', format=tarfile.USTAR_FORMAT)
+        self._size = 0
+        self.written.append(name)
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    @property
+    def next_index(self):
+        return self.index + 1 if self.written else self.index
+
+
+def load_state(output_dir):
+    try:
+        with open(os.path.join(output_dir, STATE_FILENAME), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('version') == STATE_VERSION:
+            return state
+    except (OSError, ValueError):
+        pass
+    return {'version': STATE_VERSION, 'next_shard': 0, 'samples': {}}
+
+
+def write_atomic(path, write):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        write(f)
+    os.replace(temp_path, path)
+
+
+def export(samples, output_dir, shard_size=256 * 1024 * 1024, min_duration=0.0, max_duration=None,
+           min_chars=1, max_chars=None, full=False, log=None):
+    # samples: 可迭代的样本，{'book_id', 'chapter_id', 'paragraph_id', 'text', 'audio_path', 'audio_meta'}
+    # 返回本次导出的统计信息
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.monotonic()
+    state = {'version': STATE_VERSION, 'next_shard': 0, 'samples': {}} if full else load_state(output_dir)
+    previous = state['samples']
+
+    # 上次导出中断时留下的分片，以及完整导出时的所有旧分片
+    for name in os.listdir(output_dir):
+        match = SHARD_PATTERN.match(name)
+        if match and (full or int(match.group(1)) >= state['next_shard']):
+            os.remove(os.path.join(output_dir, name))
+
+    def accepted(chars, duration):
+        return (min_chars <= chars and (max_chars is None or chars <= max_chars)
+                and min_duration <= duration and (max_duration is None or duration <= max_duration))
+
+    writer = ShardWriter(output_dir, state['next_shard'], shard_size)
+    current = {}
+    stats = {'samples': 0, 'exported': 0, 'unchanged': 0, 'filtered': 0, 'missing': 0,
+             'removed': 0, 'audio_seconds': 0.0, 'bytes': 0}
+    try:
+        for sample in samples:
+            key = f"{sample['chapter_id']}_{sample['paragraph_id']}"
+            text = sample['text'].strip()
+            # 已打包的录音由调用方提供audio_signature和read_audio，否则按文件大小和修改时间判断是否变化
+            signature = sample.get('audio_signature')
+            if signature is None:
+                try:
+                    st = os.stat(sample['audio_path'])
+                except OSError:
+                    stats['missing'] += 1
+                    continue
+                signature = [st.st_size, st.st_mtime_ns]
+            fingerprint = hashlib.sha1(json.dumps(
+                [text, os.path.basename(sample['audio_path'])] + signature,
+                ensure_ascii=False).encode('utf-8')).hexdigest()
+
+            old = previous.get(key)
+            if old is not None and old['fingerprint'] == fingerprint:
+                # 过滤条件可能与上次不同，按记录的时长和字数重新判断
+                if not accepted(old['entry']['chars'], old['entry']['duration']):
+                    stats['filtered'] += 1
+                    continue
+                current[key] = old
+                stats['samples'] += 1
+                stats['unchanged'] += 1
+                stats['audio_seconds'] += old['entry']['duration']
+                continue
+
+            audio = sample['read_audio']() if 'read_audio' in sample else sample['audio_path']
+            if audio is None:
+                stats['missing'] += 1
+                continue
+
+            # 优先使用录音入库时记录的信息，没有时读取WAV文件头
+            meta = sample.get('audio_meta') or {}
+            if meta.get('duration') is not None and meta.get('sample_rate'):
+                duration, sample_rate = meta['duration'], meta['sample_rate']
+            else:
+                info = wav_info(io.BytesIO(audio) if isinstance(audio, bytes) else audio)
+                if info is None:
+                    stats['filtered'] += 1
+                    continue
+                duration, sample_rate = info
+
+            chars = count_chars(text)
+            if not accepted(chars, duration):
+                stats['filtered'] += 1
+                continue
+
+            entry = {
+                'key': key,
+                'book_id': sample['book_id'],
+                'chapter_id': sample['chapter_id'],
+                'paragraph_id': sample['paragraph_id'],
+                'text': text,
+                'chars': chars,
+                'duration': round(duration, 3),
+                'sample_rate': sample_rate
+            }
+            shard = writer.add(key, [
+                ('wav', audio),
+                ('txt', text.encode('utf-8')),
+                ('json', json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+            ])
+            entry['shard'] = shard
+            entry['audio'] = f'{shard}:{key}.wav'
+            current[key] = {'fingerprint': fingerprint, 'entry': entry}
+            stats['samples'] += 1
+            stats['exported'] += 1
+            stats['audio_seconds'] += entry['duration']
+            stats['bytes'] += len(audio) if isinstance(audio, bytes) else os.path.getsize(audio)
+            if log and stats['exported'] % 1000 == 0:
+                log(f"已导出 {stats['exported']} 个样本")
+    finally:
+        writer.close()
+
+    stats['removed'] = len(set(previous) - set(current))
+    state = {'version': STATE_VERSION, 'next_shard': writer.next_index, 'samples': current}
+
+    # 先写清单再写状态：中断时状态仍指向旧分片，下次导出会重新处理
+    def write_manifest(f):
+        for item in current.values():
+            f.write(json.dumps(item['entry'], ensure_ascii=False) + '\n')
+    write_atomic(os.path.join(output_dir, MANIFEST_FILENAME), write_manifest)
+    write_atomic(os.path.join(output_dir, STATE_FILENAME),
+                 lambda f: json.dump(state, f, ensure_ascii=False))
+
+    # 删除不再包含任何有效样本的旧分片
+    live = {item['entry']['shard'] for item in current.values()}
+    stats['shards_removed'] = 0
+    for name in os.listdir(output_dir):
+        if SHARD_PATTERN.match(name) and name not in live:
+            os.remove(os.path.join(output_dir, name))
+            stats['shards_removed'] += 1
+
+    stats['audio_seconds'] = round(stats['audio_seconds'], 1)
+    stats['shards_written'] = writer.written
+    stats['elapsed'] = round(time.monotonic() - start, 2)
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='导出书籍的（文本，音频）训练数据')
+    parser.add_argument('--book', type=str, required=True, help='书籍id')
+    parser.add_argument('--output', type=str, default=None, help='输出目录，默认为书籍目录下的dataset')
+    parser.add_argument('--shard-size', type=int, default=256, help='每个分片的大小（MB）')
+    parser.add_argument('--min-duration', type=float, default=0.0, help='最短音频时长（秒）')
+    parser.add_argument('--max-duration', type=float, default=None, help='最长音频时长（秒）')
+    parser.add_argument('--min-chars', type=int, default=1, help='最少字数')
+    parser.add_argument('--max-chars', type=int, default=None, help='最多字数')
+    parser.add_argument('--full', action='store_true', help='忽略上次导出的状态，重新完整导出')
+    args = parser.parse_args()
+
+    import app as webapp
+
+    if not webapp.Book.load(args.book):
+        parser.error('书籍不存在')
+    output_dir = args.output or webapp.dataset_dir(args.book)
+    result = export(
+        webapp.dataset_samples(args.book), output_dir,
+        shard_size=args.shard_size * 1024 * 1024,
+        min_duration=args.min_duration, max_duration=args.max_duration,
+        min_chars=args.min_chars, max_chars=args.max_chars,
+        full=args.full, log=print
+    )
+    print(f"导出完成：{result['samples']} 个样本（新导出 {result['exported']}，未变化 {result['unchanged']}，"
+          f"过滤 {result['filtered']}，缺少音频 {result['missing']}，移除 {result['removed']}），"
+          f"音频 {result['audio_seconds']} 秒，用时 {result['elapsed']} 秒 -> {output_dir}")
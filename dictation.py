@@ -0,0 +1,139 @@
+import threading
+import time
+import traceback
+import uuid
+import wave
+from array import array
+
+# 边录边识别的会话
+# 浏览器在录音过程中把16kHz单声道int16 PCM分块上传，每块带递增的序号：
+#   - 音频追加写入段落的WAV文件（录音结束后仍是一个完整的WAV，可用于训练）
+#   - 同时送入识别流，服务端在录音过程中就开始解码
+# 重复上传的块（网络重试）会被忽略；跳过序号的块会被拒绝，由客户端按顺序重传。
+# 超过idle_timeout秒没有收到数据的会话视为已放弃，下次创建会话时清理。
+
+SAMPLE_RATE = 16000
+
+
+class DictationSession:
+    def __init__(self, book_id, chapter_id, paragraph_id, audio_path, start_time=None):
+        self.id = str(uuid.uuid4())
+        self.book_id = book_id
+        self.chapter_id = chapter_id
+        self.paragraph_id = paragraph_id
+        self.audio_path = audio_path
+        self.start_time = start_time
+        self.stream = None
+        # 各阶段的耗时，见dictation_trace.py
+        self.trace = None
+        self.next_seq = 0
+        self.bytes = 0
+        self.peak = 0
+        self.last_active = time.monotonic()
+        self.finished = False
+        self._lock = threading.Lock()
+        self._wav = wave.open(audio_path, 'wb')
+        self._wav.setnchannels(1)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(SAMPLE_RATE)
+
+    def append(self, seq, data):
+        # 返回False表示重复的块；序号不连续时抛出ValueError
+        with self._lock:
+            if self.finished:
+                raise ValueError('录音会话已结束')
+            if seq < self.next_seq:
+                return False
+            if seq > self.next_seq:
+                raise ValueError(f'缺少第 {self.next_seq} 块音频')
+            if len(data) % 2:
+                raise ValueError('音频数据长度错误')
+            self._wav.writeframes(data)
+            if data:
+                samples = array('h')
+                samples.frombytes(data)
+                self.peak = max(self.peak, max(samples), -min(samples))
+            if self.stream is not None:
+                self.stream.feed(data)
+            self.next_seq += 1
+            self.bytes += len(data)
+            self.last_active = time.monotonic()
+            return True
+
+    def close(self):
+        # 结束写入，此后WAV文件完整可用
+        with self._lock:
+            if not self.finished:
+                self.finished = True
+                self._wav.close()
+
+    @property
+    def duration(self):
+        return self.bytes / 2 / SAMPLE_RATE
+
+    def audio_meta(self):
+        # 与录音入库时记录的音频信息格式一致
+        return {
+            'duration': round(self.duration, 3),
+            'sample_rate': SAMPLE_RATE,
+            'channels': 1,
+            'peak': round(min(self.peak / 32768.0, 1.0), 4)
+        }
+
+
+class DictationManager:
+    def __init__(self, idle_timeout=60.0):
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.started = 0
+        self.finished = 0
+        self.expired = 0
+
+    def add(self, session):
+        self.reap()
+        with self._lock:
+            self._sessions[session.id] = session
+            self.started += 1
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def pop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self.finished += 1
+            return session
+
+    def reap(self):
+        # 清理长时间没有数据的会话，归还其占用的识别客户端
+        now = time.monotonic()
+        with self._lock:
+            expired = [s for s in self._sessions.values() if now - s.last_active > self.idle_timeout]
+            for session in expired:
+                del self._sessions[session.id]
+                self.expired += 1
+        for session in expired:
+            abort(session)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': len(self._sessions),
+                'started': self.started,
+                'finished': self.finished,
+                'expired': self.expired
+            }
+
+
+def abort(session):
+    try:
+        session.close()
+        if session.stream is not None:
+            session.stream.abort()
+    except Exception:
+        traceback.print_exc()
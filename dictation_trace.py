@@ -0,0 +1,259 @@
+import datetime
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+# 录音识别各阶段的耗时
+# 原先只在段落中记录transcribe_delay（从开始录音到识别完成的总时间减去音频长度），
+# 看不出时间花在上传、识别进程还是保存章节上。这里为每次录音识别记录各阶段的时间点：
+#   record_stop       停止录音（浏览器上传的stop_time，没有时按开始时间加音频长度估算）
+#   upload_received   服务端收到完整的录音（边录边识别时为收到结束请求）
+#   audio_saved       录音已转换并保存（边录边识别时为WAV文件写完）
+#   recognizer_start  取得识别客户端，开始识别（边录边识别时为录音开始时打开识别流）
+#   first_output      识别客户端的第一个输出（中间结果或识别进程的第一行输出）
+#   final_text        得到最终识别结果
+#   chapter_saved     识别结果已写入章节
+# 相邻时间点之差即为各阶段的耗时，见SPANS；record_stop来自浏览器的时钟，
+# 与服务端时钟不一致时只影响upload阶段。
+# 每次识别写入一行JSON到滚动日志，超过max_bytes后轮转，保留backups个旧文件。
+
+STAGES = ('record_stop', 'upload_received', 'audio_saved', 'recognizer_start', 'first_output', 'final_text',
+          'chapter_saved')
+
+# (阶段名, 起点（取其中最晚的时间点）, 终点)；终点早于起点的阶段不计入，
+# 例如边录边识别时识别流在停止录音前就已打开，没有queue阶段
+SPANS = (
+    ('upload', ('record_stop',), 'upload_received'),
+    ('audio_save', ('upload_received',), 'audio_saved'),
+    ('queue', ('audio_saved',), 'recognizer_start'),
+    ('first_output', ('recognizer_start',), 'first_output'),
+    ('decode', ('audio_saved', 'recognizer_start'), 'final_text'),
+    ('chapter_save', ('final_text',), 'chapter_saved'),
+    ('total', ('record_stop',), 'chapter_saved'),
+)
+
+PERCENTILES = (50, 90, 99)
+
+LOG_FILENAME = 'dictation_trace.log'
+
+
+def client_time(value):
+    # 浏览器上传的毫秒时间戳转换为秒，无法解析时返回None
+    try:
+        return float(value) / 1000 if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+class Trace:
+    def __init__(self, book_id, chapter_id, paragraph_id, mode):
+        # mode：upload（录音结束后上传）、stream（边录边识别）、recognize（单独调用识别接口）
+        self.id = str(uuid.uuid4())
+        self.book_id = book_id
+        self.chapter_id = chapter_id
+        self.paragraph_id = paragraph_id
+        self.mode = mode
+        self.marks = {}
+        self.audio_duration = None
+        self.success = None
+
+    def mark(self, stage, at=None):
+        # 只记录第一次到达该时间点的时间，可以从任意线程调用
+        self.marks.setdefault(stage, time.time() if at is None else at)
+
+    def spans(self):
+        spans = {}
+        for name, starts, end in SPANS:
+            start_times = [self.marks[stage] for stage in starts if stage in self.marks]
+            if not start_times or end not in self.marks:
+                continue
+            seconds = self.marks[end] - max(start_times)
+            if seconds >= 0:
+                spans[name] = round(seconds, 4)
+        return spans
+
+    def to_dict(self):
+        finished = self.marks.get('chapter_saved') or max(self.marks.values(), default=time.time())
+        return {
+            'id': self.id,
+            'day': datetime.datetime.fromtimestamp(finished).strftime('%Y-%m-%d'),
+            'book_id': self.book_id,
+            'chapter_id': self.chapter_id,
+            'paragraph_id': self.paragraph_id,
+            'mode': self.mode,
+            'success': self.success,
+            'audio_duration': self.audio_duration,
+            'marks': {stage: round(t, 4) for stage, t in self.marks.items()},
+            'spans': self.spans()
+        }
+
+
+def percentile(sorted_values, p):
+    # 最近秩法，sorted_values需已排序
+    rank = math.ceil(p / 100.0 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize(values):
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = round(percentile(values, p) * 1000, 1)
+    return summary
+
+
+class TraceLog:
+    def __init__(self, path, max_bytes=5 * 1024 * 1024, backups=3):
+        # path为日志文件路径或返回路径的函数（书籍目录可能在启动后修改）
+        self._path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.recorded = 0
+        self.rotations = 0
+        self.errors = 0
+
+    @property
+    def path(self):
+        return self._path() if callable(self._path) else self._path
+
+    def record(self, trace):
+        line = json.dumps(trace.to_dict(), ensure_ascii=False) + '\n'
+        path = self.path
+        try:
+            with self._lock:
+                if os.path.exists(path) and os.path.getsize(path) + len(line) > self.max_bytes:
+                    self._rotate(path)
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+                self.recorded += 1
+        except OSError as e:
+            # 日志写入失败不影响识别结果
+            self.errors += 1
+            print(f'写入识别耗时日志失败：{str(e)}')
+
+    def _rotate(self, path):
+        # 调用方需持有self._lock
+        for i in range(self.backups, 0, -1):
+            source = path if i == 1 else f'{path}.{i - 1}'
+            if os.path.exists(source):
+                os.replace(source, f'{path}.{i}')
+        self.rotations += 1
+
+    def entries(self):
+        # 从最旧的文件开始逐行读取，跳过无法解析的行（例如写入中途退出）
+        path = self.path
+        files = [f'{path}.{i}' for i in range(self.backups, 0, -1)] + [path]
+        for name in files:
+            try:
+                f = open(name, 'r', encoding='utf-8')
+            except OSError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+    def report(self, book_id=None, days=None, mode=None):
+        # 按阶段、书籍和日期统计各阶段耗时的p50/p90/p99；days为最近几天（含今天）
+        since = None
+        if days:
+            since = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+        overall = {}
+        books = {}
+        by_day = {}
+        count = failed = 0
+        for entry in self.entries():
+            if book_id and entry.get('book_id') != book_id:
+                continue
+            if mode and entry.get('mode') != mode:
+                continue
+            if since and entry.get('day', '') < since:
+                continue
+            count += 1
+            if entry.get('success') is False:
+                failed += 1
+            for name, seconds in entry.get('spans', {}).items():
+                overall.setdefault(name, []).append(seconds)
+                books.setdefault(entry.get('book_id'), {}).setdefault(name, []).append(seconds)
+                by_day.setdefault(entry.get('day'), {}).setdefault(name, []).append(seconds)
+
+        span_names = [name for name, _, _ in SPANS]
+
+        def summarize_group(group):
+            return {name: summarize(group[name]) for name in span_names if name in group}
+
+        return {
+            'count': count,
+            'failed': failed,
+            'stages': summarize_group(overall),
+            'books': {bid: summarize_group(group) for bid, group in books.items()},
+            'days': {day: summarize_group(group) for day, group in sorted(by_day.items())}
+        }
+
+    def stats(self):
+        path = self.path
+        return {
+            'recorded': self.recorded,
+            'rotations': self.rotations,
+            'errors': self.errors,
+            'bytes': os.path.getsize(path) if os.path.exists(path) else 0
+        }
+
+
+def format_report(report, by='stage', titles=None):
+    # 命令行输出的表格
+    titles = titles or {}
+    lines = [f"共 {report['count']} 次识别，失败 {report['failed']} 次"]
+    header = f"{'阶段':<14}{'次数':>8}" + ''.join(f"{f'p{p}(ms)':>12}" for p in PERCENTILES)
+
+    def table(group):
+        rows = [header]
+        for name, summary in group.items():
+            rows.append(f"{name:<14}{summary['count']:>8}" +
+                        ''.join(f"{summary[f'p{p}_ms']:>12}" for p in PERCENTILES))
+        return rows
+
+    if by == 'stage':
+        lines += table(report['stages'])
+    else:
+        groups = report['books'] if by == 'book' else report['days']
+        for key, group in groups.items():
+            lines.append('')
+            lines.append(titles.get(key, key) if by == 'book' else key)
+            lines += table(group)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='统计录音识别各阶段耗时的p50/p90/p99')
+    parser.add_argument('--book', type=str, default=None, help='只统计这本书')
+    parser.add_argument('--days', type=int, default=None, help='只统计最近几天')
+    parser.add_argument('--mode', choices=('upload', 'stream', 'recognize'), default=None, help='只统计一种录音方式')
+    parser.add_argument('--by', choices=('stage', 'book', 'day'), default='stage', help='分组方式')
+    parser.add_argument('--json', action='store_true', help='输出JSON')
+    args = parser.parse_args()
+
+    import app as webapp
+
+    result = webapp.dictation_traces.report(args.book, args.days, args.mode)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        titles = {}
+        if args.by == 'book':
+            for bid in result['books']:
+                book = webapp.Book.load(bid)
+                if book:
+                    titles[bid] = book.title
+        print(format_report(result, args.by, titles))
@@ -18,15 +18,67 @@ def get_local_ip():
         # 如果获取失败，返回127.0.0.1
         return '127.0.0.1'
 
+CERT_FILE = 'localhost.crt'
+KEY_FILE = 'localhost.key'
+# 证书有效期，剩余有效期不足RENEW_BEFORE时重新生成
+CERT_VALID_DAYS = 30
+RENEW_BEFORE = datetime.timedelta(days=1)
+
+# 检查已有证书能否继续使用，可以使用时返回None，否则返回原因
+def cert_reuse_problem(cert_file, key_file, local_ip):
+    if not os.path.exists(cert_file) or not os.path.exists(key_file):
+        return "证书不存在"
+    
+    # 私钥必须与证书对应，ssl加载时会检查；比用cryptography读取RSA私钥快得多
+    try:
+        ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(cert_file, key_file)
+    except (ssl.SSLError, OSError) as e:
+        return f"证书或私钥无效（{str(e)}）"
+    
+    from cryptography import x509
+    
+    try:
+        with open(cert_file, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+    except Exception as e:
+        return f"证书无法读取（{str(e)}）"
+    
+    # 旧版本的cryptography只有不带时区的not_valid_after（UTC时间）
+    not_valid_after = getattr(cert, 'not_valid_after_utc', None)
+    if not_valid_after is None:
+        not_valid_after = cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+    if not_valid_after - datetime.datetime.now(datetime.timezone.utc) < RENEW_BEFORE:
+        return "证书即将过期"
+    
+    # 内网IP变动后需要重新生成，否则其他设备访问新地址时证书不匹配
+    try:
+        san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    except x509.ExtensionNotFound:
+        return "证书缺少地址信息"
+    if ipaddress.ip_address(local_ip) not in san.get_values_for_type(x509.IPAddress):
+        return f"内网IP已变为 {local_ip}"
+    return None
+
+# 证书仍然有效且包含当前内网IP时直接使用，否则重新生成；返回 (证书文件, 私钥文件, 是否重新生成)
+def ensure_self_signed_cert(local_ip=None):
+    local_ip = local_ip or get_local_ip()
+    problem = cert_reuse_problem(CERT_FILE, KEY_FILE, local_ip)
+    if problem is None:
+        print(f"使用已有的证书：{CERT_FILE} 和 {KEY_FILE}")
+        return CERT_FILE, KEY_FILE, False
+    print(f"需要重新生成证书：{problem}")
+    generate_self_signed_cert(local_ip)
+    return CERT_FILE, KEY_FILE, True
+
 # 生成自签名证书
-def generate_self_signed_cert():
-    cert_file = 'localhost.crt'
-    key_file = 'localhost.key'
+def generate_self_signed_cert(local_ip=None):
+    cert_file = CERT_FILE
+    key_file = KEY_FILE
     
     print("正在生成自签名证书...")
     
     # 获取当前的内网IP地址
-    local_ip = get_local_ip()
+    local_ip = local_ip or get_local_ip()
     
     # 使用ssl模块生成自签名证书
     from cryptography import x509
@@ -71,23 +123,25 @@ def generate_self_signed_cert():
     ).not_valid_before(
         datetime.datetime.now(datetime.UTC)
     ).not_valid_after(
-        # 证书有效期为1天，每次启动都生成新证书
-        datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=1)
+        # 启动时会复用未过期且IP未变的证书，见ensure_self_signed_cert
+        datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=CERT_VALID_DAYS)
     ).add_extension(
         x509.SubjectAlternativeName(san_entries),
         critical=False,
     ).sign(private_key, hashes.SHA256(), default_backend())
     
-    # 保存证书和私钥
-    with open(cert_file, "wb") as f:
+    # 保存证书和私钥，先写临时文件再替换，避免中途退出留下不配对的证书和私钥
+    with open(cert_file + ".tmp", "wb") as f:
         f.write(cert.public_bytes(serialization.Encoding.PEM))
     
-    with open(key_file, "wb") as f:
+    with open(key_file + ".tmp", "wb") as f:
         f.write(private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PrivateFormat.TraditionalOpenSSL,
             encryption_algorithm=serialization.NoEncryption(),
         ))
+    os.replace(key_file + ".tmp", key_file)
+    os.replace(cert_file + ".tmp", cert_file)
     
     print(f"自签名证书已生成：{cert_file} 和 {key_file}")
     print(f"证书包含地址：localhost, 127.0.0.1, {local_ip}")
@@ -0,0 +1,238 @@
+import json
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+
+# 后台任务队列和事件推送
+# 语音识别等耗时操作作为任务提交，接口立即返回任务id，不再占用Web服务器的请求线程；
+# 任务完成后通过EventBus以Server-Sent Events推送给订阅了该章节的编辑器。
+#
+# 任务分两个优先级：INTERACTIVE（编辑器中的录音识别）总是先于BATCH（批量重新识别等）执行，
+# 另外保留reserved个只处理INTERACTIVE任务的工作线程，交互式识别不会排在长时间的批量任务之后。
+
+INTERACTIVE = 0
+BATCH = 1
+
+
+class Job:
+    def __init__(self, func, args, kwargs, priority):
+        self.id = str(uuid.uuid4())
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'priority': 'interactive' if self.priority == INTERACTIVE else 'batch',
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class JobQueue:
+    def __init__(self, workers=2, reserved=1, max_pending=200, keep=1000):
+        # workers为工作线程总数，其中reserved个只处理INTERACTIVE任务
+        # 等待中的任务超过max_pending时拒绝提交；已完成的任务保留最近keep个供查询
+        self.workers = max(workers, reserved + 1)
+        self.reserved = reserved
+        self.max_pending = max_pending
+        self.keep = keep
+        self._queues = {INTERACTIVE: deque(), BATCH: deque()}
+        self._jobs = OrderedDict()
+        self._cond = threading.Condition()
+        self._threads = []
+
+        # 统计信息
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.running = 0
+
+    def submit(self, func, *args, priority=INTERACTIVE, **kwargs):
+        # 提交任务，队列已满时抛出queue.Full
+        job = Job(func, args, kwargs, priority)
+        with self._cond:
+            if sum(len(q) for q in self._queues.values()) >= self.max_pending:
+                self.rejected += 1
+                raise queue.Full('任务队列已满，请稍后再试')
+            self._ensure_workers()
+            self._queues[priority].append(job)
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.status in ('queued', 'running'):
+                    break
+                self._jobs.popitem(last=False)
+            self.submitted += 1
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def _ensure_workers(self):
+        # 调用方需持有self._cond
+        if self._threads:
+            return
+        for i in range(self.workers):
+            interactive_only = i < self.reserved
+            thread = threading.Thread(
+                target=self._worker, args=(interactive_only,),
+                name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self, interactive_only):
+        # 调用方需持有self._cond
+        if self._queues[INTERACTIVE]:
+            return self._queues[INTERACTIVE].popleft()
+        if not interactive_only and self._queues[BATCH]:
+            return self._queues[BATCH].popleft()
+        return None
+
+    def _worker(self, interactive_only):
+        while True:
+            with self._cond:
+                job = self._next_job(interactive_only)
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job(interactive_only)
+                job.status = 'running'
+                job.started = time.time()
+                self.running += 1
+
+            try:
+                job.result = job.func(job, *job.args, **job.kwargs)
+                job.status = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.status = 'failed'
+
+            with self._cond:
+                job.finished = time.time()
+                self.running -= 1
+                if job.status == 'done':
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            job._done.set()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'reserved_interactive': self.reserved,
+                'queued_interactive': len(self._queues[INTERACTIVE]),
+                'queued_batch': len(self._queues[BATCH]),
+                'running': self.running,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected
+            }
+
+
+class EventBus:
+    # 按频道（例如(book_id, chapter_id)）分发事件，每个订阅者一个有界队列
+    # 订阅者处理过慢、队列已满时丢弃新事件，客户端可以通过修订号发现并重新加载
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, channel):
+        q = queue.Queue(maxsize=self.max_queued)
+        with self._lock:
+            if self._closed:
+                q.put_nowait(None)
+            self._subscribers.setdefault(channel, []).append(q)
+        return q
+
+    def unsubscribe(self, channel, q):
+        with self._lock:
+            subscribers = self._subscribers.get(channel, [])
+            if q in subscribers:
+                subscribers.remove(q)
+            if not subscribers:
+                self._subscribers.pop(channel, None)
+
+    def publish(self, channel, event):
+        with self._lock:
+            if self._closed:
+                return
+            subscribers = list(self._subscribers.get(channel, []))
+            self.published += 1
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+
+    def stream(self, channel, keepalive=15.0):
+        # 生成Server-Sent Events格式的数据，空闲时定期发送注释行保持连接
+        q = self.subscribe(channel)
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event = q.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    # 服务器关闭，结束连接，客户端按retry间隔重连
+                    return
+                yield f'data: {json.dumps(event, ensure_ascii=False)}\n\n'
+        finally:
+            self.unsubscribe(channel, q)
+
+    def close(self):
+        # 关闭服务器时结束所有事件流，不让长连接拖住请求线程
+        with self._lock:
+            self._closed = True
+            subscribers = [q for channel in self._subscribers.values() for q in channel]
+        for q in subscribers:
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                # 队列已满时腾出一个位置，保证结束标记能送达
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._subscribers),
+                'subscribers': sum(len(s) for s in self._subscribers.values()),
+                'published': self.published,
+                'dropped': self.dropped
+            }
@@ -0,0 +1,73 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# 按键分配的锁
+# 每本书/每个章节一把可重入锁，不相关的章节可以并行保存，
+# 同一章节的“读取-修改-保存”在锁内串行执行。
+# 锁在没有持有者和等待者时自动回收，长时间运行也不会积累锁对象。
+
+
+class KeyedLocks:
+    def __init__(self):
+        # key -> [RLock, 引用计数]
+        self._locks = {}
+        self._guard = threading.Lock()
+        self._local = threading.local()
+
+        # 统计信息，用于观察锁竞争情况
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+
+        start = time.perf_counter()
+        contended = not entry[0].acquire(blocking=False)
+        if contended:
+            entry[0].acquire()
+        wait = time.perf_counter() - start
+
+        with self._guard:
+            self.acquisitions += 1
+            self.wait_total += wait
+            if contended:
+                self.contended += 1
+            if wait > self.wait_max:
+                self.wait_max = wait
+        # 记录当前线程累计的等锁时间，供请求级别的统计读取
+        self._local.wait = getattr(self._local, 'wait', 0.0) + wait
+
+        try:
+            yield wait
+        finally:
+            entry[0].release()
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def thread_wait(self, reset=False):
+        # 当前线程自上次重置以来的累计等锁时间（秒）
+        wait = getattr(self._local, 'wait', 0.0)
+        if reset:
+            self._local.wait = 0.0
+        return wait
+
+    def stats(self):
+        with self._guard:
+            return {
+                'active': len(self._locks),
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'wait_total': round(self.wait_total, 6),
+                'wait_avg': round(self.wait_total / self.acquisitions, 6) if self.acquisitions else 0.0,
+                'wait_max': round(self.wait_max, 6)
+            }
@@ -1,17 +1,23 @@
+import time
+
+# 启动计时从导入模块之前开始
+STARTED_AT = time.perf_counter()
+
 import os
 import sys
-import requests
 import socket
 import qrcode
 import subprocess
 import signal
+import threading
+import multiprocessing
 
 # 存储所有子进程
 child_processes = []
 
 # 信号处理函数，用于处理Ctrl+C
 
-def signal_handler(sig, frame):
+def stop_child_processes():
     print("\n正在关闭所有子进程...")
     # 终止所有子进程
     for process in child_processes:
@@ -22,6 +28,9 @@ def signal_handler(sig, frame):
             # 如果进程在5秒内没有终止，强制杀死
             process.kill()
     print("所有子进程已关闭，程序退出。")
+
+def signal_handler(sig, frame):
+    stop_child_processes()
     sys.exit(0)
 
 # 注册信号处理函数
@@ -41,6 +50,66 @@ def get_local_ip():
         # 如果获取失败，返回127.0.0.1
         return '127.0.0.1'
 
+# 记录启动各阶段的耗时，服务器开始接受连接后输出，便于发现启动变慢
+class StartupTimer:
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.last = started_at
+        self.phases = []
+
+    def mark(self, name):
+        # 记录从上一阶段结束到现在的耗时
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.started_at
+
+    def report(self):
+        print(f"启动耗时 {self.total():.2f} 秒：")
+        for name, seconds in self.phases:
+            print(f"  {name:<12}{seconds * 1000:>8.0f} ms")
+
+    def as_dict(self):
+        return {'total': round(self.total(), 3), 'phases': [[name, round(seconds, 3)] for name, seconds in self.phases]}
+
+# 检查更新，在后台线程中执行，网络慢或离线时不影响启动
+def check_update(current_version, github_repo):
+    import requests
+    try:
+        # 调用 GitHub API 获取最新发布版本
+        response = requests.get(
+            f"https://api.github.com/repos/{github_repo}/releases/latest",
+            timeout=3,
+            headers={"User-Agent": "DBInputNote-Client"}
+        )
+        if response.status_code == 200:
+            latest_data = response.json()
+            latest_version = latest_data.get("tag_name", "").lstrip('v')  # 去除版本号前缀的 'v'
+            
+            # 版本号对比（简单数字对比，适用于 x.y.z 格式）
+            def version_to_tuple(version_str):
+                return tuple(map(int, version_str.split('.')))
+            
+            current_tuple = version_to_tuple(current_version)
+            latest_tuple = version_to_tuple(latest_version)
+            
+            if latest_tuple > current_tuple:
+                print(f"\n发现新版本！当前版本 v{current_version} → 最新版本 v{latest_version}")
+                print(f"下载地址：{latest_data.get('html_url', f'https://github.com/{github_repo}/releases')}")
+                print(f"更新日志：{latest_data.get('body', '请前往 GitHub 查看详细更新日志')[:200]}...\n")
+            else:
+                print("\n当前已是最新版本！\n")
+        else:
+            print("\n更新检查失败：无法获取最新版本信息\n")
+    except requests.exceptions.RequestException as e:
+        # 网络错误/超时，不影响主程序
+        print(f"\n更新检查失败：{str(e)}（忽略，继续运行）\n")
+    except ValueError as e:
+        # 返回内容或版本号格式不对
+        print(f"\n更新检查失败：{str(e)}（忽略，继续运行）\n")
+
 # 生成终端二维码
 def generate_cli_qrcode(data):
     try:
@@ -58,55 +127,43 @@ def generate_cli_qrcode(data):
         print("无法生成终端二维码，HTTPS访问地址：", data)
 
 if __name__ == '__main__':
+    # 录音入库使用进程池，打包为exe后子进程也从本程序启动，需要先交给multiprocessing处理
+    multiprocessing.freeze_support()
+    startup = StartupTimer(STARTED_AT)
+    startup.mark('导入模块')
+    
+    # 解析命令行参数
+    import argparse
+    from server import MODES
+    parser = argparse.ArgumentParser(description='DBInputNote')
+    parser.add_argument('--port', type=int, default=5001, help='服务器端口')
+    parser.add_argument('--server', choices=MODES, default='production', help='production为cheroot多线程服务器，dev为Flask开发服务器')
+    parser.add_argument('--threads', type=int, default=32, help='生产模式的请求线程数')
+    parser.add_argument('--timeout', type=float, default=30.0, help='生产模式下空闲连接的超时时间（秒）')
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help='关闭时等待进行中请求完成的最长时间（秒）')
+    parser.add_argument('--no-update-check', action='store_true', help='不检查更新')
+    args = parser.parse_args()
+    
     # 配置参数
     CURRENT_VERSION = "0.0.4"
     GITHUB_REPO = "ChaserSu/DBInputNote"  # GitHub 用户名/仓库名
-    port = 5001
+    port = args.port
     
     print("正在启动DBInputNote...")
     
-    # 每次启动都生成新证书，防止IP内网变动
-    from generate_cert import generate_self_signed_cert
-    generate_self_signed_cert()
-    
     # 获取本地IP和访问URL
     local_ip = get_local_ip()
     https_url = f"https://{local_ip}:{port}"
+    startup.mark('获取IP')
+    
+    # 证书未过期且包含当前内网IP时直接使用，内网IP变动或快过期时重新生成
+    from generate_cert import ensure_self_signed_cert
+    cert_file, key_file, cert_generated = ensure_self_signed_cert(local_ip)
+    startup.mark('生成证书' if cert_generated else '检查证书')
     
     # 生成并输出终端二维码（使用HTTPS）
     generate_cli_qrcode(https_url)
-    
-    # 检查更新
-    print("正在检查更新...")
-    try:
-        # 调用 GitHub API 获取最新发布版本
-        response = requests.get(
-            f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest",
-            timeout=3,
-            headers={"User-Agent": "DBInputNote-Client"}
-        )
-        if response.status_code == 200:
-            latest_data = response.json()
-            latest_version = latest_data.get("tag_name", "").lstrip('v')  # 去除版本号前缀的 'v'
-            
-            # 版本号对比（简单数字对比，适用于 x.y.z 格式）
-            def version_to_tuple(version_str):
-                return tuple(map(int, version_str.split('.')))
-            
-            current_tuple = version_to_tuple(CURRENT_VERSION)
-            latest_tuple = version_to_tuple(latest_version)
-            
-            if latest_tuple > current_tuple:
-                print(f"发现新版本！当前版本 v{CURRENT_VERSION} → 最新版本 v{latest_version}")
-                print(f"下载地址：{latest_data.get('html_url', f'https://github.com/{GITHUB_REPO}/releases')}")
-                print(f"更新日志：{latest_data.get('body', '请前往 GitHub 查看详细更新日志')[:200]}...\n")
-            else:
-                print("当前已是最新版本！\n")
-        else:
-            print("更新检查失败：无法获取最新版本信息\n")
-    except requests.exceptions.RequestException as e:
-        # 网络错误/超时，不影响主程序
-        print(f"更新检查失败：{str(e)}（忽略，继续运行）\n")
+    startup.mark('二维码')
     
     # 输出启动信息
     print(f"服务器已启动！")
@@ -114,13 +171,8 @@ if __name__ == '__main__':
     print(f"注意，跨设备访问需在同一局域网下")
     print(f"当前版本 v{CURRENT_VERSION}，项目地址：https://github.com/{GITHUB_REPO}")
     print(f"首次访问HTTPS会提示证书不安全，点击'高级'->'继续访问'即可")
-    
-    # 使用新生成的证书文件
-    cert_file = 'localhost.crt'
-    key_file = 'localhost.key'
-    
-    # 直接使用新生成的证书，无需检查存在性，因为我们已经生成了
-    print(f"使用新生成的证书文件：{cert_file} 和 {key_file}")
+    if cert_generated:
+        print(f"证书已重新生成，之前信任过的设备需要再确认一次")
     
     # 启动CW/start_server.exe子进程
     try:
@@ -139,35 +191,49 @@ if __name__ == '__main__':
         print("CW服务器已启动")
     except Exception as e:
         print(f"启动CW服务器失败：{str(e)}")
+    startup.mark('启动CW服务器')
     
     try:
         # 直接导入app.py中的Flask应用
         import app
+        startup.mark('导入app')
+        app.start_background_workers(port)
         
         # 设置app的配置
         app.app.config['SSL_CERT'] = cert_file
         app.app.config['SSL_KEY'] = key_file
         
+        # 服务器开始接受连接后输出启动耗时，再在后台检查更新
+        def on_ready():
+            if 'STARTUP' in app.app.config:
+                return
+            startup.mark('启动服务器')
+            startup.report()
+            app.app.config['STARTUP'] = startup.as_dict()
+            if not args.no_update_check:
+                threading.Thread(target=check_update, args=(CURRENT_VERSION, GITHUB_REPO),
+                                 name='update-check', daemon=True).start()
+        
         print(f"正在启动HTTPS服务器...")
         
-        # 直接运行Flask应用，使用HTTPS
+        # 运行Flask应用，使用HTTPS；关闭时先结束事件推送的长连接，再等待进行中的请求完成
+        import server
+        server_options = dict(mode=args.server, threads=args.threads, timeout=args.timeout,
+                              drain_timeout=args.drain_timeout, on_stop=app.event_bus.close, on_ready=on_ready)
         try:
-            import ssl
-            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            ssl_context.load_cert_chain(cert_file, key_file)
             print(f"\napp.py HTTPS运行模式")
             print(f"HTTPS访问地址：https://0.0.0.0:{port}")
             print(f"使用证书：{cert_file} 和 {key_file}")
-            app.app.run(debug=False, host='0.0.0.0', port=port, ssl_context=ssl_context)
+            server.run(app.app, '0.0.0.0', port, cert_file, key_file, **server_options)
         except Exception as e:
             print(f"HTTPS启动失败：{str(e)}")
             print("正在尝试回退到HTTP模式...")
             # 回退到HTTP模式
             print(f"HTTP访问地址：http://0.0.0.0:{port}")
-            app.app.run(debug=False, host='0.0.0.0', port=port)
+            server.run(app.app, '0.0.0.0', port, **server_options)
+        stop_child_processes()
         
     except Exception as e:
         print(f"启动应用失败：{str(e)}")
         print("程序启动失败，即将退出...")
         sys.exit(1)
-
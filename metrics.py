@@ -0,0 +1,259 @@
+import bisect
+import json
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# 请求耗时统计
+# 每个请求的耗时按阶段拆分，按接口汇总为直方图，由 /metrics 以Prometheus文本格式输出：
+#   load        解析请求JSON，从磁盘或数据库加载章节和书籍
+#   save        写入章节和书籍（JSON序列化和写盘）
+#   serialize   生成JSON响应
+#   lock_wait   等待书籍/章节锁
+#   subprocess  等待录音转换进程和语音识别
+#   mutation    其余时间，即内存中的读取和修改
+# 阶段时间互不重叠：嵌套的阶段（例如保存时加载书籍信息）只计入内层，
+# 阶段内等锁的时间（例如保存时获取章节锁）只计入lock_wait。
+# 后台线程（写回、压缩、识别任务）中的调用不属于任何请求，不计入。
+#
+# 超过slow_threshold秒的请求输出一行日志，最近的记录保存在内存中，
+# 设置了slow_log时同时以JSON行追加到该文件。
+#
+# /metrics中附加的运行统计（/api/stats中的数值）按字段名区分：COUNTER_KEYS中的累计值输出为counter
+# （名称不以_total结尾时加上_total），其余为gauge。
+
+PHASES = ('load', 'mutation', 'save', 'serialize', 'lock_wait', 'subprocess')
+
+# 直方图的桶上限（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = 'dbinputnote'
+
+# /api/stats中只增不减的累计值
+COUNTER_KEYS = frozenset((
+    'hits', 'misses', 'evictions', 'invalidations', 'deferred_commits', 'flushes', 'flush_errors',
+    'submitted', 'completed', 'failed', 'rejected', 'published', 'dropped', 'processed', 'audio_seconds',
+    'acquisitions', 'contended', 'wait_total'
+))
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class RequestMetrics:
+    def __init__(self, lock_wait=None, buckets=DEFAULT_BUCKETS, slow_threshold=1.0, slow_log=None, slow_keep=100):
+        # lock_wait(reset) -> 当前线程累计的等锁时间（秒），见KeyedLocks.thread_wait
+        self.lock_wait = lock_wait
+        self.buckets = tuple(buckets)
+        self.slow_threshold = slow_threshold
+        self.slow_log = slow_log
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # endpoint -> Histogram；(endpoint, phase) -> Histogram；(endpoint, method, status) -> 次数
+        self._durations = {}
+        self._phases = {}
+        self._requests = {}
+        self._slow_counts = {}
+        self._recent_slow = deque(maxlen=slow_keep)
+
+    # 请求开始和结束，由Flask的before_request/after_request调用
+    def begin(self):
+        if self.lock_wait:
+            self.lock_wait(True)
+        self._local.record = {'start': time.perf_counter(), 'phases': dict.fromkeys(PHASES, 0.0),
+                              'nested': 0.0, 'nested_wait': 0.0}
+
+    def active(self):
+        return getattr(self._local, 'record', None) is not None
+
+    def finish(self, endpoint, method, status, path=''):
+        record = getattr(self._local, 'record', None)
+        if record is None:
+            return None
+        self._local.record = None
+        total = time.perf_counter() - record['start']
+        phases = record['phases']
+        if self.lock_wait:
+            phases['lock_wait'] = self.lock_wait(True)
+        phases['mutation'] = max(0.0, total - sum(v for k, v in phases.items() if k != 'mutation'))
+        endpoint = endpoint or 'unknown'
+
+        slow = bool(self.slow_threshold) and total >= self.slow_threshold
+        with self._lock:
+            histogram = self._durations.get(endpoint)
+            if histogram is None:
+                histogram = self._durations[endpoint] = Histogram(self.buckets)
+            histogram.observe(total)
+            for phase, seconds in phases.items():
+                key = (endpoint, phase)
+                histogram = self._phases.get(key)
+                if histogram is None:
+                    histogram = self._phases[key] = Histogram(self.buckets)
+                histogram.observe(seconds)
+            key = (endpoint, method, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if slow:
+                self._slow_counts[endpoint] = self._slow_counts.get(endpoint, 0) + 1
+
+        if slow:
+            self._log_slow(endpoint, method, status, path, total, phases)
+        return total
+
+    def _log_slow(self, endpoint, method, status, path, total, phases):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'endpoint': endpoint,
+            'method': method,
+            'path': path,
+            'status': status,
+            'ms': round(total * 1000, 1),
+            'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in phases.items()}
+        }
+        with self._lock:
+            self._recent_slow.append(entry)
+        # 按耗时从大到小列出各阶段，一眼看出慢在磁盘、JSON还是锁
+        parts = '，'.join(f'{phase} {ms:.0f} ms' for phase, ms in
+                         sorted(entry['phases_ms'].items(), key=lambda item: -item[1]) if ms >= 1)
+        print(f"慢请求 {entry['ms']:.0f} ms：{method} {path}" + (f'（{parts}）' if parts else ''))
+        if self.slow_log:
+            try:
+                with open(self.slow_log, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            except OSError as e:
+                print(f'写入慢请求日志失败：{str(e)}')
+
+    def _waited(self):
+        return self.lock_wait(False) if self.lock_wait else 0.0
+
+    @contextmanager
+    def phase(self, name):
+        # 把代码块的耗时计入当前请求的某个阶段，不在请求中时不做任何事
+        # 扣除嵌套阶段的耗时和块内等锁的时间（嵌套阶段内的等锁已包含在嵌套阶段的耗时中）
+        record = getattr(self._local, 'record', None)
+        if record is None:
+            yield
+            return
+        outer_nested, outer_nested_wait = record['nested'], record['nested_wait']
+        record['nested'] = record['nested_wait'] = 0.0
+        start = time.perf_counter()
+        start_wait = self._waited()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            waited = self._waited() - start_wait
+            own_wait = waited - record['nested_wait']
+            record['phases'][name] += max(0.0, elapsed - record['nested'] - own_wait)
+            record['nested'] = outer_nested + elapsed
+            record['nested_wait'] = outer_nested_wait + waited
+
+    def timed(self, name):
+        # 装饰器形式的phase
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self, gauges=None, counters=None):
+        # Prometheus文本格式；gauges和counters为 {名称: 数值} 的附加指标，counter的名称加上_total
+        lines = []
+        with self._lock:
+            durations = sorted(self._durations.items())
+            phases = sorted(self._phases.items())
+            requests = sorted(self._requests.items())
+            slow_counts = sorted(self._slow_counts.items())
+            histograms = [
+                (f'{PREFIX}_request_duration_seconds', '请求总耗时',
+                 [({'endpoint': endpoint}, h.counts[:], h.sum, h.count) for endpoint, h in durations]),
+                (f'{PREFIX}_request_phase_seconds', '请求各阶段的耗时',
+                 [({'endpoint': endpoint, 'phase': phase}, h.counts[:], h.sum, h.count)
+                  for (endpoint, phase), h in phases]),
+            ]
+
+        for name, help_text, series in histograms:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, counts, total, count in series:
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_labels(**labels, le=repr(bound))} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {count}')
+                lines.append(f'{name}_sum{_labels(**labels)} {_format_value(total)}')
+                lines.append(f'{name}_count{_labels(**labels)} {count}')
+
+        name = f'{PREFIX}_requests_total'
+        lines.append(f'# HELP {name} 请求数')
+        lines.append(f'# TYPE {name} counter')
+        for (endpoint, method, status), count in requests:
+            lines.append(f'{name}{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+        name = f'{PREFIX}_slow_requests_total'
+        lines.append(f'# HELP {name} 超过阈值的慢请求数')
+        lines.append(f'# TYPE {name} counter')
+        for endpoint, count in slow_counts:
+            lines.append(f'{name}{_labels(endpoint=endpoint)} {count}')
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f'# TYPE {PREFIX}_{name} gauge')
+            lines.append(f'{PREFIX}_{name} {_format_value(value)}')
+        for name, value in sorted((counters or {}).items()):
+            name = name if name.endswith('_total') else f'{name}_total'
+            lines.append(f'# TYPE {PREFIX}_{name} counter')
+            lines.append(f'{PREFIX}_{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': sum(self._requests.values()),
+                'slow_requests': sum(self._slow_counts.values()),
+                'slow_threshold': self.slow_threshold,
+                'recent_slow': list(self._recent_slow)[-20:]
+            }
+
+
+def flatten_stats(stats, prefix=''):
+    # 把/api/stats中的统计信息展开为 (gauges, counters)，都是 {名称: 数值}，只保留数值
+    gauges, counters = {}, {}
+    for key, value in stats.items():
+        name = re.sub(r'[^a-zA-Z0-9_]', '_', f'{prefix}_{key}' if prefix else str(key))
+        if isinstance(value, dict):
+            nested_gauges, nested_counters = flatten_stats(value, name)
+            gauges.update(nested_gauges)
+            counters.update(nested_counters)
+        elif isinstance(value, (int, float)):
+            (counters if key in COUNTER_KEYS and not isinstance(value, bool) else gauges)[name] = value
+    return gauges, counters
@@ -0,0 +1,123 @@
+import json
+import os
+import queue
+import threading
+import traceback
+
+# 章节操作日志
+# 操作日志模式下，章节的每次修改以一行JSON追加到章节目录下的ops.log，
+# 加载时在content.json快照的基础上重放日志，后台压缩线程再把日志折叠回快照。
+#
+# 每条记录都有递增的seq，content.json中的log_seq表示快照已包含到哪一条，
+# 重放时跳过seq <= log_seq的记录，因此“写快照 -> 清空日志”之间崩溃也不会重复应用。
+#
+# 记录格式（index为段落在列表中的位置，结尾段落块始终在最后，不计入操作）：
+#   {"seq": 1, "op": "add", "index": 3, "paragraph": {...}}
+#   {"seq": 2, "op": "update", "id": "...", "fields": {"text": "..."}}
+#   {"seq": 3, "op": "move", "id": "...", "index": 0}
+#   {"seq": 4, "op": "delete", "id": "..."}
+#   {"seq": 5, "op": "audio", "id": "...", "audio": "xxx.wav"}
+
+LOG_FILENAME = 'ops.log'
+
+
+def find_index(paragraphs, paragraph_id):
+    for i, p in enumerate(paragraphs):
+        if p['id'] == paragraph_id:
+            return i
+    return -1
+
+
+def apply_op(paragraphs, op):
+    # 把一条操作应用到段落列表上，找不到目标段落时忽略该操作
+    kind = op['op']
+    if kind == 'add':
+        paragraph = dict(op['paragraph'])
+        if find_index(paragraphs, paragraph['id']) == -1:
+            index = min(max(op.get('index', len(paragraphs)), 0), len(paragraphs))
+            paragraphs.insert(index, paragraph)
+        return
+
+    index = find_index(paragraphs, op['id'])
+    if index == -1:
+        return
+    if kind == 'update':
+        paragraphs[index].update(op['fields'])
+    elif kind == 'audio':
+        paragraphs[index]['audio'] = op['audio']
+        if op.get('audio_meta'):
+            paragraphs[index]['audio_meta'] = op['audio_meta']
+        else:
+            paragraphs[index].pop('audio_meta', None)
+    elif kind == 'move':
+        paragraph = paragraphs.pop(index)
+        new_index = min(max(op['index'], 0), len(paragraphs))
+        paragraphs.insert(new_index, paragraph)
+    elif kind == 'delete':
+        del paragraphs[index]
+
+
+def read_ops(log_file, after_seq=0):
+    # 逐行读取操作记录；崩溃时最后一行可能只写了一半，遇到无法解析的行即停止
+    if not os.path.exists(log_file):
+        return
+    with open(log_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                op = json.loads(line)
+            except ValueError:
+                break
+            if op.get('seq', 0) > after_seq:
+                yield op
+
+
+def append_ops(log_file, ops, fsync=False):
+    # 追加写入操作记录，返回写入的字节数
+    data = ''.join(json.dumps(op, ensure_ascii=False) + '\n' for op in ops).encode('utf-8')
+    with open(log_file, 'ab') as f:
+        f.write(data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    return len(data)
+
+
+def truncate(log_file):
+    if os.path.exists(log_file):
+        with open(log_file, 'wb'):
+            pass
+
+
+class Compactor:
+    # 后台压缩线程：日志超过阈值的章节被放入队列，由线程调用chapter.compact()写回快照
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.compactions = 0
+
+    def schedule(self, chapter):
+        key = (chapter.book_id, chapter.id)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='oplog-compactor', daemon=True)
+                self._thread.start()
+        self._queue.put(chapter)
+
+    def _run(self):
+        while True:
+            chapter = self._queue.get()
+            with self._lock:
+                self._pending.discard((chapter.book_id, chapter.id))
+            try:
+                if chapter.compact():
+                    self.compactions += 1
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,298 @@
+import argparse
+import datetime
+import queue
+import sys
+import threading
+import time
+import traceback
+import unicodedata
+import uuid
+
+# 批量重新识别
+# 更换识别模型后，对一个章节、一本书或整个书库中所有有录音的段落重新识别。
+# 识别结果按标签保存在段落的asr字段中（paragraph['asr'][tag]），不覆盖作者的文本；
+# 同一标签下已经识别过当前录音文件的段落会被跳过，中断后用同一标签重新运行即可继续。
+#
+# 每条结果同时记录与作者文本比较的字错误率（CER，中文按字而不是按词计算），
+# 汇总后可以比较不同模型在整本书上的识别效果。
+#
+# 识别作为BATCH优先级的任务提交到任务队列，同时进行的识别不超过workers个，
+# 编辑器中的录音识别不会排在批量识别之后。
+#
+# 命令行直接读写书籍目录，服务器正在运行时它缓存中的章节会与命令行的修改互相覆盖，
+# 因此发现服务器正在运行时拒绝执行，改为通过POST /api/recognition-runs在服务器中运行。
+#
+# 命令行用法：
+#   python rerecognize.py --tag 模型名 [--book 书籍id [--chapter 章节id]] [--workers 4] [--force]
+#   python rerecognize.py --report 模型名 [模型名 ...] [--book 书籍id]
+
+
+def normalize_text(text):
+    # 比较前去掉空白和标点，英文统一为小写
+    return [c for c in (text or '').lower()
+            if not c.isspace() and not unicodedata.category(c).startswith(('P', 'S'))]
+
+
+def edit_distance(reference, hypothesis):
+    previous = list(range(len(hypothesis) + 1))
+    for i, r in enumerate(reference, 1):
+        current = [i]
+        for j, h in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (r != h)))
+        previous = current
+    return previous[-1]
+
+
+def score(reference, hypothesis):
+    # 返回 (错误字数, 参考文本字数)
+    reference = normalize_text(reference)
+    return edit_distance(reference, normalize_text(hypothesis)), len(reference)
+
+
+def is_current(target, tag):
+    # 段落在该标签下是否已经识别过当前的录音文件
+    entry = (target.get('asr') or {}).get(tag)
+    return bool(entry) and entry.get('audio') == target['audio']
+
+
+def summarize(tag, targets):
+    # 汇总已保存的识别结果，不重新识别
+    recognized = errors = chars = 0
+    audio_seconds = 0.0
+    for target in targets:
+        if not is_current(target, tag):
+            continue
+        entry = target['asr'][tag]
+        recognized += 1
+        errors += entry.get('errors', 0)
+        chars += entry.get('chars', 0)
+        audio_seconds += entry.get('duration') or 0
+    return {
+        'tag': tag,
+        'paragraphs': len(targets),
+        'recognized': recognized,
+        'audio_seconds': round(audio_seconds, 1),
+        'cer': round(errors / chars, 4) if chars else None
+    }
+
+
+class RecognitionRun:
+    def __init__(self, tag, targets, recognize, store, submit, workers=2, force=False, requested_workers=None):
+        # targets  需要识别的段落：{'book_id', 'chapter_id', 'paragraph_id', 'audio', 'audio_path', 'text', 'asr'}
+        # recognize(audio_path) -> {'text': 识别结果, 'duration': 音频长度（秒）}
+        # store(target, tag, entry) -> 是否已保存（录音在识别期间被替换时返回False）
+        # submit(func, *args) -> 任务，func(job, *args)在任务队列中执行；队列已满时抛出queue.Full
+        # requested_workers  调用方请求的同时识别数，workers因任务队列的工作线程数受限时记录原来的请求
+        self.id = str(uuid.uuid4())
+        self.tag = tag
+        self.targets = targets
+        self.recognize = recognize
+        self.store = store
+        self.submit = submit
+        self.workers = max(1, workers)
+        self.requested_workers = requested_workers or self.workers
+        self.force = force
+        self.status = 'queued'
+        self._slots = threading.Semaphore(self.workers)
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+
+        # 进度和统计
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.completed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+        self.errors = 0
+        self.chars = 0
+        self.recent_errors = []
+
+    def start(self):
+        thread = threading.Thread(target=self._drive, name=f'recognition-run-{self.id[:8]}', daemon=True)
+        thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _drive(self):
+        self.started = time.time()
+        self.status = 'running'
+        try:
+            for target in self.targets:
+                if self._cancelled.is_set():
+                    break
+                if not self.force and is_current(target, self.tag):
+                    with self._lock:
+                        self.skipped += 1
+                    continue
+                self._slots.acquire()
+                while True:
+                    try:
+                        self.submit(self._process, target)
+                        break
+                    except queue.Full:
+                        # 任务队列已满时等待，不放弃
+                        if self._cancelled.wait(1.0):
+                            self._slots.release()
+                            break
+                    except Exception:
+                        self._slots.release()
+                        raise
+            # 等待已提交的识别全部完成
+            for _ in range(self.workers):
+                self._slots.acquire()
+            self.status = 'cancelled' if self._cancelled.is_set() else 'done'
+        except Exception:
+            traceback.print_exc()
+            self.status = 'failed'
+        finally:
+            self.finished = time.time()
+            self._done.set()
+
+    def _process(self, job, target):
+        try:
+            result = self.recognize(target['audio_path'])
+            errors, chars = score(target['text'], result['text'])
+            entry = {
+                'text': result['text'],
+                'audio': target['audio'],
+                'duration': result.get('duration'),
+                'errors': errors,
+                'chars': chars,
+                'cer': round(errors / chars, 4) if chars else None,
+                'recognized_at': datetime.datetime.now().isoformat()
+            }
+            stored = self.store(target, self.tag, entry)
+            with self._lock:
+                if stored:
+                    self.completed += 1
+                    self.audio_seconds += result.get('duration') or 0
+                    self.errors += errors
+                    self.chars += chars
+                else:
+                    self.skipped += 1
+            return entry
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self.recent_errors = (self.recent_errors + [
+                    {'paragraph_id': target['paragraph_id'], 'message': str(e)}])[-10:]
+            return None
+        finally:
+            self._slots.release()
+
+    def to_dict(self):
+        with self._lock:
+            end = self.finished or time.time()
+            elapsed = end - self.started if self.started else 0
+            processed = self.completed + self.skipped + self.failed
+            return {
+                'id': self.id,
+                'tag': self.tag,
+                'status': self.status,
+                'workers': self.workers,
+                'requested_workers': self.requested_workers,
+                'total': len(self.targets),
+                'completed': self.completed,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'progress': round(processed / len(self.targets), 4) if self.targets else 1.0,
+                'audio_seconds': round(self.audio_seconds, 1),
+                'elapsed': round(elapsed, 1),
+                # 吞吐量：每秒墙钟时间识别的音频秒数
+                'throughput': round(self.audio_seconds / elapsed, 2) if elapsed else 0,
+                'cer': round(self.errors / self.chars, 4) if self.chars else None,
+                'recent_errors': list(self.recent_errors)
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量重新识别段落录音')
+    parser.add_argument('--tag', help='识别结果的标签，例如模型名称')
+    parser.add_argument('--book', help='书籍id，不指定时处理整个书库')
+    parser.add_argument('--chapter', help='章节id，需要同时指定--book')
+    parser.add_argument('--workers', type=int, default=2, help='同时进行的识别数')
+    parser.add_argument('--force', action='store_true', help='重新识别已有结果的段落')
+    parser.add_argument('--backend', help='语音识别后端，默认与app.py一致')
+    parser.add_argument('--server', help='CW服务端地址，默认与app.py一致')
+    parser.add_argument('--report', nargs='+', metavar='TAG', help='只汇总已保存的识别结果')
+    args = parser.parse_args()
+    if not args.tag and not args.report:
+        parser.error('需要指定--tag或--report')
+    if args.chapter and not args.book:
+        parser.error('--chapter需要同时指定--book')
+
+    import app as webapp
+    import asr
+    import jobs
+
+    if args.tag:
+        server = webapp.running_server()
+        if server:
+            print(f"服务器正在使用同一书库（进程 {server['pid']}，端口 {server['port']}），"
+                  f"命令行写入的识别结果会与服务器缓存中的章节互相覆盖。\n"
+                  f"请停止服务器后再运行，或在服务器中运行：POST /api/recognition-runs "
+                  f"{{\"tag\": \"{args.tag}\"}}")
+            sys.exit(1)
+
+    targets = webapp.recognition_targets(args.book, args.chapter)
+    if args.report:
+        for tag in args.report:
+            print(summarize(tag, targets))
+        return
+
+    # 命令行单独使用一组识别客户端和任务队列，全部用于批量识别
+    config = webapp.app.config
+    backend = args.backend or config['ASR_BACKEND']
+    server = args.server or config['ASR_SERVER']
+    pool = asr.RecognizerPool(
+        lambda: asr.create_backend(backend, server=server, base_dir=webapp.app.root_path,
+                                   timeout=config['ASR_TIMEOUT']),
+        size=args.workers,
+        health_interval=config['ASR_HEALTH_INTERVAL'],
+        timeout=config['ASR_TIMEOUT']
+    )
+    job_queue = jobs.JobQueue(workers=args.workers, reserved=0, max_pending=args.workers * 2)
+    def recognize(audio_path):
+        with webapp.stored_audio(audio_path) as path:
+            return pool.recognize(path)
+
+    run = RecognitionRun(
+        args.tag, targets, recognize, webapp.store_asr_result,
+        lambda func, *func_args: job_queue.submit(func, *func_args, priority=jobs.BATCH),
+        workers=args.workers, force=args.force
+    ).start()
+
+    print(f'共 {len(targets)} 个有录音的段落，标签：{args.tag}，同时识别 {run.workers} 个')
+    try:
+        while not run.wait(2.0):
+            state = run.to_dict()
+            print(f"\r{state['progress'] * 100:.1f}%  完成 {state['completed']}  跳过 {state['skipped']}  "
+                  f"失败 {state['failed']}  {state['throughput']} 音频秒/秒", end='', flush=True)
+    except KeyboardInterrupt:
+        print('\n正在等待进行中的识别完成，之后可用同一标签继续...')
+        run.cancel()
+        run.wait()
+    finally:
+        pool.close()
+
+    state = run.to_dict()
+    print()
+    print(f"{state['status']}：完成 {state['completed']}，跳过 {state['skipped']}，失败 {state['failed']}，"
+          f"音频 {state['audio_seconds']} 秒，用时 {state['elapsed']} 秒，"
+          f"吞吐量 {state['throughput']} 音频秒/秒，CER {state['cer']}")
+    for error in state['recent_errors']:
+        print(f"  {error['paragraph_id']}: {error['message']}")
+    if state['status'] == 'failed' or state['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
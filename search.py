@@ -0,0 +1,388 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import traceback
+
+# 全文搜索
+# 所有书籍的段落文本建立一个倒排索引，保存在书籍目录下的search.db（SQLite FTS5）。
+# 中文没有空格分词，这里按二元组（相邻两个字）切分：“天气很好”索引为“天气 气很 很好 好”，
+# 每段连续汉字的最后一个字单独作为一项，单字查询以前缀方式匹配；英文和数字按单词索引。
+# 查询时按同样的方式切分，连续汉字作为短语匹配，结果按BM25排序。
+#
+# 章节保存时根据本次保存包含的操作（添加、修改、删除段落）只更新变化的段落，
+# 更新先在内存中合并，由后台线程每隔delay秒在一个事务中写入，不占用保存请求的时间。
+# 进程外修改的书籍或已有的书库需要重建索引：python search.py --rebuild
+
+INDEX_FILENAME = 'search.db'
+INDEX_VERSION = '1'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    book_id TEXT NOT NULL,
+    chapter_id TEXT NOT NULL,
+    paragraph_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (book_id, chapter_id, paragraph_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5(
+    tokens, content='', prefix='1', tokenize='unicode61 remove_diacritics 0'
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# 汉字、假名和谚文按二元组切分，其余字母和数字按单词切分
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\U00020000-\U0002fa1f'
+TOKEN_PATTERN = re.compile(f'([{CJK_CHARS}]+)|((?:(?![{CJK_CHARS}])[^\\W_])+)')
+
+# 搜索结果中摘要的长度（字数）
+SNIPPET_CHARS = 80
+# 命中数超过此值时只返回“超过”，不再精确计数
+MAX_COUNT = 1000
+
+
+def runs(text):
+    # 返回 [(是否为汉字, 连续的汉字或单词)]
+    return [(bool(m.group(1)), m.group(0).lower()) for m in TOKEN_PATTERN.finditer(text or '')]
+
+
+def tokenize(text):
+    tokens = []
+    for cjk, run in runs(text):
+        if cjk:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    return ' '.join(tokens)
+
+
+def build_query(query):
+    # 把用户输入转换为FTS5查询，没有可搜索的内容时返回None
+    parts = []
+    query_runs = runs(query)
+    for i, (cjk, run) in enumerate(query_runs):
+        if cjk and len(run) > 1:
+            parts.append('"' + ' '.join(run[j:j + 2] for j in range(len(run) - 1)) + '"')
+        elif cjk or i == len(query_runs) - 1:
+            # 单字和最后一个单词按前缀匹配，输入未完成的单词也能搜到
+            parts.append(f'"{run}"*')
+        else:
+            parts.append(f'"{run}"')
+    return ' '.join(parts) or None
+
+
+def make_snippet(text, query, size=SNIPPET_CHARS):
+    # 截取包含查询内容的一段文字，返回 (摘要, 摘要中命中位置的列表[[开始, 结束]])
+    lower = text.lower()
+    query = (query or '').strip().lower()
+    needles = [query] if query and query in lower else [run for _, run in runs(query)]
+    first = min((lower.find(n) for n in needles if n in lower), default=0)
+    start = max(0, min(first - size // 4, len(text) - size))
+    end = min(len(text), start + size)
+    snippet = text[start:end]
+
+    highlights = []
+    lower_snippet = snippet.lower()
+    for needle in needles:
+        position = lower_snippet.find(needle)
+        while needle and position != -1:
+            highlights.append([position, position + len(needle)])
+            position = lower_snippet.find(needle, position + len(needle))
+    highlights.sort()
+    # 合并重叠的命中位置
+    merged = []
+    for span in highlights:
+        if merged and span[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], span[1])
+        else:
+            merged.append(span)
+
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(text) else ''
+    return prefix + snippet + suffix, [[s + len(prefix), e + len(prefix)] for s, e in merged]
+
+
+class SearchIndex:
+    def __init__(self, path, delay=0.5):
+        # path() -> 索引数据库文件路径
+        self.path = path
+        self.delay = delay
+        self._local = threading.local()
+        # 写入串行进行：后台写入和重建章节不能交错
+        self._write_lock = threading.Lock()
+        self._cond = threading.Condition()
+        # (book_id, chapter_id) -> {paragraph_id: 文本，已删除为None}
+        self._pending = {}
+        self._thread = None
+        self._closed = False
+
+        # 统计信息
+        self.searches = 0
+        self.search_time = 0.0
+        self.writes = 0
+        self.paragraphs_written = 0
+
+    def _connect(self):
+        # 每个线程一个连接；WAL模式下搜索不会被写入阻塞
+        path = self.path()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.path != path:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.path = path
+        return conn
+
+    # 写入
+    def update(self, book_id, chapter_id, changes):
+        # changes: {paragraph_id: 文本，已删除的段落为None}；稍后由后台线程写入
+        if not changes:
+            return
+        with self._cond:
+            if self._closed:
+                return
+            self._pending.setdefault((book_id, chapter_id), {}).update(changes)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='search-index', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+            # 合并一段时间内的修改，在一个事务中写入
+            time.sleep(self.delay)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def flush(self):
+        # 立即写入所有待写入的修改
+        with self._write_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            conn = self._connect()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    count = 0
+                    for (book_id, chapter_id), changes in pending.items():
+                        for paragraph_id, text in changes.items():
+                            self._delete_doc(conn, book_id, chapter_id, paragraph_id)
+                            if text is not None and text.strip():
+                                self._insert_doc(conn, book_id, chapter_id, paragraph_id, text)
+                            count += 1
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            except Exception:
+                # 写入失败时放回队列，之后排队的修改更新，覆盖放回的内容
+                with self._cond:
+                    for key, changes in pending.items():
+                        self._pending[key] = dict(changes, **self._pending.get(key, {}))
+                raise
+            self.writes += 1
+            self.paragraphs_written += count
+            return count
+
+    @staticmethod
+    def _insert_doc(conn, book_id, chapter_id, paragraph_id, text):
+        cursor = conn.execute(
+            'INSERT INTO docs (book_id, chapter_id, paragraph_id, text) VALUES (?, ?, ?, ?)',
+            (book_id, chapter_id, paragraph_id, text))
+        conn.execute('INSERT INTO terms (rowid, tokens) VALUES (?, ?)', (cursor.lastrowid, tokenize(text)))
+
+    @staticmethod
+    def _delete_rows(conn, rows):
+        # 无内容的FTS5表删除时需要提供原来的词项
+        for doc_id, text in rows:
+            conn.execute("INSERT INTO terms (terms, rowid, tokens) VALUES ('delete', ?, ?)", (doc_id, tokenize(text)))
+            conn.execute('DELETE FROM docs WHERE id = ?', (doc_id,))
+
+    def _delete_doc(self, conn, book_id, chapter_id, paragraph_id):
+        self._delete_rows(conn, conn.execute(
+            'SELECT id, text FROM docs WHERE book_id = ? AND chapter_id = ? AND paragraph_id = ?',
+            (book_id, chapter_id, paragraph_id)).fetchall())
+
+    def _discard_pending(self, book_id, chapter_id=None):
+        with self._cond:
+            for key in [key for key in self._pending if key[0] == book_id and chapter_id in (None, key[1])]:
+                del self._pending[key]
+
+    def replace_chapter(self, book_id, chapter_id, paragraphs):
+        # 重建一个章节的索引；调用方需持有章节锁，之前排队的修改已包含在paragraphs中
+        with self._write_lock:
+            self._discard_pending(book_id, chapter_id)
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # 只重写文本有变化的段落，索引已是最新时重建只需要比较文本
+                indexed = {row[0]: row[1:] for row in conn.execute(
+                    'SELECT paragraph_id, id, text FROM docs WHERE book_id = ? AND chapter_id = ?',
+                    (book_id, chapter_id))}
+                current = {p['id']: p['text'] for p in paragraphs
+                           if p.get('text', '').strip() and not p.get('is_end_paragraph')}
+                self._delete_rows(conn, [row for paragraph_id, row in indexed.items()
+                                         if current.get(paragraph_id) != row[1]])
+                for paragraph_id, text in current.items():
+                    if paragraph_id not in indexed or indexed[paragraph_id][1] != text:
+                        self._insert_doc(conn, book_id, chapter_id, paragraph_id, text)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def remove(self, book_id, chapter_id=None):
+        # 删除一本书或一个章节的索引
+        with self._write_lock:
+            self._discard_pending(book_id, chapter_id)
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if chapter_id is None:
+                    rows = conn.execute('SELECT id, text FROM docs WHERE book_id = ?', (book_id,)).fetchall()
+                else:
+                    rows = conn.execute('SELECT id, text FROM docs WHERE book_id = ? AND chapter_id = ?',
+                                        (book_id, chapter_id)).fetchall()
+                self._delete_rows(conn, rows)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def retain(self, book_ids=None, book_id=None, chapter_ids=None):
+        # 重建时删除已不存在的书籍（book_ids），或一本书中已不存在的章节（book_id, chapter_ids）
+        conn = self._connect()
+        if book_id is None:
+            for (stale,) in conn.execute('SELECT DISTINCT book_id FROM docs').fetchall():
+                if stale not in book_ids:
+                    self.remove(stale)
+            return
+        for (stale,) in conn.execute('SELECT DISTINCT chapter_id FROM docs WHERE book_id = ?', (book_id,)).fetchall():
+            if stale not in chapter_ids:
+                self.remove(book_id, stale)
+
+    def is_built(self):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row is not None and row[0] == INDEX_VERSION
+
+    def mark_built(self):
+        self._connect().execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (INDEX_VERSION,))
+
+    # 查询
+    def search(self, query, book_id=None, limit=20, offset=0):
+        # 返回 (命中总数，超过MAX_COUNT时为MAX_COUNT, [{book_id, chapter_id, paragraph_id, snippet, highlights, score}])
+        fts_query = build_query(query)
+        if fts_query is None:
+            return 0, []
+        start = time.monotonic()
+        conn = self._connect()
+        book_filter = ' AND docs.book_id = ?' if book_id else ''
+        params = (fts_query, book_id) if book_id else (fts_query,)
+        rows = conn.execute(
+            'SELECT docs.book_id, docs.chapter_id, docs.paragraph_id, docs.text, bm25(terms) AS score '
+            'FROM terms JOIN docs ON docs.id = terms.rowid '
+            f'WHERE terms MATCH ?{book_filter} ORDER BY score LIMIT ? OFFSET ?',
+            params + (limit, offset)).fetchall()
+        total = conn.execute(
+            'SELECT count(*) FROM (SELECT 1 FROM terms JOIN docs ON docs.id = terms.rowid '
+            f'WHERE terms MATCH ?{book_filter} LIMIT ?)', params + (MAX_COUNT,)).fetchone()[0]
+
+        results = []
+        for book, chapter, paragraph, text, score in rows:
+            snippet, highlights = make_snippet(text, query)
+            results.append({
+                'book_id': book,
+                'chapter_id': chapter,
+                'paragraph_id': paragraph,
+                'snippet': snippet,
+                'highlights': highlights,
+                # bm25越小越相关，取反后越大越相关
+                'score': round(-score, 3)
+            })
+        with self._cond:
+            self.searches += 1
+            self.search_time += time.monotonic() - start
+        return total, results
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        try:
+            self.flush()
+        except Exception:
+            traceback.print_exc()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def stats(self):
+        with self._cond:
+            pending = sum(len(changes) for changes in self._pending.values())
+            searches, search_time = self.searches, self.search_time
+        # 索引还未建立时不创建数据库文件
+        paragraphs = size = None
+        if os.path.exists(self.path()):
+            try:
+                paragraphs = self._connect().execute('SELECT count(*) FROM docs').fetchone()[0]
+                size = os.path.getsize(self.path())
+            except (sqlite3.Error, OSError):
+                pass
+        return {
+            'paragraphs': paragraphs,
+            'bytes': size,
+            'pending': pending,
+            'writes': self.writes,
+            'paragraphs_written': self.paragraphs_written,
+            'searches': searches,
+            'avg_search_ms': round(search_time / searches * 1000, 2) if searches else 0
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='全文搜索索引')
+    parser.add_argument('query', nargs='?', help='搜索内容')
+    parser.add_argument('--rebuild', action='store_true', help='重建整个书库（或--book指定的书籍）的索引')
+    parser.add_argument('--book', type=str, default=None, help='书籍id')
+    parser.add_argument('--limit', type=int, default=20, help='最多显示的结果数')
+    args = parser.parse_args()
+    if not args.query and not args.rebuild:
+        parser.error('需要指定搜索内容或--rebuild')
+
+    import app as webapp
+
+    if args.rebuild:
+        result = webapp.rebuild_search_index(args.book, log=print)
+        print(f"重建完成：{result['books']} 本书，{result['chapters']} 个章节，"
+              f"{result['paragraphs']} 个段落，用时 {result['elapsed']} 秒")
+    if args.query:
+        start = time.monotonic()
+        total, results = webapp.search_index.search(args.query, args.book, limit=args.limit)
+        print(f"共 {total}{'+' if total >= MAX_COUNT else ''} 条结果，用时 {(time.monotonic() - start) * 1000:.1f} 毫秒")
+        for result in results:
+            print(f"{result['book_id'][:8]} {result['chapter_id'][:8]} {result['paragraph_id'][:8]}  {result['snippet']}")
+    webapp.search_index.close()
@@ -0,0 +1,94 @@
+import signal
+import threading
+import time
+
+# Web服务器
+# production模式使用cheroot（纯Python的WSGI服务器，Windows下和打包为exe后都可以使用）：
+#   - 固定大小的请求线程池，keep-alive连接空闲timeout秒后关闭
+#   - 内置TLS，使用与开发服务器相同的自签名证书
+#   - 收到Ctrl+C（SIGINT）或SIGTERM时停止接受新连接，等待进行中的请求完成（最多drain_timeout秒）
+#     再返回，之后由atexit写入章节缓存中未保存的修改；再按一次Ctrl+C立即退出
+# dev模式为Flask自带的开发服务器，未安装cheroot时也使用它。
+#
+# 服务器只运行一个进程：写回模式的章节缓存、按章节的锁、任务队列、SSE事件推送和边录边识别的会话
+# 都在进程内存中，同一章节的请求落到不同进程时会丢失识别结果推送和录音片段。
+# 耗时的工作已经不占用请求线程：录音转换在进程池中执行，语音识别在任务队列中执行。
+# 每个打开的编辑器保持一个SSE连接并占用一个请求线程，threads需要大于同时打开的编辑器数。
+
+MODES = ('production', 'dev')
+
+
+def run_dev(flask_app, host, port, cert=None, key=None):
+    ssl_context = None
+    if cert and key:
+        import ssl
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert, key)
+    flask_app.run(debug=False, host=host, port=port, ssl_context=ssl_context, threaded=True)
+
+
+def run_production(wsgi_app, host, port, cert=None, key=None, threads=32, timeout=30.0, drain_timeout=30.0,
+                   on_stop=None, on_ready=None):
+    from cheroot import wsgi
+
+    server = wsgi.Server(
+        (host, port), wsgi_app,
+        numthreads=threads,
+        request_queue_size=128,
+        timeout=timeout,
+        shutdown_timeout=drain_timeout
+    )
+    if cert and key:
+        from cheroot.ssl.builtin import BuiltinSSLAdapter
+        server.ssl_adapter = BuiltinSSLAdapter(cert, key)
+    # 绑定端口和证书错误在这里抛出，调用方可以回退
+    server.prepare()
+
+    # 服务器在后台线程中运行，主线程等待信号：Windows下阻塞在socket上的主线程收不到Ctrl+C
+    thread = threading.Thread(target=server.serve, name='wsgi-server', daemon=True)
+    thread.start()
+    if on_ready:
+        on_ready()
+
+    stopping = threading.Event()
+    signals = [signal.SIGINT] + [getattr(signal, name) for name in ('SIGTERM', 'SIGBREAK') if hasattr(signal, name)]
+    previous = {sig: signal.signal(sig, lambda sig, frame: stopping.set()) for sig in signals}
+    try:
+        while not stopping.is_set() and thread.is_alive():
+            stopping.wait(0.5)
+    finally:
+        # 等待期间再按Ctrl+C立即退出
+        for sig, handler in previous.items():
+            signal.signal(sig, signal.default_int_handler if sig == signal.SIGINT else handler)
+
+    print(f'\n正在停止服务器，等待进行中的请求完成（最多 {drain_timeout:g} 秒）...')
+    start = time.monotonic()
+    try:
+        if on_stop:
+            on_stop()
+        server.stop()
+        thread.join(drain_timeout)
+    except KeyboardInterrupt:
+        print('已强制停止服务器，进行中的请求被中断')
+        return
+    print(f'服务器已停止，用时 {time.monotonic() - start:.1f} 秒')
+
+
+def run(flask_app, host, port, cert=None, key=None, mode='production', threads=32, timeout=30.0,
+        drain_timeout=30.0, on_stop=None, on_ready=None):
+    # 阻塞运行直到服务器停止；on_ready在开始接受连接后调用
+    if mode == 'production':
+        try:
+            import cheroot
+        except ImportError:
+            print('未安装cheroot（pip install cheroot），使用Flask开发服务器')
+            mode = 'dev'
+    if mode == 'dev':
+        # 开发服务器在app.run中绑定端口，无法在绑定之后回调，在启动前调用
+        if on_ready:
+            on_ready()
+        run_dev(flask_app, host, port, cert, key)
+        return
+    print(f'生产模式：{threads} 个请求线程')
+    run_production(flask_app, host, port, cert, key, threads=threads, timeout=timeout,
+                   drain_timeout=drain_timeout, on_stop=on_stop, on_ready=on_ready)
@@ -0,0 +1,401 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+import oplog
+
+# SQLite存储后端
+# 默认的JSON目录存储（books/<id>/book_info.json、chapters/<id>/content.json）由Book和Chapter直接读写；
+# STORAGE_MODE为'sqlite'时改为通过本模块读写同一个数据库文件，音频文件仍保存在章节目录下。
+#
+# 存储后端需要提供：
+#   load_book(book_id) / save_book(data) / delete_book(book_id)
+#   list_books()                                   书架摘要
+#   load_chapter(book_id, chapter_id)              返回 {id, title, revision, version, paragraphs} 或 None
+#   save_chapter(book_id, chapter_id, title, paragraphs, revision, ops, base_version)
+#   chapter_version(book_id, chapter_id)           用于判断缓存的章节是否过期
+#   delete_chapter(book_id, chapter_id)
+#
+# 每个段落一行，按(chapter_id, order_key)建立索引。order_key为浮点数，
+# 插入和移动时取相邻两段的中间值，只写入变化的那一行；间隔过小时重新编号整章。
+# 保存时根据章节记录的操作（Chapter._pending_ops）只写入变化的行，一次保存在同一个事务内完成。
+
+ORDER_STEP = 1024.0
+# 相邻order_key的最小间隔，低于此值时重新编号整章
+MIN_ORDER_GAP = 1e-6
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL DEFAULT '',
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    id TEXT NOT NULL,
+    book_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    created_at TEXT,
+    position INTEGER NOT NULL DEFAULT 0,
+    revision INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    word_count INTEGER,
+    PRIMARY KEY (book_id, id)
+);
+CREATE TABLE IF NOT EXISTS paragraphs (
+    chapter_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    order_key REAL NOT NULL,
+    text TEXT NOT NULL DEFAULT '',
+    audio TEXT NOT NULL DEFAULT '',
+    created_at TEXT,
+    extra TEXT,
+    PRIMARY KEY (chapter_id, id)
+);
+CREATE INDEX IF NOT EXISTS paragraphs_order ON paragraphs (chapter_id, order_key);
+'''
+
+# 之后增加的列，打开旧数据库时补上
+ADDED_COLUMNS = (
+    ('books', 'updated_at', 'TEXT'),
+    ('chapters', 'updated_at', 'TEXT'),
+    ('chapters', 'word_count', 'INTEGER'),
+)
+
+# 段落中单独成列的字段，其余字段（如transcribe_delay）以JSON保存在extra列
+PARAGRAPH_COLUMNS = ('id', 'text', 'audio', 'created_at')
+
+
+def _word_count(texts):
+    # 与Chapter.word_count一致，按非空白字符计算
+    return sum(len(''.join(text.split())) for text in texts)
+
+
+def _paragraph_row(chapter_id, paragraph, order_key):
+    extra = {k: v for k, v in paragraph.items() if k not in PARAGRAPH_COLUMNS}
+    return (
+        chapter_id,
+        paragraph['id'],
+        order_key,
+        paragraph.get('text', ''),
+        paragraph.get('audio', ''),
+        paragraph.get('created_at'),
+        json.dumps(extra, ensure_ascii=False) if extra else None
+    )
+
+
+class SqliteStorage:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        for table, column, kind in ADDED_COLUMNS:
+            if column not in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+        self._backfill_word_counts(conn)
+
+    def _backfill_word_counts(self, conn):
+        # 旧数据库新增word_count列后按段落文本补算一次
+        rows = conn.execute('SELECT book_id, id FROM chapters WHERE word_count IS NULL').fetchall()
+        for book_id, chapter_id in rows:
+            texts = [r[0] for r in conn.execute('SELECT text FROM paragraphs WHERE chapter_id = ?', (chapter_id,))]
+            conn.execute('UPDATE chapters SET word_count = ? WHERE book_id = ? AND id = ?',
+                         (_word_count(texts), book_id, chapter_id))
+
+    def _connect(self):
+        # 每个线程一个连接；WAL模式下读取不会被写入阻塞
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=OFF')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # 书籍
+    def load_book(self, book_id):
+        conn = self._connect()
+        row = conn.execute('SELECT id, title, author FROM books WHERE id = ?', (book_id,)).fetchone()
+        if row is None:
+            return None
+        chapters = conn.execute(
+            'SELECT id, title, created_at FROM chapters WHERE book_id = ? ORDER BY position',
+            (book_id,)).fetchall()
+        return {
+            'id': row[0],
+            'title': row[1],
+            'author': row[2],
+            'chapters': [{'id': c[0], 'title': c[1], 'created_at': c[2]} for c in chapters]
+        }
+
+    def save_book(self, data, updated_at=None):
+        # 章节的修订号和版本号由save_chapter维护，这里只更新标题和顺序
+        updated_at = updated_at or datetime.datetime.now().isoformat()
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO books (id, title, author, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET title = excluded.title, author = excluded.author, '
+                'updated_at = excluded.updated_at',
+                (data['id'], data['title'], data.get('author', ''), updated_at))
+            for position, chapter in enumerate(data.get('chapters', [])):
+                conn.execute(
+                    'INSERT INTO chapters (id, book_id, title, created_at, position) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(book_id, id) DO UPDATE SET title = excluded.title, '
+                    'created_at = excluded.created_at, position = excluded.position',
+                    (chapter['id'], data['id'], chapter['title'], chapter.get('created_at'), position))
+
+    def delete_book(self, book_id):
+        with self._transaction() as conn:
+            conn.execute(
+                'DELETE FROM paragraphs WHERE chapter_id IN (SELECT id FROM chapters WHERE book_id = ?)',
+                (book_id,))
+            conn.execute('DELETE FROM chapters WHERE book_id = ?', (book_id,))
+            conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+
+    def list_books(self):
+        # 书架摘要，字数为各章节保存时记录的word_count之和
+        # 修改时间与JSON存储一致：书籍信息或任一章节最后一次保存的时间
+        conn = self._connect()
+        rows = conn.execute('''
+            SELECT b.id, b.title, b.author,
+                   (SELECT COUNT(*) FROM chapters c WHERE c.book_id = b.id),
+                   (SELECT created_at FROM chapters c WHERE c.book_id = b.id ORDER BY position LIMIT 1),
+                   (SELECT COALESCE(SUM(c.word_count), 0) FROM chapters c WHERE c.book_id = b.id),
+                   (SELECT MAX(t) FROM (SELECT b.updated_at AS t
+                                        UNION ALL SELECT c.updated_at FROM chapters c WHERE c.book_id = b.id))
+              FROM books b ORDER BY b.rowid
+        ''').fetchall()
+        return [{
+            'id': r[0],
+            'title': r[1],
+            'author': r[2],
+            'chapter_count': r[3],
+            'created_at': r[4],
+            'word_count': r[5],
+            'updated_at': r[6]
+        } for r in rows]
+
+    # 章节
+    def chapter_version(self, book_id, chapter_id):
+        row = self._connect().execute(
+            'SELECT version FROM chapters WHERE book_id = ? AND id = ?', (book_id, chapter_id)).fetchone()
+        return row[0] if row else None
+
+    def load_chapter(self, book_id, chapter_id):
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT title, revision, version FROM chapters WHERE book_id = ? AND id = ?',
+            (book_id, chapter_id)).fetchone()
+        if row is None:
+            return None
+        paragraphs = []
+        for pid, text, audio, created_at, extra in conn.execute(
+                'SELECT id, text, audio, created_at, extra FROM paragraphs WHERE chapter_id = ? ORDER BY order_key',
+                (chapter_id,)):
+            paragraph = {'id': pid, 'text': text, 'audio': audio, 'created_at': created_at}
+            if extra:
+                paragraph.update(json.loads(extra))
+            paragraphs.append(paragraph)
+        return {'id': chapter_id, 'title': row[0], 'revision': row[1], 'version': row[2], 'paragraphs': paragraphs}
+
+    def save_chapter(self, book_id, chapter_id, title, paragraphs, revision, ops=None, base_version=None,
+                     updated_at=None):
+        # paragraphs为保存后的完整段落列表（不含结尾段落块）
+        # ops为上次保存以来的操作；数据库中的版本与base_version一致时只写入变化的行，否则整章重写
+        # 返回保存后的版本号
+        updated_at = updated_at or datetime.datetime.now().isoformat()
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT version FROM chapters WHERE book_id = ? AND id = ?', (book_id, chapter_id)).fetchone()
+            if row is None:
+                conn.execute(
+                    'INSERT INTO chapters (id, book_id, title) VALUES (?, ?, ?)', (chapter_id, book_id, title))
+                version = 0
+            else:
+                version = row[0]
+
+            if ops is None or base_version is None or version != base_version or not self._apply_ops(conn, chapter_id, paragraphs, ops):
+                self._rewrite(conn, chapter_id, paragraphs)
+
+            version += 1
+            conn.execute(
+                'UPDATE chapters SET title = ?, revision = ?, version = ?, updated_at = ?, word_count = ? '
+                'WHERE book_id = ? AND id = ?',
+                (title, revision, version, updated_at, _word_count(p.get('text', '') for p in paragraphs),
+                 book_id, chapter_id))
+            return version
+
+    def delete_chapter(self, book_id, chapter_id):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM paragraphs WHERE chapter_id = ?', (chapter_id,))
+            conn.execute('DELETE FROM chapters WHERE book_id = ? AND id = ?', (book_id, chapter_id))
+
+    def _rewrite(self, conn, chapter_id, paragraphs):
+        conn.execute('DELETE FROM paragraphs WHERE chapter_id = ?', (chapter_id,))
+        conn.executemany(
+            'INSERT INTO paragraphs (chapter_id, id, order_key, text, audio, created_at, extra) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [_paragraph_row(chapter_id, p, (i + 1) * ORDER_STEP) for i, p in enumerate(paragraphs)])
+
+    def _apply_ops(self, conn, chapter_id, paragraphs, ops):
+        # 按操作只写入变化的行，无法增量写入时返回False，由调用方整章重写
+        placed = set()
+        changed = set()
+        deleted = set()
+        for op in ops:
+            kind = op['op']
+            if kind == 'add':
+                placed.add(op['paragraph']['id'])
+            elif kind == 'move':
+                placed.add(op['id'])
+            elif kind == 'delete':
+                deleted.add(op['id'])
+                placed.discard(op['id'])
+                changed.discard(op['id'])
+            else:
+                changed.add(op['id'])
+
+        for paragraph_id in deleted:
+            conn.execute('DELETE FROM paragraphs WHERE chapter_id = ? AND id = ?', (chapter_id, paragraph_id))
+
+        positions = {p['id']: i for i, p in enumerate(paragraphs)}
+
+        # 新增或移动的段落在最终列表中连续成段，每段的order_key取两侧未移动段落之间的均分值
+        indexes = sorted(positions[pid] for pid in placed if pid in positions)
+        start = 0
+        while start < len(indexes):
+            end = start
+            while end + 1 < len(indexes) and indexes[end + 1] == indexes[end] + 1:
+                end += 1
+            first, last = indexes[start], indexes[end]
+            keys = self._order_keys(
+                conn, chapter_id,
+                paragraphs[first - 1]['id'] if first > 0 else None,
+                paragraphs[last + 1]['id'] if last + 1 < len(paragraphs) else None,
+                last - first + 1)
+            if keys is None:
+                return False
+            conn.executemany(
+                'INSERT OR REPLACE INTO paragraphs (chapter_id, id, order_key, text, audio, created_at, extra) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [_paragraph_row(chapter_id, paragraphs[first + i], key) for i, key in enumerate(keys)])
+            start = end + 1
+
+        for paragraph_id in changed - placed:
+            if paragraph_id not in positions:
+                continue
+            row = _paragraph_row(chapter_id, paragraphs[positions[paragraph_id]], 0)
+            cursor = conn.execute(
+                'UPDATE paragraphs SET text = ?, audio = ?, created_at = ?, extra = ? WHERE chapter_id = ? AND id = ?',
+                (row[3], row[4], row[5], row[6], chapter_id, paragraph_id))
+            if cursor.rowcount == 0:
+                return False
+        return True
+
+    def _order_keys(self, conn, chapter_id, before_id, after_id, count):
+        # 在before_id和after_id两段之间生成count个递增的order_key，间隔过小或找不到相邻段落时返回None
+        def key_of(paragraph_id):
+            row = conn.execute(
+                'SELECT order_key FROM paragraphs WHERE chapter_id = ? AND id = ?',
+                (chapter_id, paragraph_id)).fetchone()
+            return row[0] if row else None
+
+        low = key_of(before_id) if before_id else None
+        high = key_of(after_id) if after_id else None
+        if (before_id and low is None) or (after_id and high is None):
+            return None
+        if low is None and high is None:
+            low, high = 0.0, (count + 1) * ORDER_STEP
+        elif low is None:
+            low = high - (count + 1) * ORDER_STEP
+        elif high is None:
+            high = low + (count + 1) * ORDER_STEP
+        step = (high - low) / (count + 1)
+        if step < MIN_ORDER_GAP:
+            return None
+        return [low + step * (i + 1) for i in range(count)]
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE 在事务开始时就取得写锁，避免多个线程同时升级为写事务时互相等待超时
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
+
+
+def _file_time(path):
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+
+
+def migrate(books_folder, storage, log=print):
+    # 把JSON目录存储中的书籍导入数据库，章节按content.json快照加ops.log重放得到的内容导入
+    # 可以重复执行，已存在的书籍和章节会被覆盖
+    books = chapters = paragraphs = 0
+    for book_id in sorted(os.listdir(books_folder)):
+        info_file = os.path.join(books_folder, book_id, 'book_info.json')
+        if not os.path.exists(info_file):
+            continue
+        with open(info_file, 'r', encoding='utf-8') as f:
+            book = json.load(f)
+        # 修改时间沿用文件的修改时间，导入后书架的排序不变
+        storage.save_book(book, _file_time(info_file))
+        books += 1
+
+        for chapter in book.get('chapters', []):
+            chapter_dir = os.path.join(books_folder, book_id, 'chapters', chapter['id'])
+            content_file = os.path.join(chapter_dir, 'content.json')
+            if not os.path.exists(content_file):
+                continue
+            with open(content_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            items = data.get('paragraphs', [])
+            revision = data.get('revision', 0)
+            for op in oplog.read_ops(os.path.join(chapter_dir, oplog.LOG_FILENAME), after_seq=data.get('log_seq', 0)):
+                oplog.apply_op(items, op)
+                revision = op.get('revision', revision + 1)
+            items = [p for p in items if not p.get('is_end_paragraph') and p['id'] != 'end_paragraph']
+            storage.save_chapter(book_id, chapter['id'], chapter['title'], items, revision,
+                                 updated_at=_file_time(content_file))
+            chapters += 1
+            paragraphs += len(items)
+        log(f'已导入：{book["title"]}')
+    return books, chapters, paragraphs
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='把books目录中的书籍导入SQLite数据库')
+    parser.add_argument('--books', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'books'), help='书籍目录')
+    parser.add_argument('--db', type=str, default=None, help='数据库文件路径，默认为书籍目录下的library.db')
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(args.books, 'library.db')
+    storage = SqliteStorage(db_path)
+    books, chapters, paragraphs = migrate(args.books, storage)
+    print(f'导入完成：{books} 本书，{chapters} 个章节，{paragraphs} 个段落 -> {db_path}')
+    print("将 STORAGE_MODE 设置为 'sqlite' 后启用数据库存储")
@@ -0,0 +1,113 @@
+import os
+import struct
+import sys
+import wave
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as webapp
+import asr
+
+STORAGE_MODES = ('snapshot', 'oplog', 'sqlite')
+
+
+def configure(root, storage):
+    # 切换到临时书籍目录，返回切换前的配置
+    keys = ('BOOKS_FOLDER', 'STORAGE_MODE', 'SQLITE_PATH', 'SEARCH_INDEX_PATH', 'WRITE_BEHIND')
+    saved = {key: webapp.app.config[key] for key in keys}
+    webapp.chapter_store.clear()
+    webapp.app.config['BOOKS_FOLDER'] = str(root)
+    webapp.app.config['STORAGE_MODE'] = storage
+    webapp.app.config['SQLITE_PATH'] = None
+    webapp.app.config['SEARCH_INDEX_PATH'] = os.path.join(str(root), 'search.db')
+    return saved
+
+
+def restore(saved):
+    # 写入未保存的修改后再恢复配置，后台线程不会写到其他目录
+    webapp.chapter_store.clear()
+    if webapp.search_build_thread is not None:
+        webapp.search_build_thread.join(5)
+    webapp.search_index.flush()
+    webapp.catalog.close()
+    webapp.app.config.update(saved)
+    webapp.chapter_store.write_behind = saved['WRITE_BEHIND']
+
+
+class Library:
+    def __init__(self, root, storage):
+        self.root = root
+        self.storage = storage
+        self.client = webapp.app.test_client()
+
+    def post(self, url, **kwargs):
+        data = self.client.post(url, **kwargs).get_json()
+        assert data is not None
+        return data
+
+    def new_chapter(self, texts=()):
+        book_id = self.post('/api/book/new', json={'title': '测试书籍'})['book']['id']
+        chapter_id = self.post(f'/api/book/{book_id}/chapter/new', json={'title': '第一章'})['chapter']['id']
+        for text in texts:
+            assert self.post(f'/api/chapter/{book_id}/{chapter_id}/paragraph/add', json={'text': text})['success']
+        return book_id, chapter_id
+
+    def record(self, book_id, chapter_id, paragraph_id, seconds=0.5, text=None):
+        # 给段落添加一段录音；text不为None时测试识别后端（fake）会返回它，见asr.FakeBackend
+        chapter = self.cached(book_id, chapter_id)
+        filename = chapter.new_audio_filename(paragraph_id)
+        path = os.path.join(chapter.audio_dir, filename)
+        with wave.open(path, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(16000)
+            f.writeframes(struct.pack('<h', 1000) * int(seconds * 16000))
+        if text is not None:
+            with open(os.path.splitext(path)[0] + '.txt', 'w', encoding='utf-8') as f:
+                f.write(text)
+        with webapp.chapter_lock(book_id, chapter_id):
+            chapter.add_audio(paragraph_id, filename)
+            webapp.chapter_store.commit(chapter)
+        return path
+
+    def cached(self, book_id, chapter_id):
+        return webapp.chapter_store.get(book_id, chapter_id)
+
+    def reload(self, book_id, chapter_id):
+        # 写入所有未保存的修改，丢弃缓存，从磁盘或数据库重新加载
+        webapp.chapter_store.clear()
+        return webapp.Chapter.load(chapter_id, book_id)
+
+
+@pytest.fixture(params=STORAGE_MODES)
+def library(request, tmp_path):
+    saved = configure(tmp_path, request.param)
+    try:
+        yield Library(tmp_path, request.param)
+    finally:
+        restore(saved)
+
+
+@pytest.fixture
+def oplog_library(tmp_path):
+    saved = configure(tmp_path, 'oplog')
+    try:
+        yield Library(tmp_path, 'oplog')
+    finally:
+        restore(saved)
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    # 一个识别任务客户端和一个边录边识别连接，使用测试后端
+    pool = asr.RecognizerPool(asr.FakeBackend, size=1, health_interval=0, max_streams=1)
+    monkeypatch.setattr(webapp, 'asr_pool', pool)
+    yield pool
+    pool.close()
+
+
+def state(chapter):
+    # 用于比较的章节内容：段落顺序、文本、录音和修订号
+    return chapter.revision, [(p['id'], p['text'], p.get('audio', '')) for p in chapter.paragraphs]
@@ -0,0 +1,123 @@
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+import asr
+
+
+class FakeConnection:
+    # 代替CapsWriterBackend：前failures次连接失败
+    attempts = 0
+    failures = 0
+
+    def __init__(self, server, base_dir, timeout=60):
+        FakeConnection.attempts += 1
+        if FakeConnection.attempts <= FakeConnection.failures:
+            raise ConnectionRefusedError('refused')
+
+    def recognize(self, audio_path, trace=None):
+        return {'text': 'cw', 'duration': 0.0}
+
+    def healthy(self):
+        return True
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def flaky_cw(monkeypatch):
+    FakeConnection.attempts = 0
+    FakeConnection.failures = 1
+    monkeypatch.setattr(asr, 'CapsWriterBackend', FakeConnection)
+    monkeypatch.setattr(asr, '_cw_unreachable', asr.threading.Event())
+    return FakeConnection
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_cw_falls_back_to_exe_when_unreachable(flaky_cw):
+    backend = asr.create_backend('cw')
+    assert isinstance(backend, asr.CwExeBackend)
+    # 替代的客户端报告为不可用，池会关闭它并重新连接
+    assert not backend.healthy()
+    assert isinstance(asr.create_backend('cw'), FakeConnection)
+
+
+def test_pool_recovers_from_failed_fallback(flaky_cw, tmp_path):
+    # 替代的客户端识别失败时（例如没有start_client.exe），池重建客户端并连上CW服务端
+    pool = asr.RecognizerPool(lambda: asr.create_backend('cw', base_dir=str(tmp_path)), size=1, health_interval=0)
+    assert pool.recognize(str(tmp_path / 'a.wav'))['text'] == 'cw'
+    assert pool.stats()['restarts'] == 1
+
+
+def test_health_check_reconnects_fallback(flaky_cw, tmp_path):
+    pool = asr.RecognizerPool(lambda: asr.create_backend('cw', base_dir=str(tmp_path)), size=1, health_interval=0.02)
+    try:
+        pool._idle.get()
+        pool._idle.put(pool._create())
+        pool._ensure_health_thread()
+        # 空闲的替代客户端在健康检查时换成常驻连接
+        assert wait_until(lambda: pool.stats()['restarts'] >= 1)
+        worker = pool._idle.get(timeout=1)
+        pool._idle.put(worker)
+        assert isinstance(worker, FakeConnection)
+    finally:
+        pool.close()
+
+
+def test_pool_rebuilds_failed_client(tmp_path):
+    created = []
+
+    class Flaky(asr.FakeBackend):
+        def __init__(self):
+            super().__init__()
+            self.alive = True
+            created.append(self)
+
+        def recognize(self, audio_path, trace=None):
+            if len(created) == 1:
+                self.alive = False
+                raise ConnectionError('lost')
+            return {'text': 'ok', 'duration': 0.0}
+
+        def healthy(self):
+            return self.alive
+
+    pool = asr.RecognizerPool(Flaky, size=1, health_interval=0)
+    assert pool.recognize(str(tmp_path / 'a.wav'))['text'] == 'ok'
+    assert len(created) == 2
+    assert pool.stats()['restarts'] == 1
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='使用shell脚本模拟start_client.exe')
+def test_exe_backend_times_out(tmp_path):
+    os.makedirs(tmp_path / 'CW')
+    exe = tmp_path / 'CW' / 'start_client.exe'
+    exe.write_text('#!/bin/sh\nsleep 30\n')
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+
+    backend = asr.CwExeBackend(str(tmp_path), timeout=0.3)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        backend.recognize('a.wav')
+    assert time.monotonic() - start < 5
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='使用shell脚本模拟start_client.exe')
+def test_exe_backend_parses_output(tmp_path):
+    os.makedirs(tmp_path / 'CW')
+    exe = tmp_path / 'CW' / 'start_client.exe'
+    exe.write_text('#!/bin/sh\necho "    音频长度：3.12s "\necho "识别结果："\necho "今天天气不错"\nsleep 30\n')
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+
+    result = asr.CwExeBackend(str(tmp_path), timeout=10).recognize('a.wav')
+    assert result == {'text': '今天天气不错', 'duration': 3.12}
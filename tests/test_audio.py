@@ -0,0 +1,53 @@
+import os
+
+import app as webapp
+
+
+def test_recorded_audio_is_cached_and_served_with_ranges(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+    path = library.record(book_id, chapter_id, paragraph_id)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    url = f'/api/audio/{book_id}/{chapter_id}/{os.path.basename(path)}'
+    response = library.client.get(url)
+    assert response.status_code == 200 and response.data == data
+    # 录音文件名不会被复用，浏览器可以长期缓存
+    assert response.headers['Cache-Control'] == (
+        f"private, max-age={webapp.app.config['AUDIO_CACHE_MAX_AGE']}, immutable")
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+    response = library.client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == data[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(data)}'
+
+    assert library.client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert library.client.get(url, headers={'If-Modified-Since': last_modified}).status_code == 304
+
+
+def test_other_files_are_revalidated(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    chapter = library.cached(book_id, chapter_id)
+    chapter.ensure_dirs()
+    with open(os.path.join(chapter.audio_dir, 'import.wav'), 'wb') as f:
+        f.write(b'RIFF')
+    response = library.client.get(f'/api/audio/{book_id}/{chapter_id}/import.wav')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+
+def test_new_audio_filenames_are_unique(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    chapter = library.cached(book_id, chapter_id)
+    paragraph_id = chapter.paragraphs[0]['id']
+    # 同一秒内的多次录音不会覆盖已缓存的文件
+    names = [chapter.new_audio_filename(paragraph_id) for _ in range(3)]
+    assert len(set(names)) == 3
+    assert all(webapp.AUDIO_FILENAME_PATTERN.match(name) for name in names)
+    assert all(os.path.exists(os.path.join(chapter.audio_dir, name)) for name in names)
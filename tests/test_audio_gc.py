@@ -0,0 +1,72 @@
+import os
+import time
+
+import audio_gc
+import app as webapp
+
+
+def touch(path, age=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'data')
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_find_orphans(tmp_path):
+    audio_dir = str(tmp_path)
+    for name in ('live.wav', 'live.txt', 'live.merge.txt', 'dead.wav', 'dead.srt', 'dead.wav.upload', 'notes.dat'):
+        touch(os.path.join(audio_dir, name), age=120)
+    touch(os.path.join(audio_dir, 'originals', 'dead.m4a'), age=120)
+    touch(os.path.join(audio_dir, 'originals', 'live.m4a'), age=120)
+    # 刚上传、还没有被段落引用的录音
+    touch(os.path.join(audio_dir, 'new.wav'))
+
+    orphans = audio_gc.find_orphans(audio_dir, {'live.wav'}, grace=60)
+    assert sorted(os.path.relpath(path, audio_dir) for _, path, _ in orphans) == [
+        'dead.srt', 'dead.wav', 'dead.wav.upload', os.path.join('originals', 'dead.m4a')]
+
+
+def test_sweep_reports_until_applied(oplog_library, monkeypatch):
+    library = oplog_library
+    monkeypatch.setattr(webapp.audio_sweeper, 'grace', 0)
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+    old = library.record(book_id, chapter_id, paragraph_id, text='旧的识别结果')
+    # 重新录音后旧的录音和识别结果不再被引用
+    new = library.record(book_id, chapter_id, paragraph_id)
+    old_text = os.path.splitext(old)[0] + '.txt'
+
+    # 默认只生成报告
+    assert webapp.audio_sweeper.dry_run
+    report = webapp.audio_sweeper.sweep(book_id)
+    assert report['dry_run'] and report['files'] == 2
+    assert os.path.exists(old) and os.path.exists(old_text)
+
+    job_id = library.post('/api/audio-gc/sweep', json={'book_id': book_id, 'apply': True})['job_id']
+    job = webapp.background_jobs.get(job_id)
+    assert job.wait(5) and job.result['files'] == 2
+    assert not os.path.exists(old) and not os.path.exists(old_text)
+    assert os.path.exists(new)
+
+
+def test_sweep_removes_packed_clips_and_stray_chapters(oplog_library, monkeypatch):
+    library = oplog_library
+    monkeypatch.setattr(webapp.audio_sweeper, 'grace', 0)
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段'])
+    first, second = [p['id'] for p in library.cached(book_id, chapter_id).paragraphs[:2]]
+    kept = library.record(book_id, chapter_id, first)
+    dropped = library.record(book_id, chapter_id, second)
+    audio_dir = os.path.dirname(kept)
+    webapp.audio_packer.process(audio_dir, older_than=0)
+    library.client.delete(f'/api/chapter/{book_id}/{chapter_id}/paragraph/delete/{second}')
+    # 删除章节时中途失败留下的目录
+    stray = touch(os.path.join(library.root, book_id, 'chapters', 'stray', 'content.json'), age=10)
+
+    report = webapp.audio_sweeper.sweep(book_id, dry_run=False)
+    assert (report['packed'], report['dirs']) == (1, 1)
+    pack = webapp.audio_packs.get(audio_dir)
+    assert pack.names() == [os.path.basename(kept)]
+    assert pack.entry(os.path.basename(dropped)) is None
+    assert not os.path.exists(os.path.dirname(stray))
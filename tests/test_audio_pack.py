@@ -0,0 +1,101 @@
+import os
+
+import audio_pack
+import app as webapp
+
+
+def write_clips(audio_dir, clips):
+    os.makedirs(audio_dir, exist_ok=True)
+    paths = []
+    for name, data in clips.items():
+        path = os.path.join(audio_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def test_pack_add_remove_and_reload(tmp_path):
+    audio_dir = str(tmp_path)
+    pack = audio_pack.AudioPack(audio_dir)
+    assert pack.add(write_clips(audio_dir, {'a.wav': b'aaaa', 'b.wav': b'bb', 'b.txt': b'text'})) == 3
+    # 原文件删除，内容在包中
+    assert audio_pack.loose_files(audio_dir) == []
+    assert pack.read('b.wav') == b'bb'
+    pack.remove(['a.wav'])
+
+    reloaded = audio_pack.AudioPack(audio_dir)
+    assert sorted(reloaded.names()) == ['b.txt', 'b.wav']
+    assert reloaded.stats() == {'clips': 2, 'live_bytes': 6, 'dead_bytes': 4}
+    assert dict(reloaded.iter_clips()) == {'b.wav': b'bb', 'b.txt': b'text'}
+
+
+def test_pack_ignores_unindexed_tail(tmp_path):
+    audio_dir = str(tmp_path)
+    pack = audio_pack.AudioPack(audio_dir)
+    pack.add(write_clips(audio_dir, {'a.wav': b'aaaa'}))
+    # 写入内容后、追加索引前崩溃
+    with open(os.path.join(audio_dir, audio_pack.pack_filename(1)), 'ab') as f:
+        f.write(b'garbage')
+    pack = audio_pack.AudioPack(audio_dir)
+    pack.add(write_clips(audio_dir, {'b.wav': b'bb'}))
+    assert pack.entry('b.wav') == (audio_pack.pack_filename(1), 4, 2)
+    assert pack.read('b.wav') == b'bb'
+
+
+def test_compaction_keeps_open_clips(tmp_path):
+    audio_dir = str(tmp_path)
+    pack = audio_pack.AudioPack(audio_dir)
+    pack.add(write_clips(audio_dir, {'a.wav': b'a' * 100, 'b.wav': b'0123456789'}))
+    clip = pack.open('b.wav')
+    pack.remove(['a.wav'])
+
+    assert pack.compact()
+    assert pack.entry('b.wav') == (audio_pack.pack_filename(2), 0, 10)
+    assert sorted(os.listdir(audio_dir)) == sorted([audio_pack.INDEX_FILENAME, audio_pack.pack_filename(2)])
+    assert audio_pack.AudioPack(audio_dir).read('b.wav') == b'0123456789'
+    # 压缩前打开的录音仍然可以读取
+    with clip:
+        clip.seek(4)
+        assert clip.read() == b'456789'
+        assert clip.read() == b''
+
+
+def test_registry_keeps_one_pack_per_directory(tmp_path):
+    registry = audio_pack.PackRegistry(max_open=1)
+    first_dir, second_dir = str(tmp_path / 'first'), str(tmp_path / 'second')
+    pack = registry.get(first_dir)
+    pack.add(write_clips(first_dir, {'a.wav': b'aaaa'}))
+    registry.get(second_dir)
+
+    # 被挤出后仍在使用的包不会被另一个对象替换，之前的修改在同一把锁内可见
+    assert registry.get(first_dir) is pack
+    pack.add(write_clips(first_dir, {'b.wav': b'bb'}))
+    assert registry.get(first_dir).read('b.wav') == b'bb'
+    assert audio_pack.AudioPack(first_dir).stats()['clips'] == 2
+
+
+def test_packed_audio_is_served_with_ranges(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+    path = library.record(book_id, chapter_id, paragraph_id)
+    with open(path, 'rb') as f:
+        data = f.read()
+    webapp.audio_packer.process(os.path.dirname(path), older_than=0)
+    assert not os.path.exists(path)
+
+    url = f'/api/audio/{book_id}/{chapter_id}/{os.path.basename(path)}'
+    response = library.client.get(url)
+    assert response.status_code == 200
+    assert response.data == data
+    assert response.content_length == len(data)
+    etag = response.headers['ETag']
+
+    response = library.client.get(url, headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == data[10:20]
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(data)}'
+
+    assert library.client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert library.client.get(url, headers={'Range': f'bytes={len(data) + 10}-'}).status_code == 416
@@ -0,0 +1,67 @@
+import io
+import zipfile
+
+import book_export
+
+
+def test_txt_and_markdown_export():
+    chapters = [('第一章', ['第一段', '  ', '# 不是标题']), ('第二章', ['第二段\n换行'])]
+    text = b''.join(book_export.export('txt', 'b', '书名', '作者', chapters)).decode('utf-8')
+    assert text == '书名\n作者：作者\n\n\n第一章\n\n第一段\n# 不是标题\n\n\n第二章\n\n第二段\n换行\n'
+
+    markdown = b''.join(book_export.export('md', 'b', '书名', '', chapters)).decode('utf-8')
+    assert markdown == '# 书名\n\n## 第一章\n\n第一段\n\n\\# 不是标题\n\n## 第二章\n\n第二段  \n换行\n'
+
+
+def test_export_reads_chapters_lazily():
+    read = []
+
+    def chapters():
+        for i in range(3):
+            read.append(i)
+            yield f'第{i}章', [f'段落{i}']
+
+    for fmt in ('txt', 'epub'):
+        read.clear()
+        stream = book_export.export(fmt, 'b', '书名', '', chapters())
+        next(stream)
+        next(stream)
+        # 输出第一块数据时只读取了第一章
+        assert read == [0]
+        list(stream)
+        assert read == [0, 1, 2]
+
+
+def test_streamed_epub_is_a_valid_archive():
+    chapters = [('第一章', ['<第一段> & 更多']), ('第二章', ['第二段'])]
+    data = b''.join(book_export.export('epub', 'b', '书名', '作者', chapters))
+    # mimetype是第一个文件且未压缩，阅读器按固定偏移识别
+    assert data[30:38] == b'mimetype' and data[38:58] == b'application/epub+zip'
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.infolist()[0].compress_type == zipfile.ZIP_STORED
+        # 没有数据描述符，文件头中已写入大小
+        assert not any(info.flag_bits & 0x08 for info in archive.infolist())
+        assert 'OEBPS/chapter-0002.xhtml' in archive.namelist()
+        chapter = archive.read('OEBPS/chapter-0001.xhtml').decode('utf-8')
+        assert '<p>&lt;第一段&gt; &amp; 更多</p>' in chapter
+        assert '<itemref idref="chapter-2"/>' in archive.read('OEBPS/content.opf').decode('utf-8')
+
+
+def test_export_endpoint(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段'])
+    library.post(f'/api/chapter/{book_id}/{chapter_id}/paragraph/add', json={'text': '第三段'})
+
+    response = library.client.get(f'/api/book/{book_id}/export?format=txt')
+    assert response.is_streamed
+    assert response.mimetype == 'text/plain'
+    assert "filename*=UTF-8''" in response.headers['Content-Disposition']
+    assert response.get_data(as_text=True).endswith('第一章\n\n第一段\n第二段\n第三段\n')
+
+    response = library.client.get(f'/api/book/{book_id}/export?format=epub')
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert '第三段' in archive.read('OEBPS/chapter-0001.xhtml').decode('utf-8')
+
+    assert not library.client.get(f'/api/book/{book_id}/export?format=pdf').get_json()['success']
@@ -0,0 +1,58 @@
+import json
+import os
+
+import app as webapp
+import catalog
+
+
+def write_book(root, book_id, chapter_ids, title='书'):
+    os.makedirs(os.path.join(root, book_id), exist_ok=True)
+    with open(os.path.join(root, book_id, 'book_info.json'), 'w', encoding='utf-8') as f:
+        json.dump({'id': book_id, 'title': title, 'chapters': [{'id': c, 'title': c} for c in chapter_ids]}, f)
+
+
+def test_catalog_reuses_summaries_until_files_change(tmp_path):
+    root = str(tmp_path)
+    words = {('b', 'c1'): 3, ('b', 'c2'): 4}
+    signatures = {key: [[1, 1]] for key in words}
+    counted = []
+
+    def chapter_words(book_id, chapter_id):
+        counted.append(chapter_id)
+        return words[(book_id, chapter_id)]
+
+    write_book(root, 'b', ['c1', 'c2'])
+    books = catalog.Catalog(lambda: root, lambda *key: signatures[key], chapter_words, verify_interval=0)
+    assert [(b['id'], b['chapter_count'], b['word_count']) for b in books.books()] == [('b', 2, 7)]
+    assert sorted(counted) == ['c1', 'c2']
+    assert os.path.exists(os.path.join(root, catalog.CATALOG_FILENAME))
+
+    # 重新启动后从catalog.json读取，签名未变的章节不重新统计字数
+    counted.clear()
+    words[('b', 'c2')] = 10
+    signatures[('b', 'c2')] = [[2, 2]]
+    books = catalog.Catalog(lambda: root, lambda *key: signatures[key], chapter_words, verify_interval=0)
+    assert books.books()[0]['word_count'] == 13
+    assert counted == ['c2']
+
+    # 章节保存时只更新该章节的字数
+    books.chapter_saved('b', 'c1', 5, [[3, 3]])
+    assert books.books()[0]['word_count'] == 15
+    assert books.stats()['books'] == 1
+
+    os.remove(os.path.join(root, 'b', 'book_info.json'))
+    assert books.books() == []
+
+
+def test_bookshelf_follows_edits(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['一二三'])
+    library.post(f'/api/chapter/{book_id}/{chapter_id}/paragraph/add', json={'text': '四 五'})
+    library.reload(book_id, chapter_id)
+    books = {b['id']: b for b in library.client.get('/api/books').get_json()['books']}
+    assert (books[book_id]['chapter_count'], books[book_id]['word_count']) == (1, 5)
+    parsed = webapp.catalog.stats()['parsed']
+
+    # 书架再次打开时不重新解析书籍信息
+    library.client.get('/api/books')
+    assert webapp.catalog.stats()['parsed'] == parsed
@@ -0,0 +1,96 @@
+import json
+import os
+import struct
+import tarfile
+import wave
+
+import app as webapp
+import dataset
+
+
+def write_wav(path, seconds):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(struct.pack('<h', 0) * int(seconds * 16000))
+    return path
+
+
+def samples(audio_dir, texts):
+    return [{
+        'book_id': 'b',
+        'chapter_id': 'c',
+        'paragraph_id': paragraph_id,
+        'text': text,
+        'audio_path': os.path.join(audio_dir, f'{paragraph_id}.wav'),
+        'audio_meta': None
+    } for paragraph_id, text in texts.items()]
+
+
+def manifest(output_dir):
+    with open(os.path.join(output_dir, dataset.MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+        return {entry['key']: entry for entry in map(json.loads, f)}
+
+
+def test_incremental_export_writes_only_changes(tmp_path):
+    audio_dir, output_dir = str(tmp_path / 'audio'), str(tmp_path / 'out')
+    os.makedirs(audio_dir)
+    for paragraph_id in ('p1', 'p2', 'p3'):
+        write_wav(os.path.join(audio_dir, f'{paragraph_id}.wav'), 0.5)
+    texts = {'p1': '第一段', 'p2': '第二段', 'p3': '第三段'}
+
+    # 分片超过大小后切分，每个分片一个样本
+    stats = dataset.export(samples(audio_dir, texts), output_dir, shard_size=1)
+    assert (stats['exported'], stats['shards_written']) == (3, [dataset.shard_name(i) for i in range(3)])
+    entries = manifest(output_dir)
+    assert entries['c_p1']['audio'] == f'{dataset.shard_name(0)}:c_p1.wav'
+    assert entries['c_p1']['duration'] == 0.5 and entries['c_p1']['chars'] == 3
+    with tarfile.open(os.path.join(output_dir, dataset.shard_name(1))) as tar:
+        assert sorted(tar.getnames()) == ['c_p2.json', 'c_p2.txt', 'c_p2.wav']
+
+    # 修改文本、删除段落：只导出变化的样本，不再被引用的分片被删除
+    texts['p1'] = '修改后的第一段'
+    del texts['p2']
+    stats = dataset.export(samples(audio_dir, texts), output_dir, shard_size=1)
+    assert (stats['exported'], stats['unchanged'], stats['removed']) == (1, 1, 1)
+    assert stats['shards_written'] == [dataset.shard_name(3)]
+    assert stats['shards_removed'] == 2
+    entries = manifest(output_dir)
+    assert sorted(entries) == ['c_p1', 'c_p3']
+    assert entries['c_p1']['text'] == '修改后的第一段' and entries['c_p1']['shard'] == dataset.shard_name(3)
+    assert sorted(n for n in os.listdir(output_dir) if n.endswith('.tar')) == [
+        dataset.shard_name(2), dataset.shard_name(3)]
+
+    # 重新录音（文件大小变化）也会重新导出；过滤条件按记录的时长判断
+    write_wav(os.path.join(audio_dir, 'p3.wav'), 1.5)
+    stats = dataset.export(samples(audio_dir, texts), output_dir, shard_size=1, max_duration=1.0)
+    assert (stats['exported'], stats['unchanged'], stats['filtered']) == (0, 1, 1)
+    assert sorted(manifest(output_dir)) == ['c_p1']
+
+
+def test_export_job_reads_packed_audio(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段'])
+    first, second = [p['id'] for p in library.cached(book_id, chapter_id).paragraphs[:2]]
+    packed = library.record(book_id, chapter_id, first, seconds=0.25)
+    with open(packed, 'rb') as f:
+        data = f.read()
+    webapp.audio_packer.process(os.path.dirname(packed), older_than=0)
+    library.record(book_id, chapter_id, second)
+
+    job_id = library.post(f'/api/book/{book_id}/dataset/export', json={})['job_id']
+    job = webapp.background_jobs.get(job_id)
+    assert job.wait(5) and job.status == 'done'
+    assert job.result['exported'] == 2
+
+    entries = manifest(webapp.dataset_dir(book_id))
+    entry = entries[f'{chapter_id}_{first}']
+    shard, member = entry['audio'].split(':')
+    with tarfile.open(os.path.join(webapp.dataset_dir(book_id), shard)) as tar:
+        assert tar.extractfile(member).read() == data
+
+    # 打包后的录音按包中的位置判断，未变化时不再导出
+    job = webapp.background_jobs.get(library.post(f'/api/book/{book_id}/dataset/export', json={})['job_id'])
+    assert job.wait(5)
+    assert (job.result['exported'], job.result['unchanged']) == (0, 2)
@@ -0,0 +1,97 @@
+import os
+import struct
+
+import app as webapp
+import asr
+
+
+def pcm(seconds):
+    return struct.pack('<h', 1000) * int(seconds * asr.SAMPLE_RATE)
+
+
+def start(library, book_id, chapter_id, paragraph_id):
+    return library.post(f'/api/chapter/{book_id}/{chapter_id}/dictation/start', json={'id': paragraph_id})
+
+
+def events_of(q, kind, count, timeout=5.0):
+    events = []
+    while len(events) < count:
+        event = q.get(timeout=timeout)
+        if event.get('type') == kind:
+            events.append(event)
+    return events
+
+
+def test_dictation_streams_partials_and_finishes(oplog_library, fake_pool):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+    channel = (book_id, chapter_id)
+    events = webapp.event_bus.subscribe(channel)
+    try:
+        session = start(library, book_id, chapter_id, paragraph_id)
+        assert session['success'] and session['streaming']
+        session_id = session['session_id']
+        assert fake_pool.stats()['streams'] == 1
+
+        for seq in range(2):
+            result = library.post(f'/api/dictation/{session_id}/chunk?seq={seq}', data=pcm(0.25))
+            assert result['next_seq'] == seq + 1
+        # 每块音频都推送一次中间结果
+        partials = events_of(events, 'partial', 2)
+        assert [event['text'] for event in partials] == ['0.25', '0.50']
+        assert all(event['paragraph_id'] == paragraph_id for event in partials)
+
+        # 测试后端在音频旁边有同名.txt时返回其内容
+        audio_path = webapp.dictation_sessions.get(session_id).audio_path
+        with open(os.path.splitext(audio_path)[0] + '.txt', 'w', encoding='utf-8') as f:
+            f.write('边录边识别')
+        finished = library.post(f'/api/dictation/{session_id}/finish', json={})
+        assert finished['success']
+        assert finished['duration'] == 0.5
+        recognition = events_of(events, 'recognition', 1)[0]
+        assert recognition['success'] and recognition['text'] == '边录边识别'
+    finally:
+        webapp.event_bus.unsubscribe(channel, events)
+
+    # 识别流结束后连接归还，可以再次使用
+    assert fake_pool.stats()['streams'] == 0
+    assert fake_pool.stats()['requests'] == 1
+    paragraph = library.reload(book_id, chapter_id).get_paragraph(paragraph_id)
+    assert paragraph['text'] == '边录边识别'
+    assert paragraph['audio'] == os.path.basename(audio_path)
+
+
+def test_dictation_without_free_stream_records_only(oplog_library, fake_pool):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段'])
+    first, second = [p['id'] for p in library.cached(book_id, chapter_id).paragraphs[:2]]
+
+    streaming = start(library, book_id, chapter_id, first)
+    assert streaming['streaming']
+    # 连接已全部占用：只录音并说明原因，不占用识别任务的客户端
+    declined = start(library, book_id, chapter_id, second)
+    assert declined['success'] and not declined['streaming']
+    assert declined['message']
+    assert fake_pool.stats()['streams_declined'] == 1
+
+    library.post(f'/api/dictation/{declined["session_id"]}/chunk?seq=0', data=pcm(0.25))
+    job_id = library.post(f'/api/dictation/{declined["session_id"]}/finish', json={})['job_id']
+    assert webapp.job_queue.get(job_id).wait(5)
+    assert library.client.get(f'/api/jobs/{job_id}').get_json()['job']['status'] == 'done'
+    library.post(f'/api/dictation/{streaming["session_id"]}/cancel')
+    assert fake_pool.stats()['streams'] == 0
+
+
+def test_dictation_reports_backend_without_streaming(oplog_library, monkeypatch, tmp_path):
+    library = oplog_library
+    pool = asr.RecognizerPool(lambda: asr.CwExeBackend(str(tmp_path)), size=1, health_interval=0)
+    monkeypatch.setattr(webapp, 'asr_pool', pool)
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+
+    result = start(library, book_id, chapter_id, paragraph_id)
+    assert result['success'] and not result['streaming']
+    assert '不支持' in result['message']
+    assert pool.stats()['streaming'] is False
+    library.post(f'/api/dictation/{result["session_id"]}/cancel')
@@ -0,0 +1,73 @@
+import json
+
+import app as webapp
+import dictation_trace
+
+
+def make_trace(book_id, mode='upload', start=1000.0, decode=1.0, **marks):
+    trace = dictation_trace.Trace(book_id, 'c', 'p', mode)
+    times = {'record_stop': start, 'upload_received': start + 0.2, 'audio_saved': start + 0.3,
+             'recognizer_start': start + 0.4, 'first_output': start + 0.5,
+             'final_text': start + 0.3 + decode, 'chapter_saved': start + 0.35 + decode}
+    times.update(marks)
+    for stage, at in times.items():
+        if at is not None:
+            trace.mark(stage, at)
+    trace.success = True
+    return trace
+
+
+def test_percentiles_use_nearest_rank():
+    values = list(range(1, 101))
+    assert [dictation_trace.percentile(values, p) for p in (50, 90, 99)] == [50, 90, 99]
+    assert dictation_trace.percentile([7], 99) == 7
+    assert dictation_trace.summarize([0.3, 0.1, 0.2]) == {'count': 3, 'p50_ms': 200.0, 'p90_ms': 300.0,
+                                                          'p99_ms': 300.0}
+
+
+def test_trace_spans():
+    spans = make_trace('b').spans()
+    assert spans['upload'] == 0.2 and spans['queue'] == 0.1 and spans['chapter_save'] == 0.05
+    # 解码从保存录音和取得识别客户端中较晚的时间点算起
+    assert spans['decode'] == 0.9 and spans['total'] == 1.35
+
+    # 边录边识别时识别流在停止录音前已打开，没有排队阶段
+    stream = make_trace('b', mode='stream', recognizer_start=990.0, first_output=991.0).spans()
+    assert 'queue' not in stream and stream['decode'] == 1.0
+    # 只记录第一次到达的时间
+    trace = make_trace('b')
+    trace.mark('record_stop', 0)
+    assert trace.marks['record_stop'] == 1000.0
+
+
+def test_trace_log_rotates_and_reports(tmp_path):
+    path = str(tmp_path / dictation_trace.LOG_FILENAME)
+    line_size = len(json.dumps(make_trace('a').to_dict(), ensure_ascii=False)) + 1
+    log = dictation_trace.TraceLog(path, max_bytes=line_size * 4, backups=1)
+    for i in range(10):
+        log.record(make_trace('a' if i % 2 else 'b', decode=i + 1))
+    assert log.stats()['rotations'] == 2
+    # 超出保留数量的旧文件被丢弃，只统计仍在日志中的记录
+    entries = list(log.entries())
+    assert len(entries) == 6
+
+    report = log.report()
+    assert report['count'] == 6 and report['failed'] == 0
+    assert report['stages']['decode'] == {'count': 6, 'p50_ms': 6900.0, 'p90_ms': 9900.0, 'p99_ms': 9900.0}
+    assert report['books']['a']['decode']['count'] == 3
+    assert log.report(book_id='a')['count'] == 3
+    assert log.report(mode='stream')['count'] == 0
+    assert list(report['days']) == [entries[0]['day']]
+
+
+def test_latency_endpoint(oplog_library):
+    library = oplog_library
+    book_id, _ = library.new_chapter()
+    webapp.dictation_traces.record(make_trace(book_id, decode=0.5))
+    webapp.dictation_traces.record(make_trace(book_id, mode='stream', decode=1.5))
+
+    data = library.client.get(f'/api/dictation/latency?book_id={book_id}').get_json()
+    assert data['success'] and data['count'] == 2
+    assert data['titles'] == {book_id: '测试书籍'}
+    assert data['stages']['decode']['p50_ms'] == 400.0
+    assert library.client.get('/api/dictation/latency?mode=stream').get_json()['count'] == 1
@@ -0,0 +1,74 @@
+import queue
+import threading
+import time
+
+import pytest
+
+import app as webapp
+import jobs
+
+
+def test_interactive_jobs_run_before_batch():
+    job_queue = jobs.JobQueue(workers=1, reserved=0)
+    gate = threading.Event()
+    order = []
+    blocker = job_queue.submit(lambda job: gate.wait(5), priority=jobs.BATCH)
+    submitted = [
+        job_queue.submit(lambda job, name: order.append(name), name, priority=priority)
+        for name, priority in (('batch1', jobs.BATCH), ('interactive1', jobs.INTERACTIVE),
+                               ('batch2', jobs.BATCH), ('interactive2', jobs.INTERACTIVE))
+    ]
+    gate.set()
+    assert blocker.wait(5)
+    assert all(job.wait(5) for job in submitted)
+    assert order == ['interactive1', 'interactive2', 'batch1', 'batch2']
+
+
+def test_reserved_worker_skips_batch_jobs():
+    # 批量任务占满其余工作线程时，保留的工作线程仍然处理交互式任务
+    job_queue = jobs.JobQueue(workers=2, reserved=1)
+    gate = threading.Event()
+    batch = [job_queue.submit(lambda job: gate.wait(5), priority=jobs.BATCH) for _ in range(3)]
+    try:
+        interactive = job_queue.submit(lambda job: 'done', priority=jobs.INTERACTIVE)
+        assert interactive.wait(5) and interactive.result == 'done'
+        assert job_queue.stats()['running'] == 1
+        assert job_queue.stats()['queued_batch'] == 2
+    finally:
+        gate.set()
+    assert all(job.wait(5) for job in batch)
+
+
+def test_full_queue_rejects_jobs():
+    job_queue = jobs.JobQueue(workers=1, reserved=0, max_pending=1)
+    gate = threading.Event()
+    job_queue.submit(lambda job: gate.wait(5))
+    try:
+        # 正在执行的任务不计入等待数
+        while job_queue.stats()['running'] == 0:
+            time.sleep(0.01)
+        job_queue.submit(lambda job: None)
+        with pytest.raises(queue.Full):
+            job_queue.submit(lambda job: None)
+        assert job_queue.stats()['rejected'] == 1
+    finally:
+        gate.set()
+
+
+def test_failed_job_reports_error():
+    job = jobs.JobQueue(workers=1, reserved=0).submit(lambda job: 1 / 0)
+    assert job.wait(5)
+    assert job.status == 'failed' and 'division' in job.error
+
+
+def test_background_work_stays_off_asr_queue(oplog_library):
+    library = oplog_library
+    book_id, _ = library.new_chapter(['第一段'])
+    submitted = webapp.job_queue.stats()['submitted']
+
+    job_id = library.post('/api/audio-gc/sweep', json={'book_id': book_id})['job_id']
+    assert webapp.background_jobs.get(job_id).wait(5)
+    assert library.client.get(f'/api/jobs/{job_id}').get_json()['job']['status'] == 'done'
+    assert webapp.submit_search_rebuild(book_id).wait(5)
+    # 识别任务队列的工作线程只处理语音识别
+    assert webapp.job_queue.stats()['submitted'] == submitted
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+
+import app as webapp
+import metrics
+from locks import KeyedLocks
+
+
+def test_lock_wait_is_not_counted_in_enclosing_phase():
+    locks = KeyedLocks()
+    request_metrics = metrics.RequestMetrics(locks.thread_wait, slow_threshold=0.0001)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with locks.hold('chapter'):
+            holding.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    holding.wait(5)
+    threading.Timer(0.2, release.set).start()
+
+    request_metrics.begin()
+    with request_metrics.phase('save'):
+        with locks.hold('chapter'):
+            with request_metrics.phase('load'):
+                time.sleep(0.05)
+    request_metrics.finish('save_chapter', 'POST', 200)
+    thread.join()
+
+    phases = request_metrics.stats()['recent_slow'][-1]['phases_ms']
+    assert phases['lock_wait'] >= 150
+    assert phases['load'] >= 45
+    # 保存阶段只剩下自身的耗时，不包含等锁和加载
+    assert phases['save'] < 40
+    assert sum(phases.values()) <= request_metrics.stats()['recent_slow'][-1]['ms'] + 1
+
+
+def test_stats_counters_are_rendered_as_counters():
+    gauges, counters = metrics.flatten_stats({
+        'chapter_cache': {'entries': 3, 'hits': 10, 'write_behind': False},
+        'locks': {'wait_total': 0.5, 'wait_max': 0.1}
+    })
+    assert gauges == {'chapter_cache_entries': 3, 'chapter_cache_write_behind': False, 'locks_wait_max': 0.1}
+    assert counters == {'chapter_cache_hits': 10, 'locks_wait_total': 0.5}
+
+    text = metrics.RequestMetrics().render(gauges, counters)
+    assert '# TYPE dbinputnote_chapter_cache_hits_total counter\ndbinputnote_chapter_cache_hits_total 10\n' in text
+    assert '# TYPE dbinputnote_chapter_cache_entries gauge\ndbinputnote_chapter_cache_entries 3\n' in text
+    assert 'dbinputnote_locks_wait_total 0.5\n' in text
+
+
+def test_metrics_endpoint(oplog_library):
+    library = oplog_library
+    # 请求统计在整个进程内累计，按前后两次的差值判断
+    key = ('add_paragraph', 'POST', '200')
+    before = webapp.request_metrics._requests.get(key, 0)
+    library.new_chapter(['第一段'])
+    text = library.client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE dbinputnote_request_duration_seconds histogram' in text
+    assert f'dbinputnote_requests_total{{endpoint="add_paragraph",method="POST",status="200"}} {before + 1}' in text
+    assert '# TYPE dbinputnote_jobs_submitted_total counter' in text
+    assert '# TYPE dbinputnote_jobs_running gauge' in text
+
+
+def test_slow_request_settings_apply_after_import(oplog_library, monkeypatch, tmp_path):
+    library = oplog_library
+    slow_log = tmp_path / 'slow.log'
+    monkeypatch.setitem(webapp.app.config, 'SLOW_REQUEST_THRESHOLD', 0.000001)
+    monkeypatch.setitem(webapp.app.config, 'SLOW_REQUEST_LOG', str(slow_log))
+    monkeypatch.setattr(webapp.request_metrics, 'slow_threshold', webapp.request_metrics.slow_threshold)
+    monkeypatch.setattr(webapp.request_metrics, 'slow_log', webapp.request_metrics.slow_log)
+    webapp.apply_config()
+
+    library.client.get('/api/books')
+    entry = json.loads(slow_log.read_text(encoding='utf-8').splitlines()[-1])
+    assert entry['endpoint'] == 'get_books'
+    assert set(entry['phases_ms']) == set(metrics.PHASES)
@@ -0,0 +1,79 @@
+import json
+import socket
+
+import app as webapp
+import rerecognize
+
+
+def test_score_counts_characters():
+    # 中文按字比较，忽略空白和标点
+    assert rerecognize.score('今天天气不错。', '今天 天汽不错') == (1, 6)
+    assert rerecognize.score('Hello, World', 'hello world') == (0, 10)
+
+
+def test_recognition_run_stores_results_and_resumes(oplog_library, fake_pool):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['今天天气不错', '没有录音', '明天下雨'])
+    first, _, third = [p['id'] for p in library.cached(book_id, chapter_id).paragraphs[:3]]
+    library.record(book_id, chapter_id, first, text='今天天汽不错')
+    library.record(book_id, chapter_id, third, text='明天下雨')
+
+    result = library.post('/api/recognition-runs', json={'tag': 'fake', 'book_id': book_id})
+    run = webapp.recognition_runs[result['run']['id']]
+    assert run.wait(5)
+    state = run.to_dict()
+    assert state['status'] == 'done'
+    assert (state['total'], state['completed'], state['failed']) == (2, 2, 0)
+    assert state['cer'] == 0.1
+
+    paragraph = library.reload(book_id, chapter_id).get_paragraph(first)
+    assert paragraph['asr']['fake']['text'] == '今天天汽不错'
+    assert paragraph['asr']['fake']['cer'] == round(1 / 6, 4)
+    report = library.client.get(f'/api/recognition-report?tag=fake&book_id={book_id}').get_json()
+    assert report['reports'][0]['recognized'] == 2
+
+    # 同一标签再次运行时跳过已识别的段落
+    again = webapp.recognition_runs[
+        library.post('/api/recognition-runs', json={'tag': 'fake', 'book_id': book_id})['run']['id']]
+    assert again.wait(5)
+    assert (again.to_dict()['completed'], again.to_dict()['skipped']) == (0, 2)
+
+
+def test_recognition_run_reports_worker_limit(oplog_library, fake_pool):
+    library = oplog_library
+    book_id, _ = library.new_chapter(['第一段'])
+    batch_workers = webapp.job_queue.workers - webapp.job_queue.reserved
+
+    result = library.post('/api/recognition-runs', json={'tag': 'fake', 'book_id': book_id,
+                                                         'workers': batch_workers + 3})
+    assert result['run']['workers'] == batch_workers
+    assert result['run']['requested_workers'] == batch_workers + 3
+    assert str(batch_workers) in result['message']
+    assert webapp.recognition_runs[result['run']['id']].wait(5)
+
+
+def test_recognition_targets_bypass_chapter_cache(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+    library.record(book_id, chapter_id, paragraph_id)
+    webapp.chapter_store.clear()
+
+    targets = webapp.recognition_targets(book_id)
+    assert [target['paragraph_id'] for target in targets] == [paragraph_id]
+    assert webapp.chapter_store.stats()['entries'] == 0
+
+
+def test_running_server_is_detected(oplog_library):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    port = listener.getsockname()[1]
+    with open(webapp.server_info_path(), 'w', encoding='utf-8') as f:
+        json.dump({'pid': -1, 'port': port}, f)
+    try:
+        assert webapp.running_server()['port'] == port
+    finally:
+        listener.close()
+    # 服务器异常退出后残留的记录不算
+    assert webapp.running_server() is None
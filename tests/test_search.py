@@ -0,0 +1,56 @@
+import os
+import threading
+
+import app as webapp
+import search
+
+
+def search_api(library, query, **params):
+    # 保存章节时排队的索引修改立即写入
+    webapp.chapter_store.flush_all()
+    webapp.search_index.flush()
+    return library.client.get('/api/search', query_string=dict(params, q=query)).get_json()
+
+
+def test_tokenize_uses_bigrams():
+    assert search.tokenize('天气很好 Hello') == '天气 气很 很好 好 hello'
+
+
+def test_search_follows_edits(library):
+    book_id, chapter_id = library.new_chapter(['今天天气很好', '明天下雨'])
+    webapp.search_index.mark_built()
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+
+    result = search_api(library, '天气')
+    assert not result['indexing']
+    assert [(r['book_id'], r['paragraph_id']) for r in result['results']] == [(book_id, paragraph_id)]
+    assert result['results'][0]['chapter_title'] == '第一章'
+
+    library.post(f'/api/chapter/{book_id}/{chapter_id}/paragraph/update', json={'id': paragraph_id, 'text': '晴天'})
+    assert search_api(library, '天气')['total'] == 0
+    assert search_api(library, '晴天')['total'] == 1
+    # 按书籍过滤
+    assert search_api(library, '晴天', book_id='missing')['total'] == 0
+
+
+def test_first_search_does_not_wait_for_index(oplog_library, monkeypatch):
+    library = oplog_library
+    library.new_chapter(['已有的段落'])
+    # 换成一个空的索引，相当于升级后第一次搜索已有的书库
+    webapp.search_index.flush()
+    monkeypatch.setitem(webapp.app.config, 'SEARCH_INDEX_PATH', os.path.join(library.root, 'empty.db'))
+
+    gate = threading.Event()
+    rebuild = webapp.rebuild_search_index
+    monkeypatch.setattr(webapp, 'rebuild_search_index', lambda *args: gate.wait(5) and rebuild(*args))
+    try:
+        result = search_api(library, '段落')
+        assert result['success'] and result['indexing'] and result['message']
+        assert result['total'] == 0
+    finally:
+        gate.set()
+    webapp.search_build_thread.join(5)
+
+    result = search_api(library, '段落')
+    assert not result['indexing']
+    assert result['total'] == 1
@@ -0,0 +1,221 @@
+import os
+import random
+import time
+
+import app as webapp
+import chapter_store
+import oplog
+import storage
+from conftest import state
+
+
+def random_edits(library, book_id, chapter_id, count, seed):
+    # 随机执行添加、修改、移动、删除和批量操作
+    rng = random.Random(seed)
+    base = f'/api/chapter/{book_id}/{chapter_id}'
+    for i in range(count):
+        ids = [p['id'] for p in library.cached(book_id, chapter_id).paragraphs[:-1]]
+        kind = rng.choice(('add', 'add', 'update', 'update', 'move', 'delete', 'batch'))
+        if kind == 'add' or not ids:
+            after_id = rng.choice(ids) if ids and rng.random() < 0.5 else None
+            library.post(f'{base}/paragraph/add', json={'text': f'段落{i}', 'after_id': after_id})
+        elif kind == 'update':
+            library.post(f'{base}/paragraph/update', json={'id': rng.choice(ids), 'text': f'修改{i}'})
+        elif kind == 'move':
+            library.post(f'{base}/paragraph/move-to', json={'id': rng.choice(ids), 'index': rng.randrange(len(ids))})
+        elif kind == 'delete':
+            library.client.delete(f'{base}/paragraph/delete/{rng.choice(ids)}')
+        else:
+            library.post(f'{base}/paragraphs/batch', json={'ops': [
+                {'op': 'add', 'text': f'批量{i}', 'after_id': rng.choice(ids)},
+                {'op': 'update', 'id': '$0', 'text': f'批量修改{i}'},
+                {'op': 'move', 'id': rng.choice(ids), 'direction': 'down'},
+            ]})
+
+
+def test_round_trip(library):
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段', '第三段'])
+    random_edits(library, book_id, chapter_id, 60, seed=1)
+    expected = state(library.cached(book_id, chapter_id))
+
+    assert state(library.reload(book_id, chapter_id)) == expected
+    # 重新加载后继续修改，再次加载仍然一致
+    random_edits(library, book_id, chapter_id, 30, seed=2)
+    expected = state(library.cached(book_id, chapter_id))
+    assert state(library.reload(book_id, chapter_id)) == expected
+
+
+def test_write_behind_is_flushed(library):
+    webapp.chapter_store.write_behind = True
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    paragraph_id = library.cached(book_id, chapter_id).paragraphs[0]['id']
+    library.post(f'/api/chapter/{book_id}/{chapter_id}/paragraph/update', json={'id': paragraph_id, 'text': '写回'})
+    assert webapp.chapter_store.is_dirty(book_id, chapter_id)
+
+    chapter = library.reload(book_id, chapter_id)
+    assert chapter.get_paragraph(paragraph_id)['text'] == '写回'
+
+
+def test_cache_checks_staleness_outside_lock():
+    class Stub:
+        def __init__(self, book_id, chapter_id):
+            self.book_id, self.id = book_id, chapter_id
+            self.size_estimate = 0
+            self.stale = False
+
+        def is_stale(self):
+            # 检查期间其他线程可以使用缓存
+            assert not store._lock.locked()
+            return self.stale
+
+    store = chapter_store.ChapterStore(lambda chapter_id, book_id: Stub(book_id, chapter_id))
+    first = store.get('b', 'c')
+    assert store.get('b', 'c') is first
+    first.stale = True
+    second = store.get('b', 'c')
+    assert second is not first
+    assert (store.hits, store.misses, store.invalidations) == (1, 2, 1)
+
+
+def test_bookshelf_summary(library):
+    book_id, chapter_id = library.new_chapter(['一二三', '四 五'])
+    webapp.chapter_store.clear()
+    books = {book['id']: book for book in webapp.Book.get_all_books()}
+    assert books[book_id]['chapter_count'] == 1
+    assert books[book_id]['word_count'] == 5
+    assert books[book_id]['updated_at']
+
+
+def test_sqlite_word_count_is_stored_per_chapter(tmp_path):
+    path = str(tmp_path / 'books.db')
+    db = storage.SqliteStorage(path)
+    db.save_book({'id': 'b', 'title': '书', 'author': '', 'chapters': [{'id': 'c', 'title': '章'}]})
+    db.save_chapter('b', 'c', '章', [{'id': 'p1', 'text': '一二三'}, {'id': 'p2', 'text': '四\u3000五'}], 1)
+    assert db.list_books()[0]['word_count'] == 5
+    db.save_chapter('b', 'c', '章', [{'id': 'p1', 'text': '一二'}], 2)
+    assert db.list_books()[0]['word_count'] == 2
+
+    # 新增word_count列之前的数据库在打开时补算
+    db._connect().execute('UPDATE chapters SET word_count = NULL')
+    assert storage.SqliteStorage(path).list_books()[0]['word_count'] == 2
+
+
+def test_oplog_replay(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段'])
+    random_edits(library, book_id, chapter_id, 40, seed=3)
+    expected = state(library.cached(book_id, chapter_id))
+    webapp.chapter_store.clear()
+
+    # 修改只追加到日志，加载时在快照上重放
+    chapter_dir = os.path.join(library.root, book_id, 'chapters', chapter_id)
+    log_file = os.path.join(chapter_dir, oplog.LOG_FILENAME)
+    assert os.path.getsize(log_file) > 0
+    chapter = webapp.Chapter.load(chapter_id, book_id)
+    assert chapter.log_ops > 0
+    assert state(chapter) == expected
+
+
+def test_oplog_ignores_torn_last_line(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    random_edits(library, book_id, chapter_id, 10, seed=4)
+    expected = state(library.cached(book_id, chapter_id))
+    webapp.chapter_store.clear()
+
+    # 写入中途崩溃时最后一行不完整
+    log_file = os.path.join(library.root, book_id, 'chapters', chapter_id, oplog.LOG_FILENAME)
+    with open(log_file, 'a', encoding='utf-8') as f:
+        f.write('{"seq": 999, "op": "delete", "id"')
+    assert state(webapp.Chapter.load(chapter_id, book_id)) == expected
+
+
+def test_oplog_compaction(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段'])
+    random_edits(library, book_id, chapter_id, 40, seed=5)
+    chapter = library.cached(book_id, chapter_id)
+    expected = state(chapter)
+    webapp.chapter_store.flush(book_id, chapter_id)
+
+    log_file = os.path.join(library.root, book_id, 'chapters', chapter_id, oplog.LOG_FILENAME)
+    with open(log_file, 'rb') as f:
+        old_log = f.read()
+    assert chapter.compact()
+    assert chapter.log_ops == 0
+    assert os.path.getsize(log_file) == 0
+    assert state(library.reload(book_id, chapter_id)) == expected
+
+    # 写入快照之后、清空日志之前崩溃：已包含在快照中的记录不会被重复应用
+    with open(log_file, 'wb') as f:
+        f.write(old_log)
+    assert state(webapp.Chapter.load(chapter_id, book_id)) == expected
+
+
+def test_oplog_compaction_after_threshold(oplog_library, monkeypatch):
+    library = oplog_library
+    monkeypatch.setitem(webapp.app.config, 'OPLOG_COMPACT_OPS', 5)
+    compactions = webapp.compactor.compactions
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    random_edits(library, book_id, chapter_id, 20, seed=6)
+    expected = state(library.cached(book_id, chapter_id))
+
+    # 日志超过阈值后由后台线程压缩
+    deadline = time.monotonic() + 5
+    while webapp.compactor.compactions == compactions and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert webapp.compactor.compactions > compactions
+    assert state(library.reload(book_id, chapter_id)) == expected
+
+
+def test_batch_rollback(library):
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段', '第三段'])
+    chapter = library.cached(book_id, chapter_id)
+    ids = [p['id'] for p in chapter.paragraphs[:-1]]
+    before = state(chapter)
+
+    result = library.post(f'/api/chapter/{book_id}/{chapter_id}/paragraphs/batch', json={'ops': [
+        {'op': 'add', 'text': '新段落', 'after_id': ids[0]},
+        {'op': 'update', 'id': ids[1], 'text': '修改'},
+        {'op': 'move', 'id': ids[2], 'index': 0},
+        {'op': 'delete', 'id': ids[0]},
+        {'op': 'update', 'id': 'missing', 'text': '不存在'},
+    ]})
+    assert not result['success']
+    assert result['failed_index'] == 4
+    assert state(library.cached(book_id, chapter_id)) == before
+
+    # 回滚后继续修改缓存中的同一个章节对象，保存时不会带上被回滚的操作
+    library.post(f'/api/chapter/{book_id}/{chapter_id}/paragraph/add', json={'text': '第四段'})
+    expected = state(library.cached(book_id, chapter_id))
+    assert len(expected[1]) == 5
+    assert state(library.reload(book_id, chapter_id)) == expected
+
+
+def test_batch_commit(library):
+    book_id, chapter_id = library.new_chapter(['第一段'])
+    result = library.post(f'/api/chapter/{book_id}/{chapter_id}/paragraphs/batch', json={'ops': [
+        {'op': 'add', 'text': '甲'},
+        {'op': 'add', 'text': '乙', 'after_id': '$0'},
+        {'op': 'move', 'id': '$1', 'index': 0},
+    ]})
+    assert result['success']
+    chapter = library.reload(book_id, chapter_id)
+    assert [p['text'] for p in chapter.paragraphs[:-1]] == ['乙', '第一段', '甲']
+
+
+def test_migrate_json_to_sqlite(oplog_library):
+    library = oplog_library
+    book_id, chapter_id = library.new_chapter(['第一段', '第二段'])
+    random_edits(library, book_id, chapter_id, 30, seed=7)
+    expected = state(library.cached(book_id, chapter_id))
+    webapp.chapter_store.clear()
+
+    # 快照加未压缩的日志一起导入
+    db = storage.SqliteStorage(os.path.join(library.root, 'library.db'))
+    try:
+        assert storage.migrate(str(library.root), db, log=lambda message: None) == (1, 1, len(expected[1]) - 1)
+    finally:
+        db.close()
+    webapp.app.config['STORAGE_MODE'] = 'sqlite'
+    assert state(webapp.Chapter.load(chapter_id, book_id)) == expected